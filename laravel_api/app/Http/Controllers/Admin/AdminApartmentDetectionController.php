@@ -4,6 +4,7 @@
 
 use App\Http\Controllers\Controller;
 use Illuminate\Http\Request;
+use Illuminate\Support\Facades\Cache;
 use Illuminate\Support\Facades\Log;
 use Illuminate\Support\Facades\Storage;
 use Symfony\Component\Process\Process;
@@ -19,6 +20,11 @@ class AdminApartmentDetectionController extends Controller
      * - target_image: Clean PNG/JPG image for polygon alignment (optional)
      * 
      * If target_image is provided, polygons are transformed to match target coordinates.
+     * If pages is provided (e.g. "all" or "1-3,5"), every selected PDF page is
+     * processed and the response holds one result per page under "pages".
+     * If plan_key is provided for a single-page upload, the run is stored under
+     * that key and the next upload with the same key only recomputes the
+     * apartments near edited red lines (ids of the others stay the same).
      * 
      * Returns:
      * - JSON with detected apartment polygons (coordinates as percentages)
@@ -31,9 +37,19 @@ public function detect(Request $request)
         $request->validate([
             'source_pdf' => 'required|file|mimes:pdf|max:20480', // max 20MB
             'target_image' => 'nullable|file|mimes:png,jpg,jpeg|max:20480', // optional clean image
+            'pages' => ['nullable', 'string', 'max:100', 'regex:/^(all|[0-9,\-\s]+)$/i'], // optional multi-page selection
+            'plan_key' => ['nullable', 'string', 'regex:/^[0-9A-Za-z_-]{1,64}$/'], // optional incremental re-detection
         ]);
 
         $tempPaths = [];
+        $statePath = null;
+        if ($request->filled('plan_key') && !$request->filled('pages')) {
+            $stateDir = storage_path('app/detection-state');
+            if (!is_dir($stateDir)) {
+                mkdir($stateDir, 0775, true);
+            }
+            $statePath = $stateDir . '/' . $request->input('plan_key') . '.npz';
+        }
 
         try {
             // Store source PDF temporarily
@@ -49,6 +65,28 @@ public function detect(Request $request)
                 $targetPath = Storage::path($tempPaths['target']);
             }
 
+            // Prefer a running detection worker (detect_apartments.py --serve --socket)
+            // so the request does not pay Python/OpenCV startup cost
+            $workerSocket = env('DETECTION_SOCKET');
+            if ($workerSocket) {
+                $result = $this->detectViaWorker($workerSocket, $sourcePath, $targetPath, $request->input('pages'), $statePath);
+
+                if ($result !== null) {
+                    $this->cleanupTempFiles($tempPaths);
+
+                    if (empty($result['success'])) {
+                        return response()->json([
+                            'success' => false,
+                            'error' => 'Detection failed: ' . ($result['error'] ?? 'Unknown error occurred')
+                        ], 500);
+                    }
+
+                    $this->logTimings($result, 'worker');
+
+                    return response()->json($result);
+                }
+            }
+
             // Run Python detection script
             $scriptPath = base_path('scripts/detect_apartments.py');
 
@@ -95,12 +133,53 @@ public function detect(Request $request)
                 ], 500);
             }
 
-            // Build command with arguments
-            $command = [$pythonPath, $scriptPath, '--source', $sourcePath];
+            // Name the packages to install instead of failing inside the script
+            $dependencies = $this->pythonDependencies($pythonPath, $scriptPath);
+            if ($dependencies !== null && !empty($dependencies['missing'])) {
+                $this->cleanupTempFiles($tempPaths);
+                return response()->json([
+                    'success' => false,
+                    'error' => 'Python dependencies missing: ' . implode(', ', $dependencies['missing'])
+                        . '. Install them with: pip install ' . implode(' ', $dependencies['missing'])
+                ], 500);
+            }
+
+            // Build command with arguments. Intermediate results are cached by
+            // content hash so re-uploads of the same plan skip finished stages.
+            // --stream prints one JSON record per line, so stray library output
+            // on stdout cannot corrupt the result.
+            $command = [
+                $pythonPath, $scriptPath,
+                '--source', $sourcePath,
+                '--cache-dir', storage_path('app/detection-cache'),
+                '--stream',
+            ];
             if ($targetPath) {
                 $command[] = '--target';
                 $command[] = $targetPath;
             }
+            if ($request->filled('pages')) {
+                $command[] = '--pages';
+                $command[] = $request->input('pages');
+            }
+            if ($statePath) {
+                if (file_exists($statePath)) {
+                    $command[] = '--previous-state';
+                    $command[] = $statePath;
+                }
+                $command[] = '--save-state';
+                $command[] = $statePath;
+            }
+            // Per-stage CPU time and peak memory in the logged timings
+            if (env('DETECTION_PROFILE')) {
+                $command[] = '--profile';
+            }
+            // Degrade (tile, lower DPI, skip OCR or registration) instead of
+            // being killed at the hosting memory limit
+            if (env('DETECTION_MAX_MEMORY')) {
+                $command[] = '--max-memory';
+                $command[] = (string) (int) env('DETECTION_MAX_MEMORY');
+            }
 
             Log::info('Running apartment detection', [
                 'command' => implode(' ', $command),
@@ -134,25 +213,10 @@ public function detect(Request $request)
             }
 
             $output = $process->getOutput();
+            $result = $this->parseStreamOutput($output);
 
-            // Attempt clean decode first
-            $result = json_decode($output, true);
-
-            // If failed, try to extract JSON from mixed output (e.g. system warnings + JSON)
-            if (json_last_error() !== JSON_ERROR_NONE) {
-                // Find first '{' and last '}'
-                $start = strpos($output, '{');
-                $end = strrpos($output, '}');
-
-                if ($start !== false && $end !== false && $end > $start) {
-                    $cleanJson = substr($output, $start, $end - $start + 1);
-                    $result = json_decode($cleanJson, true);
-                }
-            }
-
-            if (json_last_error() !== JSON_ERROR_NONE || $result === null) {
+            if ($result === null) {
                 Log::error('Invalid JSON from detection script', [
-                    'error' => json_last_error_msg(),
                     'output' => $output,
                     'stderr' => $process->getErrorOutput() // Capture stderr too
                 ]);
@@ -163,6 +227,8 @@ public function detect(Request $request)
                 ], 500);
             }
 
+            $this->logTimings($result, 'script');
+
             return response()->json($result);
         } catch (\Exception $e) {
             $this->cleanupTempFiles($tempPaths);
@@ -179,6 +245,286 @@ public function detect(Request $request)
         }
     }
 
+    /**
+     * Queue a detection for the job worker (detect_apartments.py --job-worker)
+     * and return immediately with a job id to poll via jobStatus().
+     *
+     * Accepts the same fields as detect(). The uploads are moved into the job
+     * directory, which the worker deletes after its retention period.
+     */
+    public function submitJob(Request $request)
+    {
+        $request->validate([
+            'source_pdf' => 'required|file|mimes:pdf|max:20480', // max 20MB
+            'target_image' => 'nullable|file|mimes:png,jpg,jpeg|max:20480', // optional clean image
+            'pages' => ['nullable', 'string', 'max:100', 'regex:/^(all|[0-9,\-\s]+)$/i'], // optional multi-page selection
+        ]);
+
+        $jobId = date('YmdHis') . '_' . bin2hex(random_bytes(4));
+        $jobDir = $this->jobsDir() . '/' . $jobId;
+
+        try {
+            if (!mkdir($jobDir, 0775, true)) {
+                throw new \RuntimeException('Cannot create job directory');
+            }
+
+            // Paths in job.json are relative to the job directory
+            $job = ['source' => 'source.pdf', 'target' => null, 'pages' => $request->input('pages') ?: null];
+            $request->file('source_pdf')->move($jobDir, 'source.pdf');
+
+            if ($request->hasFile('target_image')) {
+                $targetImage = $request->file('target_image');
+                $job['target'] = 'target.' . $targetImage->getClientOriginalExtension();
+                $targetImage->move($jobDir, $job['target']);
+            }
+
+            file_put_contents($jobDir . '/job.json', json_encode($job));
+            file_put_contents($jobDir . '/status.json', json_encode([
+                'id' => $jobId,
+                'state' => 'queued',
+                'submitted' => microtime(true),
+            ]));
+            // Written last: the worker only picks up jobs with this marker
+            touch($jobDir . '/queued');
+        } catch (\Exception $e) {
+            Log::error('Apartment detection job submission failed', [
+                'job' => $jobId,
+                'message' => $e->getMessage()
+            ]);
+
+            return response()->json([
+                'success' => false,
+                'error' => 'Could not queue detection: ' . $e->getMessage()
+            ], 500);
+        }
+
+        Log::info('Queued apartment detection job', ['job' => $jobId]);
+
+        return response()->json([
+            'success' => true,
+            'job_id' => $jobId,
+            'state' => 'queued',
+        ], 202);
+    }
+
+    /**
+     * Report a queued detection job: state (queued, running, done, failed),
+     * current stage and progress (0-1), plus the detection result once done.
+     */
+    public function jobStatus(string $jobId)
+    {
+        if (!preg_match('/^[0-9A-Za-z_-]{1,64}$/', $jobId)) {
+            return response()->json(['success' => false, 'error' => 'Invalid job id'], 400);
+        }
+
+        $jobDir = $this->jobsDir() . '/' . $jobId;
+        $status = @json_decode((string) @file_get_contents($jobDir . '/status.json'), true);
+
+        if (!is_array($status)) {
+            return response()->json(['success' => false, 'error' => 'Job not found'], 404);
+        }
+
+        $response = ['success' => ($status['state'] ?? null) !== 'failed'] + $status;
+
+        if (($status['state'] ?? null) === 'done') {
+            $result = json_decode((string) @file_get_contents($jobDir . '/result.json'), true);
+            $response['result'] = $result;
+
+            // Clients keep polling a finished job; only the first poll that
+            // sees it done logs (creating the marker fails once it exists)
+            if (is_array($result) && ($marker = @fopen($jobDir . '/timings-logged', 'x'))) {
+                fclose($marker);
+                $this->logTimings($result, 'job');
+            }
+        }
+
+        return response()->json($response);
+    }
+
+    /**
+     * Dependency report of detect_apartments.py --check-deps for this Python.
+     *
+     * A complete installation is cached per interpreter and script version, so
+     * uploads only pay for the probe once; a report with missing packages is
+     * not cached, so installing them takes effect on the next upload. Returns
+     * null when the probe itself fails (e.g. an older script).
+     */
+    private function pythonDependencies(string $pythonPath, string $scriptPath): ?array
+    {
+        $cacheKey = 'apartment-detection-deps:' . md5($pythonPath . '|' . @filemtime($scriptPath));
+        $cached = Cache::get($cacheKey);
+        if (is_array($cached)) {
+            return $cached;
+        }
+
+        $process = new Process([$pythonPath, $scriptPath, '--check-deps']);
+        $process->setTimeout(15);
+        $process->run();
+
+        $report = json_decode(trim($process->getOutput()), true);
+        if (!is_array($report) || !isset($report['missing'])) {
+            Log::warning('Python dependency check failed', [
+                'output' => $process->getOutput(),
+                'error' => $process->getErrorOutput()
+            ]);
+            return null;
+        }
+
+        if (empty($report['missing'])) {
+            Cache::put($cacheKey, $report, now()->addDay());
+        }
+
+        return $report;
+    }
+
+    /**
+     * Queue directory shared with detect_apartments.py --job-worker --jobs-dir
+     */
+    private function jobsDir(): string
+    {
+        return env('DETECTION_JOBS_DIR') ?: storage_path('app/detection-jobs');
+    }
+
+    /**
+     * Send a detection request to the long-lived worker over its Unix socket.
+     *
+     * Returns the decoded result, or null when the worker is unreachable so the
+     * caller can fall back to spawning the script directly.
+     */
+    private function detectViaWorker(string $socketPath, string $sourcePath, ?string $targetPath, ?string $pages = null, ?string $statePath = null): ?array
+    {
+        $socket = @stream_socket_client('unix://' . $socketPath, $errno, $errstr, 5);
+
+        if (!$socket) {
+            Log::warning('Detection worker unreachable, spawning script instead', [
+                'socket' => $socketPath,
+                'error' => $errstr
+            ]);
+            return null;
+        }
+
+        stream_set_timeout($socket, 120);
+
+        $payload = json_encode([
+            'id' => uniqid('detect_', true),
+            'source' => $sourcePath,
+            'target' => $targetPath,
+            'pages' => $pages ?: null,
+            'previous_state' => $statePath && file_exists($statePath) ? $statePath : null,
+            'save_state' => $statePath,
+        ]);
+
+        fwrite($socket, $payload . "\n");
+        $line = fgets($socket);
+        $meta = stream_get_meta_data($socket);
+        fclose($socket);
+
+        if ($line === false || $meta['timed_out']) {
+            Log::error('Detection worker did not respond', ['socket' => $socketPath]);
+            return null;
+        }
+
+        $result = json_decode($line, true);
+
+        if (!is_array($result)) {
+            Log::error('Invalid JSON from detection worker', ['output' => $line]);
+            return null;
+        }
+
+        unset($result['id']);
+
+        return $result;
+    }
+
+    /**
+     * Rebuild the result document from the script's --stream (NDJSON) output.
+     *
+     * Apartment records are collected (per page for multi-page runs) and put
+     * back in id order under the summary record. Lines that are not JSON,
+     * e.g. library warnings, are skipped. Returns null without a summary.
+     */
+    private function parseStreamOutput(string $output): ?array
+    {
+        $apartments = [];
+        $summary = null;
+
+        foreach (preg_split('/\R/', $output) as $line) {
+            $record = json_decode($line, true);
+
+            if (!is_array($record)) {
+                continue;
+            }
+
+            // Plain error document, printed before arguments are parsed
+            // (e.g. a missing Python dependency)
+            if (!isset($record['type'])) {
+                if (isset($record['error'])) {
+                    return $record;
+                }
+                continue;
+            }
+
+            $type = $record['type'];
+            unset($record['type']);
+
+            if ($type === 'apartment') {
+                $page = $record['page'] ?? 0;
+                unset($record['page']);
+                $apartments[$page][] = $record;
+            } elseif ($type === 'summary') {
+                $summary = $record;
+            } elseif ($type === 'error') {
+                return $record;
+            }
+        }
+
+        if ($summary === null) {
+            return null;
+        }
+
+        $sorted = function (array $records): array {
+            usort($records, fn ($a, $b) => $a['id'] <=> $b['id']);
+            return $records;
+        };
+
+        if (isset($summary['pages'])) {
+            foreach ($summary['pages'] as $i => $page) {
+                $summary['pages'][$i]['apartments'] = $sorted($apartments[$page['page']] ?? []);
+            }
+        } else {
+            $summary['apartments'] = $sorted($apartments[0] ?? []);
+        }
+
+        return $summary;
+    }
+
+    /**
+     * Log the per-stage timings reported by the detection script, so slow
+     * requests can be traced to a pipeline stage.
+     */
+    private function logTimings(array $result, string $via): void
+    {
+        $context = ['via' => $via];
+
+        if (isset($result['pages'])) {
+            $context['pages'] = array_map(fn ($page) => [
+                'page' => $page['page'] ?? null,
+                'timings' => $page['timings'] ?? null,
+                'cache' => $page['cache'] ?? null,
+            ], $result['pages']);
+        } else {
+            $context['timings'] = $result['timings'] ?? null;
+            $context['cache'] = $result['cache'] ?? null;
+            $context['ocr'] = $result['ocr'] ?? null;
+            $context['registration'] = $result['registration'] ?? null;
+            $context['dpi'] = $result['dpi'] ?? null;
+            $context['incremental'] = $result['incremental'] ?? null;
+            $context['memory'] = $result['memory'] ?? null;
+        }
+
+        Log::info('Apartment detection timings', $context);
+    }
+
     /**
      * Clean up temporary files
      */
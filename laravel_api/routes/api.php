@@ -441,6 +441,8 @@
     // Apartment Detection from PDF (AI-powered polygon detection)
     Route::prefix('admin/detect-apartments')->middleware('role:admin')->controller(AdminApartmentDetectionController::class)->group(function () {
         Route::post('/', 'detect');  // Upload PDF with red lines, get detected polygons
+        Route::post('/jobs', 'submitJob');  // Queue a detection, returns a job id to poll
+        Route::get('/jobs/{jobId}', 'jobStatus');  // Job progress, with the result once done
     });
 
     // Admin Apartment Navigation Management Routes
@@ -0,0 +1,87 @@
+"""
+Cache benchmark: a detection without --cache-dir against a cold and a warm
+run on a DetectionCache, per setting.
+
+Each synthetic plan (benchmarks/synthetic.py) is detected once uncached,
+then twice on an empty cache directory: the first run fills it, the second
+loads every stage it can. A cache hit must give exactly the uncached result,
+so the apartments (ids, polygons, numbers) of all three runs must be equal;
+the script exits non-zero otherwise. Reports the time of each run.
+
+Usage:
+    python benchmarks/bench_cache.py
+    python benchmarks/bench_cache.py --units 24,96 --target --ocr
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from detect_apartments import DetectionCache, detect_apartments
+from synthetic import generate_plan, render_target
+
+# Settings that change which cache entries a run reads (registration ones only
+# matter with --target)
+SETTINGS = [
+    ('default', {}),
+    ('index', {'match_mode': 'index'}),
+    ('text regions', {'text_scope': 'regions'}),
+    ('tiled', {'tile_height': 256}),
+    ('dpi auto', {'dpi': 'auto'}),
+    ('pyramid', {'registration': 'pyramid'}),
+    ('sift', {'feature_backend': 'sift'}),
+]
+
+
+def run(path, target, cache_dir, settings):
+    """(ms, apartments) of one detection, on a DetectionCache in cache_dir if given"""
+    cache = DetectionCache(cache_dir) if cache_dir else None
+    start = time.perf_counter()
+    # detect_apartments() prints debug lines to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        apartments, *_ = detect_apartments(path, target, cache=cache, **settings)
+    return (time.perf_counter() - start) * 1000, apartments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', default='24,48,96', help='Comma-separated units per plan')
+    parser.add_argument('--target', action='store_true', help='Also register against a warped target render')
+    parser.add_argument('--ocr', action='store_true', help='Plans without PDF labels, numbered by OCR')
+    parser.add_argument('--seed', type=int, default=2)
+    args = parser.parse_args()
+
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"{'units':>5} {'settings':<13} {'uncached ms':>12} {'cold ms':>8} {'warm ms':>8} {'identical':>10}")
+        for units in [int(u) for u in args.units.split(',')]:
+            path = os.path.join(workdir, f"plan_{units}.pdf")
+            generate_plan(path, units, noise=0.5, seed=args.seed, label_format='' if args.ocr else 'bina {n}')
+            target = None
+            if args.target:
+                target = os.path.join(workdir, f"plan_{units}_target.png")
+                render_target(path, target, dpi=100, noise=0.5, seed=args.seed)
+
+            for name, settings in SETTINGS:
+                cache_dir = os.path.join(workdir, f"cache_{units}_{name.replace(' ', '_')}")
+                uncached_ms, uncached = run(path, target, None, settings)
+                cold_ms, cold = run(path, target, cache_dir, settings)
+                warm_ms, warm = run(path, target, cache_dir, settings)
+                identical = uncached == cold == warm
+                mismatches += not identical
+                print(f"{units:>5} {name:<13} {uncached_ms:>12.1f} {cold_ms:>8.1f} {warm_ms:>8.1f} "
+                      f"{str(identical):>10}")
+
+    if mismatches:
+        print(f"{mismatches} setting(s) where a cached run differs from an uncached one")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Incremental re-detection benchmark: a full run of an edited plan against a
+run with the previous plan's state (--previous-state).
+
+A synthetic plan is detected once with save_state, then each edit (a wall
+gap that merges a unit with the outside, a gap between two units, a new
+wall splitting a unit) is applied to a copy and detected both ways. The
+apartments (polygons and numbers) must be identical; the script exits
+non-zero otherwise. Reports the best-of-repeat total and regions-stage
+time of each path and what the incremental run kept and recomputed.
+With --ocr the plan has no PDF labels, so every unit goes through Tesseract
+and the incremental run reuses the reads of unchanged units.
+
+Usage:
+    python benchmarks/bench_incremental.py
+    python benchmarks/bench_incremental.py --units 96 --dpi 200 --ocr
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fitz
+
+from detect_apartments import Timings, detect_apartments
+from synthetic import generate_plan
+
+
+def edited_copy(src, dst, draw):
+    doc = fitz.open(src)
+    draw(doc[0])
+    doc.save(dst)
+    doc.close()
+
+
+def edits(truth):
+    """(name, draw(page)) per edit, positioned on units of the ground truth"""
+    units = truth['pages'][0]
+
+    def box(index):
+        (x0, y0), (x1, _), (_, y1), _ = units[index]['polygon']
+        return x0, y0, x1, y1
+
+    def outer_gap(page):
+        x0, y0, x1, y1 = box(0)
+        page.draw_rect(fitz.Rect(x0 - 3, (y0 + y1) / 2 - 8, x0 + 3, (y0 + y1) / 2 + 8), color=None, fill=(1, 1, 1))
+
+    def inner_gap(page):
+        x0, y0, x1, y1 = box(len(units) // 2)
+        page.draw_rect(fitz.Rect(x1 - 3, (y0 + y1) / 2 - 8, x1 + 3, (y0 + y1) / 2 + 8), color=None, fill=(1, 1, 1))
+
+    def split(page):
+        x0, y0, x1, y1 = box(len(units) // 3)
+        page.draw_line(((x0 + x1) / 2, y0), ((x0 + x1) / 2, y1), color=(1, 0, 0), width=2)
+
+    return [('outer gap', outer_gap), ('inner gap', inner_gap), ('split', split)]
+
+
+def run(path, repeat, **kwargs):
+    """(best total ms, best regions ms, apartments, timings) over repeat detections"""
+    best_total = best_regions = None
+    for _ in range(repeat):
+        timings = Timings()
+        start = time.perf_counter()
+        # detect_apartments() prints debug lines to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            apartments, *_ = detect_apartments(path, timings=timings, **kwargs)
+        total = (time.perf_counter() - start) * 1000
+        regions = timings.stages.get('regions', 0) + timings.stages.get('polygons', 0)
+        best_total = total if best_total is None else min(best_total, total)
+        best_regions = regions if best_regions is None else min(best_regions, regions)
+    return best_total, best_regions, apartments, timings
+
+
+def signature(apartments):
+    return sorted((json.dumps(a['polygon']), a['apartment_number'] or '') for a in apartments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', type=int, default=48)
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--ocr', action='store_true', help='Plan without PDF labels, numbered by OCR')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    # CLI defaults, except one Tesseract run per region (for the units
+    # without a PDF label) so a read does not depend on which other regions
+    # share its mosaic
+    settings = {'dpi': args.dpi, 'ocr_mode': 'single', 'ocr_budget': None}
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        base = os.path.join(workdir, 'plan.pdf')
+        truth = generate_plan(base, args.units, noise=0.5, seed=3, label_format='' if args.ocr else 'bina {n}')
+        state = os.path.join(workdir, 'plan.state.npz')
+        run(base, 1, save_state=state, **settings)
+
+        print(f"{'edit':<10} {'full ms':>8} {'incr ms':>8} {'regions full':>13} {'regions incr':>13} "
+              f"{'kept':>5} {'recomputed':>11} {'ocr reused':>11} {'identical':>10}")
+        for name, draw in edits(truth):
+            path = os.path.join(workdir, f"{name.replace(' ', '_')}.pdf")
+            edited_copy(base, path, draw)
+            full_ms, full_regions, full, _ = run(path, args.repeat, **settings)
+            incr_ms, incr_regions, incremental, timings = run(path, args.repeat, previous_state=state, **settings)
+            report = timings.reports['incremental']
+            identical = signature(full) == signature(incremental)
+            mismatches += not identical
+            print(f"{name:<10} {full_ms:>8.1f} {incr_ms:>8.1f} {full_regions:>13.1f} {incr_regions:>13.1f} "
+                  f"{report['kept']:>5} {report['recomputed']:>11} {report.get('ocr_reused', 0):>11} "
+                  f"{str(identical):>10}")
+
+    if mismatches:
+        print(f"{mismatches} edit(s) differ from a full run")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+PDF label extraction benchmark on a word-dense page.
+
+Builds a site-plan-like sheet holding tens of thousands of words: a grid of
+units with one "bina N" or bare-number label each, dimension strings, room
+names and area values, plus an area schedule ("bina N ... m2" rows) and
+notes in a side panel, the way real sheets carry them. Then times
+get_pdf_text_data() with the word list already extracted (only grouping
+and parsing are measured), once for the whole page and once clipped to the
+unit outlines (text_scope 'regions'). The numbers found are checked against
+the labels that were placed; numbers read from outside the unit grid are
+counted as stray.
+
+Usage:
+    python benchmarks/bench_labels.py
+    python benchmarks/bench_labels.py --units 400 --clutter 60000 --pdf site.pdf
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fitz
+import numpy as np
+
+from detect_apartments import (
+    PdfSession, clip_words, get_pdf_text_data, match_numbers_to_polygons, text_clip_boxes
+)
+from synthetic import ROOM_NAMES
+
+
+def generate_dense_page(path, units=300, clutter=30000, seed=0, size=(3370, 2384), panel=0.25):
+    """
+    Write a one-page PDF with `units` labelled cells and `clutter` distractor words
+
+    The cells fill the page left of a side panel (`panel` of the width) that
+    holds an area schedule and notes. The text is written as raw
+    content-stream operators; placing tens of thousands of words through
+    PyMuPDF's text API takes minutes.
+
+    Returns (numbers, cells): the set of unit numbers placed as labels and
+    the cell rectangles (x0, y0, x1, y1) in PDF points.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    plan_width = width * (1 - panel)
+    doc = fitz.open()
+    page = doc.new_page(width=width, height=height)
+    # Registers the Helvetica resource the operators below refer to
+    page.insert_text((0, height), ' ', fontname='helv', fontsize=3)
+    ops = []
+
+    def text(x, y, string, fontsize):
+        # PDF user space has its origin at the bottom left
+        ops.append(f"BT /helv {fontsize} Tf 1 0 0 1 {x:.2f} {height - y:.2f} Tm ({string}) Tj ET")
+
+    cols = int(np.ceil(np.sqrt(units * (plan_width - 100) / (height - 100))))
+    cell_w, cell_h = (plan_width - 100) / cols, (height - 100) / int(np.ceil(units / cols))
+    numbers, cells = set(), []
+    for index in range(units):
+        r, c = divmod(index, cols)
+        x, y = 50 + c * cell_w, 50 + r * cell_h
+        number = str(index + 1)
+        numbers.add(number)
+        cells.append((x, y, x + cell_w, y + cell_h))
+        # Half the units use "bina N", the rest a bare number above the area
+        label = f"bina {number}" if index % 2 else number
+        text(x + 8, y + 14 + (c % 4) * 3, label, 7)
+        text(x + 8, y + cell_h - 8, f"{rng.uniform(30, 140):.1f} m2", 5)
+
+    kinds = rng.integers(3, size=clutter)
+    xs = rng.uniform(50, plan_width - 80, clutter)
+    ys = rng.uniform(60, height - 50, clutter)
+    dims = rng.uniform(0.8, 9.9, clutter)
+    for kind, x, y, dim in zip(kinds, xs, ys, dims):
+        if kind == 0:
+            string = f"{dim:.2f}"
+        elif kind == 1:
+            string = ROOM_NAMES[int(dim * 10) % len(ROOM_NAMES)]
+        else:
+            string = f"{int(dim * 2)} {ROOM_NAMES[int(dim * 7) % len(ROOM_NAMES)]}"
+        text(x, y, string, 3)
+
+    # Side panel: area schedule with a row per unit (and a few that are not
+    # on this sheet), then numbered notes
+    x = plan_width + 40
+    rows = units + units // 5
+    row_h = min(10, (height - 400) / rows)
+    for row in range(rows):
+        y = 80 + row * row_h
+        text(x, y, f"bina {row + 1}", 5)
+        text(x + 120, y, f"{rng.uniform(30, 140):.1f} m2", 5)
+        text(x + 200, y, ROOM_NAMES[row % len(ROOM_NAMES)], 5)
+    for note in range(30):
+        text(x, height - 300 + note * 9, f"{note + 1}", 5)
+        text(x + 20, height - 300 + note * 9, "See detail sheet A-501 for wall types", 5)
+
+    xref = page.get_contents()[0]
+    doc.update_stream(xref, doc.xref_stream(xref) + ('\n0.3 g\n' + '\n'.join(ops)).encode())
+    doc.save(path)
+    doc.close()
+    return numbers, cells
+
+
+def time_text_data(path, image_w, image_h, repeat, near_polygons=None):
+    """Best-of-repeat ms of get_pdf_text_data() on a freshly opened page, and its result"""
+    best = None
+    for _ in range(repeat):
+        with PdfSession(path) as session:
+            start = time.perf_counter()
+            numbers = get_pdf_text_data(session.page(0), image_w, image_h, near_polygons=near_polygons)
+            elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', type=int, default=300)
+    parser.add_argument('--clutter', type=int, default=30000, help='Distractor words on the page')
+    parser.add_argument('--pdf', help='Benchmark this PDF instead of a generated page (whole page only)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs (best is reported)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path, expected, cells = args.pdf, None, []
+        if path is None:
+            path = os.path.join(workdir, 'dense.pdf')
+            expected, cells = generate_dense_page(path, args.units, args.clutter)
+
+        with PdfSession(path) as session:
+            page = session.page(0)
+            # Pixels at the default 100 DPI, so the 100px proximity margin is to scale
+            image_w, image_h = page.pixel_size(100)
+            scale = image_w / page.width
+            polygons = [[[x0 * scale, y0 * scale], [x1 * scale, y0 * scale], [x1 * scale, y1 * scale],
+                         [x0 * scale, y1 * scale]] for x0, y0, x1, y1 in cells]
+            word_counts = {'page': len(page.words())}
+            if polygons:
+                word_counts['regions'] = len(clip_words(page, text_clip_boxes(polygons, scale, scale)))
+
+        print(f"{'scope':<8} {'words':>7} {'text ms':>8} {'match ms':>9} {'numbers':>8} {'recall':>7} "
+              f"{'stray':>6} {'matched':>8}")
+        for scope, near in (('page', None), ('regions', polygons)):
+            if scope not in word_counts:
+                continue
+            text_ms, numbers = time_text_data(path, image_w, image_h, args.repeat, near)
+            recall = stray = matched = ''
+            match_ms = 0.0
+            if expected is not None:
+                found = {n['number'] for n in numbers}
+                recall = f"{len(found & expected) / len(expected):.2%}"
+                plan_right = max(c[2] for c in cells) * scale
+                stray = sum(n['center'][0] > plan_right for n in numbers)
+                units = [{'id': i + 1, 'polygon': p, 'apartment_number': None} for i, p in enumerate(polygons)]
+                start = time.perf_counter()
+                match_numbers_to_polygons(units, numbers)
+                match_ms = (time.perf_counter() - start) * 1000
+                matched = sum(u['apartment_number'] == str(u['id']) for u in units)
+            print(f"{scope:<8} {word_counts[scope]:>7} {text_ms:>8.1f} {match_ms:>9.1f} {len(numbers):>8} "
+                  f"{recall:>7} {stray:>6} {matched:>8}")
+
+
+if __name__ == '__main__':
+    main()
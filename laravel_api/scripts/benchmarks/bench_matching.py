@@ -0,0 +1,101 @@
+"""
+Matching benchmark: grid-indexed match_numbers_to_polygons() against the
+previous all-pairs cv2.pointPolygonTest loop, for a growing number of labels.
+
+Usage:
+    python benchmarks/bench_matching.py
+    python benchmarks/bench_matching.py --units 400 --labels 100,400,1600,6400
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+
+from detect_apartments import match_numbers_to_polygons
+
+
+def make_plan(units, labels, seed=0):
+    """Square units on a grid, one label per unit plus random extra labels"""
+    rng = np.random.default_rng(seed)
+    cols = int(np.ceil(np.sqrt(units)))
+    size = 120
+    polygons = []
+    numbers = []
+    for i in range(units):
+        x, y = (i % cols) * size, (i // cols) * size
+        polygons.append({
+            'id': i + 1,
+            'polygon': [[x, y], [x, y + size - 8], [x + size - 8, y + size - 8], [x + size - 8, y]],
+            'apartment_number': None
+        })
+        if len(numbers) < labels:
+            numbers.append({'number': str(i + 1), 'center': (x + size / 2, y + size / 2), 'source': 'pdf'})
+
+    # Remaining labels are dimension strings, room names etc. scattered on the sheet
+    extent = cols * size
+    while len(numbers) < labels:
+        cx, cy = rng.uniform(-200, extent + 200, 2)
+        numbers.append({'number': f"x{len(numbers)}", 'center': (float(cx), float(cy)), 'source': 'pdf'})
+    return polygons, numbers
+
+
+def match_all_pairs(polygons, pdf_numbers):
+    """The original O(polygons x labels) matching loop, kept as the baseline"""
+    all_matches = []
+    for i, poly_data in enumerate(polygons):
+        poly_pts = np.array(poly_data['polygon'])
+        for j, num_data in enumerate(pdf_numbers):
+            dist = cv2.pointPolygonTest(poly_pts, num_data['center'], False)
+            if dist >= -100:
+                all_matches.append({'poly_idx': i, 'num_idx': j, 'dist': dist, 'text': num_data['number']})
+    all_matches.sort(key=lambda x: x['dist'], reverse=True)
+
+    assigned_polygons, assigned_numbers = set(), set()
+    for match in all_matches:
+        if match['poly_idx'] in assigned_polygons or match['num_idx'] in assigned_numbers:
+            continue
+        polygons[match['poly_idx']]['apartment_number'] = match['text']
+        assigned_polygons.add(match['poly_idx'])
+        assigned_numbers.add(match['num_idx'])
+    return assigned_polygons
+
+
+def best_of(fn, polygons, numbers, repeat):
+    best = None
+    for _ in range(repeat):
+        for poly in polygons:
+            poly['apartment_number'] = None
+        start = time.perf_counter()
+        fn(polygons, numbers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, [poly['apartment_number'] for poly in polygons]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', type=int, default=200, help='Number of apartment polygons')
+    parser.add_argument('--labels', default='100,400,1600,6400', help='Comma-separated label counts')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    print(f"{'labels':>8} {'all-pairs ms':>14} {'grid ms':>10} {'speedup':>8} {'inside agree':>13}")
+    for labels in [int(n) for n in args.labels.split(',')]:
+        polygons, numbers = make_plan(args.units, labels)
+        old_ms, old = best_of(match_all_pairs, polygons, numbers, args.repeat)
+        new_ms, new = best_of(match_numbers_to_polygons, polygons, numbers, args.repeat)
+
+        # Only labels inside a unit are expected to match the same way; the old
+        # loop also handed far-away labels to leftover units
+        labelled = min(labels, args.units)
+        agree = sum(1 for a, b in zip(old[:labelled], new[:labelled]) if a == b)
+        print(f"{labels:>8} {old_ms:>14.1f} {new_ms:>10.1f} {old_ms / new_ms:>7.1f}x {agree:>6}/{labelled:<6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Memory budget benchmark: --max-memory estimates against measured peaks, and
+what each budget costs in degradations.
+
+A synthetic plan (benchmarks/synthetic.py) per page size is detected by
+detect_apartments.py in a fresh process per run, so every peak starts from
+the same cold interpreter. A run with an unreachable budget reports the
+estimate of the requested settings next to the measured peak RSS; then each
+--limit is tried and its degradations, resolution, numbered units and
+registration outcome are listed. A budgeted run that exceeds its limit or
+dies (e.g. killed by the OOM killer) is counted and the script exits
+non-zero; the unbudgeted one is only reported.
+
+Usage:
+    python benchmarks/bench_memory.py
+    python benchmarks/bench_memory.py --sizes a1 --dpi 200 --limit 600,1200 --target
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import generate_plan, render_target
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'detect_apartments.py')
+PAGE_SIZES = {'a3': (1190, 842), 'a2': (1684, 1190), 'a1': (2384, 1684), 'a0': (3370, 2384)}
+# Budget nothing reaches, so the requested settings run as they are
+UNLIMITED_MB = 1 << 20
+
+
+def detect(source, target, dpi, limit, extra, workdir):
+    """Result JSON of one detect_apartments.py run, None if the process failed"""
+    output = os.path.join(workdir, 'result.json')
+    if os.path.exists(output):
+        os.remove(output)
+    command = [sys.executable, SCRIPT, '--source', source, '--dpi', str(dpi), '--max-memory', str(limit),
+               '--output', output] + extra
+    if target:
+        command += ['--target', target]
+    process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if process.returncode != 0 or not os.path.exists(output):
+        return None
+    with open(output) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='a3,a1', help='Comma-separated page sizes (%s)' % ','.join(PAGE_SIZES))
+    parser.add_argument('--units', type=int, default=96)
+    parser.add_argument('--dpi', default='100,200', help='Comma-separated requested resolutions')
+    parser.add_argument('--limit', default='400,800', help='Comma-separated budgets in MB')
+    parser.add_argument('--target', action='store_true', help='Also register against a warped target render')
+    parser.add_argument('--no-labels', action='store_true', help='Plans without PDF labels, numbered by OCR')
+    parser.add_argument('--set', action='append', default=[], metavar='ARG',
+                        help='Extra detect_apartments.py argument, e.g. --set=--feature-backend=sift')
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"{'plan':<5} {'dpi':>4} {'limit MB':>9} {'est MB':>7} {'peak MB':>8} {'used dpi':>9} {'numbered':>9} "
+              f"{'registered':>11}  degradations")
+        for size in args.sizes.split(','):
+            source = os.path.join(workdir, f"{size}.pdf")
+            generate_plan(source, args.units, page_size=PAGE_SIZES[size], noise=0.5, seed=1,
+                          label_format='' if args.no_labels else 'bina {n}')
+            target = None
+            if args.target:
+                target = os.path.join(workdir, f"{size}_target.png")
+                render_target(source, target, dpi=100)
+
+            for dpi in [int(d) for d in args.dpi.split(',')]:
+                for limit in [UNLIMITED_MB] + [int(l) for l in args.limit.split(',')]:
+                    result = detect(source, target, dpi, limit, args.set, workdir)
+                    label = 'none' if limit == UNLIMITED_MB else str(limit)
+                    if result is None:
+                        failures += limit != UNLIMITED_MB
+                        print(f"{size:<5} {dpi:>4} {label:>9} {'':>7} {'':>8} {'':>9} {'':>9} {'':>11}  process failed")
+                        continue
+
+                    memory = result['memory']
+                    peak = memory['peak_mb'] or 0
+                    failures += peak > limit
+                    used_dpi = (result.get('dpi') or {}).get('dpi', dpi)
+                    numbered = sum(1 for a in result['apartments'] if a['apartment_number'])
+                    registered = (result.get('registration') or {}).get('success', '')
+                    actions = ', '.join(f"{d['stage']}:{d['action']}" for d in memory['degradations'])
+                    print(f"{size:<5} {dpi:>4} {label:>9} {memory['estimated_mb'] or 0:>7} {peak:>8.0f} "
+                          f"{used_dpi:>9} {numbered:>4}/{len(result['apartments']):<4} {str(registered):>11}  "
+                          f"{actions or '-'}")
+
+    if failures:
+        print(f"{failures} run(s) failed or exceeded their limit")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+End-to-end benchmark of detect_apartments() on synthetic plans.
+
+For every plan size in --units a plan (and, with --target, a warped target
+render) is generated with benchmarks/synthetic.py, then detected --repeat
+times in-process with per-stage profiling. Reports throughput, latency
+percentiles, peak memory per stage, and accuracy against the ground truth:
+mean polygon IoU of the best-overlapping detection per unit, unit recall
+(IoU >= 0.5) and the share of units whose number was read correctly.
+
+Usage:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --units 24,96 --noise 0.5 --target --repeat 10
+    python benchmarks/bench_pipeline.py --set registration=pyramid --set tile_height=512 --json out.json
+    python benchmarks/bench_pipeline.py --set dpi=auto
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cv2
+import numpy as np
+
+from detect_apartments import Timings, detect_apartments
+from synthetic import generate_plan, render_target, truth_in_pixels
+
+
+def parse_setting(text):
+    """key=value for detect_apartments(); value parsed as JSON when possible"""
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def polygon_mask(polygon, shape):
+    mask = np.zeros(shape, np.uint8)
+    cv2.fillPoly(mask, [np.round(np.asarray(polygon)).astype(np.int32)], 1)
+    return mask
+
+
+def score(apartments, truth_units, width, height):
+    """
+    Compare detected apartments (polygons in % of a width x height image)
+    against ground-truth units (polygons in pixels of that image)
+    """
+    shape = (int(np.ceil(height)), int(np.ceil(width)))
+    detected = [
+        (polygon_mask(np.asarray(apt['polygon']) * [width / 100, height / 100], shape), apt.get('apartment_number'))
+        for apt in apartments
+    ]
+
+    ious, found, numbered = [], 0, 0
+    for unit in truth_units:
+        truth_mask = polygon_mask(unit['polygon'], shape)
+        best_iou, best_number = 0.0, None
+        for mask, number in detected:
+            union = np.count_nonzero(truth_mask | mask)
+            iou = np.count_nonzero(truth_mask & mask) / union if union else 0.0
+            if iou > best_iou:
+                best_iou, best_number = iou, number
+        ious.append(best_iou)
+        if best_iou >= 0.5:
+            found += 1
+            numbered += best_number == unit['number']
+
+    count = max(1, len(truth_units))
+    return {
+        'mean_iou': float(np.mean(ious)) if ious else 0.0,
+        'recall': found / count,
+        'number_accuracy': numbered / count,
+        'detected': len(apartments),
+    }
+
+
+def run_case(workdir, units, args, settings):
+    pdf_path = os.path.join(workdir, f"plan_{units}.pdf")
+    truth = generate_plan(pdf_path, units, noise=args.noise, seed=args.seed)
+    target_path = None
+    if args.target:
+        target_path = os.path.join(workdir, f"plan_{units}_target.png")
+        H_true = render_target(pdf_path, target_path, dpi=100, noise=args.noise, seed=args.seed)
+
+    latencies = []
+    stages = {}
+    result = None
+    for _ in range(args.repeat):
+        timings = Timings(profile=True)
+        start = time.perf_counter()
+        # detect_apartments() prints debug lines to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            result = detect_apartments(pdf_path, target_path, enable_ocr=not args.no_ocr, timings=timings, **settings)
+        latencies.append((time.perf_counter() - start) * 1000)
+        for name, values in timings.to_dict().items():
+            stages.setdefault(name, []).append(values)
+
+    apartments, src_w, src_h, tgt_w, tgt_h = result
+    # dpi=auto and --max-memory report the resolution actually rendered
+    dpi = timings.reports.get('dpi', {}).get('dpi', settings.get('dpi', 100))
+    truth_units = truth_in_pixels(truth, 0, dpi)
+    # Without a homography the output falls back to source coordinates
+    registered = timings.reports.get('registration', {}).get('success', False)
+    if target_path and registered:
+        # Ground truth moved into the target; H_true maps 100 DPI source pixels
+        scale = np.diag([100 / dpi, 100 / dpi, 1.0])
+        for unit in truth_units:
+            pts = np.float32(unit['polygon']).reshape(-1, 1, 2)
+            unit['polygon'] = cv2.perspectiveTransform(pts, H_true @ scale).reshape(-1, 2).tolist()
+        accuracy = score(apartments, truth_units, tgt_w, tgt_h)
+    else:
+        accuracy = score(apartments, truth_units, src_w, src_h)
+
+    latencies = np.array(latencies)
+    return {
+        'units': units,
+        'runs': len(latencies),
+        'throughput_per_s': 1000 * len(latencies) / latencies.sum(),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'stages': {
+            name: {
+                'wall_ms': float(np.mean([v['wall_ms'] for v in values])),
+                'cpu_ms': float(np.mean([v.get('cpu_ms', 0) for v in values])),
+                'peak_rss_mb': float(max(v.get('peak_rss_mb', 0) for v in values)),
+            }
+            for name, values in stages.items()
+        },
+        'registered': registered if target_path else None,
+        'dpi': dpi,
+        **accuracy
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', default='24,48,96', help='Comma-separated units per plan')
+    parser.add_argument('--noise', type=float, default=0.3, help='Clutter amount, 0-1')
+    parser.add_argument('--target', action='store_true', help='Also register against a warped target render')
+    parser.add_argument('--no-ocr', action='store_true', help='Skip apartment numbering, as detect_apartments.py --no-ocr')
+    parser.add_argument('--repeat', type=int, default=5, help='Detections per plan')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='detect_apartments() option, e.g. dpi=200 or match_mode=index')
+    parser.add_argument('--json', help='Also write the full results here')
+    args = parser.parse_args()
+
+    settings = dict(parse_setting(s) for s in args.set)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for units in [int(n) for n in args.units.split(',')]:
+            results.append(run_case(workdir, units, args, settings))
+
+    print(f"{'units':>6} {'dpi':>4} {'runs/s':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'peak MB':>8} "
+          f"{'IoU':>6} {'recall':>7} {'numbers':>8}{'  registered' if args.target else ''}")
+    for r in results:
+        peak = r['stages'].get('total', {}).get('peak_rss_mb', 0)
+        print(f"{r['units']:>6} {r['dpi']:>4} {r['throughput_per_s']:>7.2f} {r['p50_ms']:>8.1f} {r['p90_ms']:>8.1f} "
+              f"{r['p99_ms']:>8.1f} {peak:>8.1f} {r['mean_iou']:>6.3f} {r['recall']:>7.2%} "
+              f"{r['number_accuracy']:>8.2%}{'  ' + str(r['registered']) if args.target else ''}")
+
+    print()
+    print(f"{'units':>6} {'stage':<16} {'wall ms':>9} {'cpu ms':>9} {'peak MB':>8}")
+    for r in results:
+        for name, s in r['stages'].items():
+            print(f"{r['units']:>6} {name:<16} {s['wall_ms']:>9.1f} {s['cpu_ms']:>9.1f} {s['peak_rss_mb']:>8.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': settings, 'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
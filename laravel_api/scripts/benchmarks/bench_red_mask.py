@@ -0,0 +1,129 @@
+"""
+Red-line barrier benchmark: the band-wise red_barrier() against the original
+detect_red_lines() + clean_mask() pair.
+
+Every plan is rendered at each --dpi and both barriers are built; the output
+must be pixel-identical (the script exits non-zero otherwise). Reports the
+best-of-repeat time and the peak of NumPy/OpenCV allocations (tracemalloc)
+of each path. The tiled column checks build_barrier_tiled() against the same
+band loop run with the original pair (bands of embedded raster images are
+resampled differently from the full render, so tiled and full barriers are
+not compared with each other).
+
+Without --pdf a small corpus of synthetic plans (benchmarks/synthetic.py) is
+generated.
+
+Usage:
+    python benchmarks/bench_red_mask.py
+    python benchmarks/bench_red_mask.py --pdf plan.pdf --pdf other.pdf --dpi 100,300
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fitz
+import numpy as np
+
+from detect_apartments import (
+    PdfSession, build_barrier_tiled, clean_mask, detect_red_lines, pdf_to_image, red_barrier
+)
+from synthetic import generate_plan, render_target
+
+
+def original_barrier(image, thickness=5):
+    return clean_mask(detect_red_lines(image), thickness=thickness)
+
+
+def original_tiled(page, dpi, band_height=512, thickness=5):
+    """build_barrier_tiled() as it was, band by band through the original pair"""
+    width, height = page.pixel_size(dpi)
+    barrier = np.zeros((height, width), np.uint8)
+    overlap = 2 + thickness
+    for y0 in range(0, height, band_height):
+        y1 = min(height, y0 + band_height)
+        band, (left, top) = page.render_clip(dpi, 0, max(0, y0 - overlap), width, min(height, y1 + overlap))
+        band_barrier = original_barrier(band, thickness)
+        barrier[y0:y1, left:left + band_barrier.shape[1]] = band_barrier[y0 - top:y1 - top]
+    return barrier
+
+
+def measure(fn, image, repeat):
+    """(best ms, peak traced MB, output) of fn(image)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(image)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    out = fn(image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1e6, out
+
+
+def corpus(workdir):
+    """Synthetic plans: sparse and dense, clean and cluttered, plus a photographed-looking render"""
+    plans = []
+    for units, noise in ((24, 0.0), (48, 0.5), (96, 1.0)):
+        path = os.path.join(workdir, f"plan_{units}_{noise}.pdf")
+        generate_plan(path, units, noise=noise, seed=units)
+        plans.append(path)
+
+    # Anti-aliased, noisy red edges are where a colour rule would disagree first
+    noisy = os.path.join(workdir, 'noisy_render.png')
+    render_target(plans[1], noisy, dpi=150, warp=0.0, noise=0.8, seed=1)
+    doc = fitz.open()
+    page = doc.new_page(width=1190, height=842)
+    page.insert_image(page.rect, filename=noisy)
+    path = os.path.join(workdir, 'noisy_render.pdf')
+    doc.save(path)
+    doc.close()
+    plans.append(path)
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pdf', action='append', help='Plan to include; may be repeated (default: synthetic corpus)')
+    parser.add_argument('--dpi', default='100,200,300', help='Comma-separated render resolutions')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        plans = args.pdf or corpus(workdir)
+        print(f"{'plan':<22} {'dpi':>4} {'pixels':>9} {'orig ms':>8} {'fused ms':>9} {'orig MB':>8} "
+              f"{'fused MB':>9} {'identical':>10} {'tiled':>6}")
+        for path in plans:
+            for dpi in [int(d) for d in args.dpi.split(',')]:
+                image = pdf_to_image(path, dpi=dpi)
+                orig_ms, orig_mb, expected = measure(original_barrier, image, args.repeat)
+                fused_ms, fused_mb, barrier = measure(red_barrier, image, args.repeat)
+                identical = np.array_equal(expected, barrier)
+
+                with PdfSession(path) as session:
+                    tiled = build_barrier_tiled(session.page(0), dpi, band_height=512, thickness=5)
+                    tiled_identical = np.array_equal(original_tiled(session.page(0), dpi), tiled)
+
+                mismatches += (not identical) + (not tiled_identical)
+                name = os.path.basename(path)[:22]
+                print(f"{name:<22} {dpi:>4} {image.shape[0] * image.shape[1] / 1e6:>8.1f}M {orig_ms:>8.1f} "
+                      f"{fused_ms:>9.1f} {orig_mb:>8.1f} {fused_mb:>9.1f} {str(identical):>10} "
+                      f"{str(tiled_identical):>6}")
+                image = expected = barrier = tiled = None
+
+    if mismatches:
+        print(f"{mismatches} barrier(s) differ from the original")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Cold-start benchmark: wall time of detect_apartments.py per execution path,
+and which of the heavy dependencies each path imports.
+
+Every path runs --repeat times as a fresh process; the best wall time is
+reported, plus the time spent in imports and the DEPENDENCIES modules loaded,
+from one more run under `python -X importtime`. Detection paths include the
+detection itself on a small synthetic plan (benchmarks/synthetic.py). --script
+runs another copy of the script on the same inputs, e.g. an older revision:
+
+    git show HEAD~1:laravel_api/scripts/detect_apartments.py > /tmp/old.py
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --script /tmp/old.py --repeat 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import generate_plan, render_target
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'detect_apartments.py')
+HEAVY_MODULES = ['numpy', 'cv2', 'fitz', 'pytesseract']
+
+
+def paths(workdir):
+    """(name, arguments) of every execution path, with their inputs written to workdir"""
+    plan = os.path.join(workdir, 'plan.pdf')
+    generate_plan(plan, 12)
+    image = os.path.join(workdir, 'plan.png')
+    render_target(plan, image, dpi=100, warp=0.0)
+    target = os.path.join(workdir, 'target.png')
+    render_target(plan, target, dpi=100)
+    unlabelled = os.path.join(workdir, 'unlabelled.pdf')
+    generate_plan(unlabelled, 12, label_format='')
+    jobs = os.path.join(workdir, 'jobs')
+    os.makedirs(jobs)
+    return [
+        ('check-deps', ['--check-deps']),
+        ('health', ['--health', '--socket', os.path.join(workdir, 'missing.sock')]),
+        ('job-status', ['--jobs-dir', jobs, '--job-status', 'missing']),
+        ('image --no-ocr', ['--source', image, '--no-ocr']),
+        ('pdf --no-ocr', ['--source', plan, '--no-ocr']),
+        ('pdf', ['--source', plan]),
+        ('pdf + target', ['--source', plan, '--target', target]),
+        ('pdf, OCR', ['--source', unlabelled]),
+    ]
+
+
+def wall_ms(script, arguments, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def import_profile(script, arguments):
+    """(ms spent in top-level imports, HEAVY_MODULES imported) of one run"""
+    process = subprocess.run([sys.executable, '-X', 'importtime', script] + arguments,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    total_us, loaded = 0, set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            total_us += int(cumulative)
+        if name.strip() in HEAVY_MODULES:
+            loaded.add(name.strip())
+    return total_us / 1000, [m for m in HEAVY_MODULES if m in loaded]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--script', action='append', help='Script to measure; may be repeated (default: this tree)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per path (best is reported)')
+    args = parser.parse_args()
+
+    scripts = args.script or [SCRIPT]
+    with tempfile.TemporaryDirectory() as workdir:
+        cases = paths(workdir)
+        print(f"{'script':<24} {'path':<16} {'wall ms':>8} {'import ms':>10}  modules")
+        for script in scripts:
+            for name, arguments in cases:
+                ms = wall_ms(script, arguments, args.repeat)
+                import_ms, loaded = import_profile(script, arguments)
+                label = os.path.basename(script)[:24]
+                print(f"{label:<24} {name:<16} {ms:>8.1f} {import_ms:>10.1f}  {', '.join(loaded) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Synthetic floor plans with known ground truth, for benchmarks.
+
+generate_plan() writes a PDF in the shape detect_apartments.py expects: red
+unit outlines, a word label per unit ("bina 12" by default) plus area and
+room-name distractors, and optional grey clutter (furniture, hatching, stray
+dimension strings). render_target() rasterizes it to a perspective-warped
+"marketing render" with the red outlines toned down, the way our target
+images look. Both return the ground truth needed to score a detection.
+
+Unit outlines must stay between 0.5% and 20% of the page area to survive the
+region filter of flood_fill_apartments(), so about 100 units fit on a page
+(fewer with a larger `irregular`). Beyond about 12 columns labels of one row
+can no longer all get their own text line.
+
+    python benchmarks/synthetic.py plan.pdf --units 40 --noise 0.5 --target plan.png
+"""
+import argparse
+import json
+import os
+import sys
+
+import cv2
+import fitz
+import numpy as np
+
+ROOM_NAMES = ['Living', 'Kitchen', 'Bedroom', 'Bath', 'WC', 'Hall', 'Balcony', 'Storage']
+
+
+def split_lengths(total, parts, rng, jitter):
+    """`parts` positive lengths summing to total, each varied by up to +-jitter"""
+    weights = 1 + rng.uniform(-jitter, jitter, parts)
+    lengths = total * weights / weights.sum()
+    return np.concatenate([[0], np.cumsum(lengths)])
+
+
+def generate_plan(path, units=24, page_size=(1190, 842), label_format='bina {n}', noise=0.0,
+                  irregular=0.2, line_width=2.0, seed=0, pages=1, first_number=1):
+    """
+    Write a synthetic plan PDF and return its ground truth
+
+    units red-outlined apartments are laid out on an irregular grid (column and
+    row sizes vary by +-irregular) inside a 50pt margin; cells beyond `units`
+    stay empty. noise (0-1) scales the amount of grey clutter. Each page numbers
+    its units from first_number + page * 100.
+
+    Returns {'page_size': [w, h], 'pages': [[{'number', 'polygon'}, ...], ...]}
+    with polygons in PDF points.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = page_size
+    margin = 50
+    aspect = (width - 2 * margin) / (height - 2 * margin)
+    cols = max(1, int(np.ceil(np.sqrt(units * aspect))))
+    rows = max(1, int(np.ceil(units / cols)))
+
+    doc = fitz.open()
+    truth = {'page_size': [width, height], 'pages': []}
+    for page_index in range(pages):
+        page = doc.new_page(width=width, height=height)
+        xs = margin + split_lengths(width - 2 * margin, cols, rng, irregular)
+        ys = margin + split_lengths(height - 2 * margin, rows, rng, irregular)
+        page_truth = []
+
+        # Clutter first so labels and outlines are drawn over it
+        for _ in range(int(noise * units * 6)):
+            x, y = rng.uniform(margin, width - margin), rng.uniform(margin, height - margin)
+            kind = rng.integers(3)
+            if kind == 0:
+                w, h = rng.uniform(6, 30, 2)
+                page.draw_rect(fitz.Rect(x, y, x + w, y + h), color=(0.45, 0.45, 0.45), width=0.6)
+            elif kind == 1:
+                angle = rng.uniform(0, np.pi)
+                length = rng.uniform(5, 25)
+                page.draw_line((x, y), (x + length * np.cos(angle), y + length * np.sin(angle)),
+                               color=(0.55, 0.55, 0.55), width=0.4)
+            else:
+                page.insert_text((x, y), f"{rng.uniform(0.8, 9.9):.2f}", fontsize=5, color=(0.4, 0.4, 0.4))
+
+        for index in range(units):
+            r, c = divmod(index, cols)
+            x0, x1, y0, y1 = xs[c], xs[c + 1], ys[r], ys[r + 1]
+            page.draw_rect(fitz.Rect(x0, y0, x1, y1), color=(1, 0, 0), width=line_width)
+
+            number = first_number + page_index * 100 + index
+            cell_w, cell_h = x1 - x0, y1 - y0
+            # get_pdf_text_data() joins words of equal height into one text
+            # line, so every column of a row gets its own label height; dense
+            # grids shrink the font to make room
+            band = cell_h * 0.55
+            fontsize = float(np.clip(min(cell_w / 9, band / ((cols + 1) * 1.4)), 3, 12))
+            levels = max(1, int(band / (fontsize * 1.4)))
+            label_y = y0 + cell_h * 0.15 + fontsize + (c % levels) * fontsize * 1.4
+            page.insert_text((x0 + cell_w * 0.2, label_y), label_format.format(n=number), fontsize=fontsize)
+            page.insert_text((x0 + cell_w * 0.2, y0 + cell_h * 0.8), f"{rng.uniform(30, 140):.1f} m2",
+                             fontsize=fontsize * 0.75)
+            if noise:
+                page.insert_text((x0 + cell_w * 0.55, y0 + cell_h * 0.6), str(rng.choice(ROOM_NAMES)),
+                                 fontsize=fontsize * 0.6, color=(0.3, 0.3, 0.3))
+
+            page_truth.append({
+                'number': str(number),
+                'polygon': [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+            })
+
+        page.insert_text((width - 250, height - 20), "Title block 1:100", fontsize=8)
+        truth['pages'].append(page_truth)
+
+    doc.save(path)
+    doc.close()
+    return truth
+
+
+def render_target(pdf_path, out_path, dpi=100, warp=0.03, noise=0.0, seed=0, page_number=0):
+    """
+    Render one page as a perspective-warped target image
+
+    Corners move by up to `warp` of the image size; noise (0-1) adds Gaussian
+    pixel noise. Red outlines are turned dark grey so the target does not look
+    like a plan to the red-line detector.
+
+    Returns the 3x3 homography from source pixels at `dpi` to target pixels.
+    """
+    rng = np.random.default_rng(seed)
+    with fitz.open(pdf_path) as doc:
+        pix = doc[page_number].get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+        img = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, pix.n)[:, :, 2::-1].copy()
+
+    red = (img[:, :, 2] > 150) & (img[:, :, 1] < 120) & (img[:, :, 0] < 120)
+    img[red] = (60, 60, 60)
+
+    h, w = img.shape[:2]
+    corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    offsets = rng.uniform(-warp, warp, (4, 2)) * [w, h]
+    H = cv2.getPerspectiveTransform(corners, (corners + offsets).astype(np.float32))
+    target = cv2.warpPerspective(img, H, (w, h), borderValue=(255, 255, 255))
+    if noise:
+        target = np.clip(target + rng.normal(0, 25 * noise, target.shape), 0, 255).astype(np.uint8)
+    cv2.imwrite(out_path, target)
+    return H
+
+
+def truth_in_pixels(truth, page_index, dpi):
+    """Ground-truth units of a page with polygons in source pixels at `dpi`"""
+    scale = dpi / 72
+    return [
+        {'number': unit['number'], 'polygon': (np.array(unit['polygon']) * scale).tolist()}
+        for unit in truth['pages'][page_index]
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='PDF to write')
+    parser.add_argument('--units', type=int, default=24)
+    parser.add_argument('--pages', type=int, default=1)
+    parser.add_argument('--page-size', default='1190x842', help='Page size in points, WxH')
+    parser.add_argument('--label', default='bina {n}', help='Label format, {n} is the unit number')
+    parser.add_argument('--noise', type=float, default=0.0, help='Clutter amount, 0-1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--target', help='Also write a warped target image of page 1 here')
+    parser.add_argument('--dpi', type=int, default=100, help='Target render resolution')
+    args = parser.parse_args()
+
+    width, height = (float(v) for v in args.page_size.lower().split('x'))
+    truth = generate_plan(args.output, args.units, (width, height), args.label, args.noise,
+                          seed=args.seed, pages=args.pages)
+    if args.target:
+        truth['target_homography'] = render_target(args.output, args.target, args.dpi, seed=args.seed).tolist()
+        truth['target_dpi'] = args.dpi
+    with open(os.path.splitext(args.output)[0] + '.truth.json', 'w') as f:
+        json.dump(truth, f, indent=1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
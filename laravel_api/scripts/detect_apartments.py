@@ -1,58 +1,272 @@
 import sys
 import json
+import argparse
+import itertools
+import os
+import re
+import time
+import shutil
+import threading
+from contextlib import contextmanager
 
-# Wrap imports to catch missing dependencies
-try:
-    import cv2
-    import numpy as np
-    import argparse
-    import os
-    import re
-    import time
-    import shutil
-
-    # Use PyMuPDF (fitz) instead of pdf2image
+# Third-party modules are imported when a stage first needs them, so paths
+# that never touch an image (--health, --job-status, --check-deps) start
+# without loading OpenCV, and a missing package is reported by name.
+# module: (alias in this file, pip packages providing it, what needs it)
+DEPENDENCIES = {
+    'numpy': ('np', ['numpy'], 'detection'),
+    'cv2': ('cv2', ['opencv-python-headless', 'opencv-python', 'opencv-contrib-python-headless',
+                    'opencv-contrib-python'], 'detection'),
+    'fitz': ('fitz', ['PyMuPDF', 'pymupdf'], 'PDF sources'),
+    'pytesseract': ('pytesseract', ['pytesseract'], 'OCR of unlabelled apartments'),
+}
+
+class MissingDependency(ImportError):
+    """A third-party module from DEPENDENCIES could not be imported"""
+
+    def __init__(self, module, error=None):
+        self.package = DEPENDENCIES[module][1][0]
+        message = f"{self.package} is required for {DEPENDENCIES[module][2]} but '{module}' could not be imported"
+        if error is not None:
+            message += f" ({error})"
+        super().__init__(f"{message}. Install it with: pip install {self.package}", name=module)
+
+def require(module):
+    """Import a DEPENDENCIES module, raising MissingDependency when it is not installed"""
+    try:
+        # __import__ rather than importlib, so `python -X importtime` lists it
+        return __import__(module)
+    except ImportError as e:
+        raise MissingDependency(module, e) from e
+
+class LazyModule:
+    """
+    Module-level stand-in for a DEPENDENCIES module
+
+    The first attribute access imports the module and rebinds the global to
+    it, so later lookups cost nothing extra. Modules are imported up front
+    with load_dependencies() where a path is known to need them.
+    """
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, attr):
+        return getattr(_load_lazy(self._module), attr)
+
+def _load_lazy(module):
+    loaded = require(module)
+    globals()[DEPENDENCIES[module][0]] = loaded
+    return loaded
+
+def load_dependencies(*modules):
+    """Import these DEPENDENCIES modules now (MissingDependency if one is not installed)"""
+    for module in modules:
+        if isinstance(globals()[DEPENDENCIES[module][0]], LazyModule):
+            _load_lazy(module)
+
+np = LazyModule('numpy')
+cv2 = LazyModule('cv2')
+fitz = LazyModule('fitz')
+
+def read_peak_rss():
+    """
+    Peak resident set size of this process in MB, None if unavailable
+
+    Linux reports the high-water mark since the last reset_peak_rss(), other
+    platforms the peak over the process lifetime.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
     try:
-        import fitz  # PyMuPDF
+        import resource
     except ImportError:
-        fitz = None
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
 
-except ImportError as e:
-    # Print valid JSON error so the PHP controller can display it nicely
-    error_msg = {
-        "success": False,
-        "error": f"Python dependency missing: {str(e)}. Please install requirements (opencv-python-headless, numpy, pymupdf)."
-    }
-    print(json.dumps(error_msg), flush=True) # Force flush
-    sys.exit(0) # Exit success so PHP parses the JSON response
+def read_rss():
+    """Current resident set size of this process in MB (the peak where that is unavailable)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return read_peak_rss()
 
-# Debug: Print to stderr to confirm we passed imports
-sys.stderr.write("DEBUG: Imports successful, starting processing...\n")
-sys.stderr.flush()
+def reset_peak_rss():
+    """Restart the peak RSS high-water mark (Linux only), True if it was reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
 
-def pdf_to_image(pdf_path, dpi=100):
-    """Convert first page of PDF to image array using PyMuPDF
-    
-    Note: Lower DPI (100) is used for shared hosting memory limits.
-    Increase to 150 for better quality if memory allows.
+def read_child_cpu():
+    """CPU seconds used by finished child processes (e.g. Tesseract)"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Timings:
     """
-    if fitz is None:
-        pass # Optional dependency
+    Wall-clock milliseconds per pipeline stage, reported in the result's `timings`
 
-    
-    doc = fitz.open(pdf_path)
-    if len(doc) == 0:
-        doc.close()
-        raise ValueError("PDF has no pages")
-    
-    page = doc[0]
-    # Calculate zoom factor for desired DPI (PDF default is 72 DPI)
-    zoom = dpi / 72
-    mat = fitz.Matrix(zoom, zoom)
-    
-    # Render page to pixmap
-    pix = page.get_pixmap(matrix=mat)
-    
+    With profile=True every stage instead reports a dict of wall_ms, cpu_ms
+    (all threads of this process), child_cpu_ms (Tesseract and other
+    subprocesses) and peak_rss_mb, the highest resident memory seen while the
+    stage ran. on_stage(name) is called whenever a stage starts, e.g. to report
+    job progress.
+    """
+
+    def __init__(self, profile=False, on_stage=None):
+        self.profile = profile
+        self.on_stage = on_stage
+        self.stages = {}
+        self.reports = {}
+        # Open profiled stages, innermost last: [peak RSS of finished children]
+        self._open = []
+        # Peak RSS seen outside any stage, before its high-water mark was reset
+        self._outside_peak = 0
+
+    @contextmanager
+    def stage(self, name):
+        if self.on_stage is not None:
+            self.on_stage(name)
+        if self.profile:
+            with self._profiled(name):
+                yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    @contextmanager
+    def _profiled(self, name):
+        # The high-water mark is reset per stage; an enclosing stage keeps
+        # the largest peak of the stages nested in it
+        if self._open:
+            self._open[-1][0] = max(self._open[-1][0], read_peak_rss() or 0)
+        else:
+            self._outside_peak = max(self._outside_peak, read_peak_rss() or 0)
+        reset_peak_rss()
+        self._open.append([0])
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        child_start = read_child_cpu()
+        try:
+            yield
+        finally:
+            wall_ms = (time.perf_counter() - start) * 1000
+            cpu_ms = (time.process_time() - cpu_start) * 1000
+            child_ms = (read_child_cpu() - child_start) * 1000
+            peak = max(self._open.pop()[0], read_peak_rss() or 0)
+            if self._open:
+                self._open[-1][0] = max(self._open[-1][0], peak)
+            self.add(name, wall_ms, cpu_ms=cpu_ms, child_cpu_ms=child_ms, peak_rss_mb=peak or None)
+
+    def mark(self):
+        """Starting point for add_since()"""
+        return time.perf_counter(), time.process_time(), read_child_cpu() if self.profile else 0.0
+
+    def add_since(self, name, mark):
+        """Record a span that started at mark() but is not a single `with` block"""
+        start, cpu_start, child_start = mark
+        ms = (time.perf_counter() - start) * 1000
+        if not self.profile:
+            self.add(name, ms)
+            return
+        peaks = [entry.get('peak_rss_mb', 0) for entry in self.stages.values()]
+        peak = max(peaks + [self._outside_peak, read_peak_rss() or 0])
+        self.add(name, ms,
+                 cpu_ms=(time.process_time() - cpu_start) * 1000,
+                 child_cpu_ms=(read_child_cpu() - child_start) * 1000,
+                 peak_rss_mb=peak or None)
+
+    def add(self, name, ms, cpu_ms=None, child_cpu_ms=None, peak_rss_mb=None):
+        if not self.profile:
+            self.stages[name] = round(self.stages.get(name, 0) + ms, 2)
+            return
+        entry = self.stages.setdefault(name, {'wall_ms': 0})
+        entry['wall_ms'] = round(entry['wall_ms'] + ms, 2)
+        if cpu_ms is not None:
+            entry['cpu_ms'] = round(entry.get('cpu_ms', 0) + cpu_ms, 2)
+            entry['child_cpu_ms'] = round(entry.get('child_cpu_ms', 0) + child_cpu_ms, 2)
+        if peak_rss_mb is not None:
+            entry['peak_rss_mb'] = round(max(entry.get('peak_rss_mb', 0), peak_rss_mb), 1)
+
+    def report(self, key, value):
+        """Attach a non-timing diagnostic, emitted as a top-level result key"""
+        self.reports[key] = value
+
+    def to_dict(self):
+        return {name: dict(value) if isinstance(value, dict) else value for name, value in self.stages.items()}
+
+class PdfSession:
+    """
+    One parsed PDF shared by rendering, text extraction and page geometry
+
+    Opening and parsing a large architectural PDF is not free, so every consumer
+    of a document goes through a single handle. Accepts a path or an already open
+    fitz.Document (which is then left open on close()).
+    """
+
+    def __init__(self, pdf, timings=None):
+        self.timings = timings if timings is not None else Timings()
+        self.uses = 0
+        start = time.perf_counter()
+        if isinstance(pdf, str):
+            self.doc, self.owned = fitz.open(pdf), True
+        else:
+            self.doc, self.owned = pdf, False
+        self.open_ms = (time.perf_counter() - start) * 1000
+        if self.owned:
+            self.timings.add('pdf_open', self.open_ms)
+        self._pages = {}
+
+    def __len__(self):
+        return len(self.doc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def page(self, page_number=0):
+        """Return the (cached) PdfPage for a 0-based page number"""
+        if len(self.doc) == 0:
+            raise ValueError("PDF has no pages")
+        if not 0 <= page_number < len(self.doc):
+            raise ValueError(f"PDF has no page {page_number + 1}")
+        if page_number not in self._pages:
+            self._pages[page_number] = PdfPage(self, page_number)
+        return self._pages[page_number]
+
+    def close(self):
+        # Every access after the first would have been a separate fitz.open() before
+        if self.owned and self.uses > 1:
+            self.timings.add('pdf_open_saved', self.open_ms * (self.uses - 1))
+        self._pages = {}
+        if self.owned:
+            self.doc.close()
+
+def pixmap_to_bgr(pix):
+    """Copy a fitz.Pixmap into an OpenCV BGR array"""
     # Get dimensions before converting
     height, width, n_channels = pix.height, pix.width, pix.n
     
@@ -72,151 +286,599 @@ def pdf_to_image(pdf_path, dpi=100):
         del img_data
     else:
         img_bgr = img_data
-    
-    doc.close()
     return img_bgr
 
-def get_pdf_text_data(pdf_path, image_w, image_h):
+class PageRaster:
+    """
+    Stand-in for a full-page BGR array that renders only the slices asked for
+
+    Supports .shape and image[y0:y1, x0:x1], which is all the OCR cropping needs,
+    so tiled high-DPI runs never hold the whole page raster.
+    """
+
+    def __init__(self, page, dpi):
+        self.page = page
+        self.dpi = dpi
+        width, height = page.pixel_size(dpi)
+        self.shape = (height, width, 3)
+
+    def __getitem__(self, key):
+        rows, cols = key[0], key[1]
+        height, width = self.shape[:2]
+        y0, y1, _ = rows.indices(height)
+        x0, x1, _ = cols.indices(width)
+        if y1 <= y0 or x1 <= x0:
+            return np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), np.uint8)
+        crop, (left, top) = self.page.render_clip(self.dpi, x0, y0, x1, y1)
+        # Trim any rounding overhang of the clip rectangle
+        return crop[y0 - top:y1 - top, x0 - left:x1 - left]
+
+class PdfPage:
+    """A single page of a PdfSession: raster, words and geometry from one handle"""
+
+    def __init__(self, session, page_number):
+        self.session = session
+        self.page_number = page_number
+        self.page = session.doc[page_number]
+        self.rect = self.page.rect
+        self.width = self.rect.width
+        self.height = self.rect.height
+        self._rasters = {}
+        self._words = None
+
+    def render(self, dpi=100):
+        """Render the page to a BGR array (cached per DPI)"""
+        if dpi in self._rasters:
+            return self._rasters[dpi]
+        self.session.uses += 1
+
+        with self.session.timings.stage('render'):
+            # Calculate zoom factor for desired DPI (PDF default is 72 DPI)
+            zoom = dpi / 72
+            mat = fitz.Matrix(zoom, zoom)
+            
+            # Render page to pixmap
+            img_bgr = pixmap_to_bgr(self.page.get_pixmap(matrix=mat))
+
+        self._rasters[dpi] = img_bgr
+        return img_bgr
+
+    def pixel_size(self, dpi):
+        """(width, height) of a full-page render at dpi, without rendering it"""
+        zoom = dpi / 72
+        irect = (self.rect * fitz.Matrix(zoom, zoom)).irect
+        return irect.width, irect.height
+
+    def render_clip(self, dpi, x0, y0, x1, y1):
+        """
+        Render only the pixel box [x0:x1, y0:y1] of the page at dpi
+
+        Returns (bgr, (left, top)), the array and its position in full-page pixel
+        coordinates; MuPDF renders clipped pixels identical to a full render.
+        """
+        zoom = dpi / 72
+        mat = fitz.Matrix(zoom, zoom)
+        origin = (self.rect * mat).irect
+        clip = fitz.Rect(
+            self.rect.x0 + x0 / zoom, self.rect.y0 + y0 / zoom,
+            self.rect.x0 + x1 / zoom, self.rect.y0 + y1 / zoom
+        )
+        pix = self.page.get_pixmap(matrix=mat, clip=clip)
+        left, top = pix.x - origin.x0, pix.y - origin.y0
+        return pixmap_to_bgr(pix), (left, top)
+
+    def words(self, clip=None):
+        """
+        Words as (x0, y0, x1, y1, "word", block_no, line_no, word_no) tuples in PDF points
+
+        With a clip rectangle (PDF points) only characters overlapping it are
+        read, so words crossing its edge come back truncated; clipped lists are
+        not cached.
+        """
+        if clip is not None:
+            self.session.uses += 1
+            with self.session.timings.stage('text_extract'):
+                return self.page.get_text("words", clip=clip)
+        if self._words is None:
+            self.session.uses += 1
+            with self.session.timings.stage('text_extract'):
+                self._words = self.page.get_text("words")
+        return self._words
+
+# Bump when a stage's algorithm changes so stale cache entries are never reused
+CACHE_VERSION = 2
+
+def pack_masks(masks):
+    """Binary (0/255) masks of any shapes as (bits, shapes), bit-packed back to back"""
+    shapes = np.array([mask.shape for mask in masks], np.int64).reshape(-1, 2)
+    if not masks:
+        return np.zeros(0, np.uint8), shapes
+    return np.packbits(np.concatenate([mask.ravel() for mask in masks]) > 0), shapes
+
+def unpack_masks(bits, shapes):
+    """The masks pack_masks() was given"""
+    sizes = shapes[:, 0] * shapes[:, 1]
+    flat = np.unpackbits(bits, count=int(sizes.sum())) * np.uint8(255)
+    return [mask.reshape(shape) for mask, shape in zip(np.split(flat, np.cumsum(sizes)[:-1]), shapes.tolist())]
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file's bytes"""
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DetectionCache:
+    """
+    On-disk cache of intermediate detection products
+
+    Entries are keyed by a hash of the source bytes plus the parameters of every
+    stage that produced them, so a repeated upload (or one that only changes the
+    target) skips each stage it has already computed. Each product is its own
+    file; reads refresh the file's mtime and evict() drops the least recently
+    used files once the directory grows past max_bytes.
+    """
+
+    def __init__(self, root, max_bytes=256 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = []
+        self.misses = []
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Stable key for a stage from its inputs' keys and parameters"""
+        import hashlib
+
+        payload = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def _path(self, key, name, ext):
+        return os.path.join(self.root, f"{key}.{name}.{ext}")
+
+    def _read(self, key, name, ext, loader):
+        path = self._path(key, name, ext)
+        try:
+            value = loader(path)
+        except (OSError, ValueError, KeyError, EOFError):
+            # Missing, evicted by another process, or truncated
+            self.misses.append(name)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits.append(name)
+        return value
+
+    def _write(self, key, name, ext, writer, to_path=False):
+        """Atomically store an entry; writer gets an open file, or the temp path with to_path"""
+        path = self._path(key, name, ext)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            if to_path:
+                writer(tmp)
+            else:
+                with open(tmp, 'wb') as f:
+                    writer(f)
+            os.replace(tmp, path)
+        except OSError as e:
+            sys.stderr.write(f"Cache write failed for {name}: {e}\n")
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def load_array(self, key, name):
+        return self._read(key, name, 'npy', lambda path: np.load(path, allow_pickle=False))
+
+    def save_array(self, key, name, array):
+        self._write(key, name, 'npy', lambda f: np.save(f, array, allow_pickle=False))
+
+    def load_mask(self, key, name):
+        """Binary (0/255) masks are stored bit-packed"""
+        def loader(path):
+            with np.load(path, allow_pickle=False) as data:
+                bits, shape = data['bits'], tuple(data['shape'])
+            return np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape) * np.uint8(255)
+        return self._read(key, name, 'npz', loader)
+
+    def save_mask(self, key, name, mask):
+        self._write(key, name, 'npz', lambda f: np.savez(
+            f, bits=np.packbits(mask > 0), shape=np.array(mask.shape)))
+
+    def load_masks(self, key, name):
+        """Lists of binary masks (e.g. region crops) are stored like save_mask()"""
+        def loader(path):
+            with np.load(path, allow_pickle=False) as data:
+                return unpack_masks(data['bits'], data['shapes'])
+        return self._read(key, name, 'npz', loader)
+
+    def save_masks(self, key, name, masks):
+        bits, shapes = pack_masks(masks)
+        self._write(key, name, 'npz', lambda f: np.savez(f, bits=bits, shapes=shapes))
+
+    def load_json(self, key, name):
+        def loader(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return self._read(key, name, 'json', loader)
+
+    def save_json(self, key, name, value):
+        self._write(key, name, 'json', lambda f: f.write(json.dumps(value).encode('utf-8')))
+
+    def load_features(self, key, name):
+        """Keypoints + descriptors saved by save_features()"""
+        def loader(path):
+            with np.load(path, allow_pickle=False) as data:
+                return array_to_keypoints(data['keypoints']), (data['descriptors'] if data['descriptors'].size else None)
+        return self._read(key, name, 'npz', loader)
+
+    def save_features(self, key, name, features):
+        keypoints, descriptors = features
+        if descriptors is None:
+            descriptors = np.zeros((0, 0), np.float32)
+        self._write(key, name, 'npz', lambda f: np.savez(
+            f, keypoints=keypoints_to_array(keypoints), descriptors=descriptors))
+
+    def load_flann_index(self, key, name, descriptors, backend):
+        """FLANN index saved by save_flann_index(), bound to the descriptors it was built on"""
+        def loader(path):
+            if not os.path.exists(path):
+                raise OSError(path)
+            index = cv2.flann_Index()
+            if not index.load(descriptors, path):
+                raise ValueError(path)
+            return index
+        return self._read(key, name, 'flann', loader)
+
+    def save_flann_index(self, key, name, index):
+        self._write(key, name, 'flann', index.save, to_path=True)
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+    def for_request(self):
+        """Same store with fresh hit/miss counters, one per detection"""
+        return DetectionCache(self.root, self.max_bytes)
+
+    def stats(self):
+        return {'hits': list(self.hits), 'misses': list(self.misses)}
+
+def pdf_to_image(pdf_path, dpi=100, page_number=0):
+    """Convert one page (first by default) of PDF to image array using PyMuPDF
+    
+    Note: Lower DPI (100) is used for shared hosting memory limits.
+    Increase to 150 for better quality if memory allows.
+
+    pdf_path may also be an open fitz.Document, which is left open.
+    """
+    with PdfSession(pdf_path) as session:
+        return session.page(page_number).render(dpi)
+
+# Words that introduce an apartment number ("bina 12") and that mark a line
+# as an area value ("54.2 m2"); override with --label-prefixes / --area-suffixes
+DEFAULT_LABEL_PREFIXES = ('bina', 'apt', 'apartment', 'ბინა')
+DEFAULT_AREA_SUFFIXES = ('m2', 'მ2', 'sq', 'sqm')
+
+class LabelVocabulary:
+    """
+    Compiled apartment-number patterns for PDF text and OCR output
+
+    A number is either introduced by one of `prefixes` (case-insensitive,
+    anywhere in a line) or stands alone on a line that mentions none of
+    `area_suffixes`.
+    """
+
+    def __init__(self, prefixes=DEFAULT_LABEL_PREFIXES, area_suffixes=DEFAULT_AREA_SUFFIXES):
+        self.prefixes = tuple(prefixes)
+        self.area_suffixes = tuple(area_suffixes)
+        prefix = '|'.join(re.escape(p) for p in self.prefixes)
+        number = r'(\d+[-\w]*)'
+        self.labelled = re.compile(rf'(?:{prefix})\s*{number}', re.IGNORECASE)
+        # Same, but never across a line break of a page's joined text
+        self.labelled_in_line = re.compile(rf'(?:{prefix})[^\S\n]*{number}', re.IGNORECASE)
+        self.area = re.compile('|'.join(re.escape(s) for s in self.area_suffixes), re.IGNORECASE)
+        self.bare = re.compile(number)
+        self.bare_lines = re.compile(rf'^{number}$', re.MULTILINE)
+
+    @property
+    def key(self):
+        """Stable identity for cache keys"""
+        return '|'.join(self.prefixes) + '/' + '|'.join(self.area_suffixes)
+
+    def parse_text(self, text):
+        """Apartment number from free text, e.g. OCR output ("bina X", or a bare number line), or None"""
+        match = self.labelled.search(text)
+        if match:
+            return match.group(1)
+
+        # Look for single number on lines without an area suffix
+        for line in text.split('\n'):
+            if self.area.search(line):
+                continue
+            match = self.bare.fullmatch(line.strip())
+            if match:
+                return match.group(1)
+        return None
+
+    def parse_lines(self, text, line_starts):
+        """
+        Numbers of a page whose lines are joined by newlines into `text`
+
+        line_starts are the character offsets of the lines. Returns
+        [(line index, number)] in line order: the first labelled number of a
+        line wins, otherwise a line that is only a number counts when it
+        mentions no area suffix. One regex pass per pattern over the whole page.
+        """
+        found = {}
+        for match in self.labelled_in_line.finditer(text):
+            line = int(np.searchsorted(line_starts, match.start(), side='right')) - 1
+            found.setdefault(line, match.group(1))
+
+        for match in self.bare_lines.finditer(text):
+            number = match.group(1)
+            if self.area.search(number) or '.' in number:
+                continue
+            line = int(np.searchsorted(line_starts, match.start(), side='right')) - 1
+            found.setdefault(line, number)
+
+        return sorted(found.items())
+
+DEFAULT_VOCABULARY = LabelVocabulary()
+
+_vocabularies = {}
+
+def get_vocabulary(prefixes=None, area_suffixes=None):
+    """LabelVocabulary for the given words (defaults when None), compiled once per process"""
+    key = (tuple(prefixes or DEFAULT_LABEL_PREFIXES), tuple(area_suffixes or DEFAULT_AREA_SUFFIXES))
+    if key == (DEFAULT_LABEL_PREFIXES, DEFAULT_AREA_SUFFIXES):
+        return DEFAULT_VOCABULARY
+    if key not in _vocabularies:
+        _vocabularies[key] = LabelVocabulary(*key)
+    return _vocabularies[key]
+
+# Word geometry of a page, PDF points plus the centre in image pixels
+# Structured dtype of word arrays, as a field list (NumPy takes it wherever a
+# dtype goes) so it is not built at import
+WORD_DTYPE = [('x0', 'f8'), ('y0', 'f8'), ('x1', 'f8'), ('y1', 'f8'), ('cx', 'f8'), ('cy', 'f8')]
+
+def group_word_lines(words, max_gap=None):
+    """
+    Start index of every text line in reading-order sorted WORD_DTYPE words
+
+    A word continues the line of the word before it unless it starts more than
+    10pt left of that word's end (a wrap) or overlaps it vertically by no more
+    than half the smaller height. With max_gap (points) a word starting more
+    than that right of the previous word's end starts a new line too.
+    """
+    if len(words) == 0:
+        return np.zeros(0, np.int64)
+    prev, cur = words[:-1], words[1:]
+    wrapped = cur['x0'] < prev['x1'] - 10
+    y_overlap = np.minimum(prev['y1'], cur['y1']) - np.maximum(prev['y0'], cur['y0'])
+    height = np.minimum(prev['y1'] - prev['y0'], cur['y1'] - cur['y0'])
+    breaks = wrapped | ~(y_overlap > height * 0.5)
+    if max_gap is not None:
+        breaks |= cur['x0'] - prev['x1'] > max_gap
+    return np.concatenate([[0], np.flatnonzero(breaks) + 1])
+
+# Extra PDF points read around a text clip, so words whose centre is inside
+# it are never cut off at the clip edge
+TEXT_CLIP_SLACK = 20
+# Every clip costs MuPDF a pass over the page content; beyond this many
+# groups one clip around all of them is cheaper
+TEXT_CLIP_MAX_GROUPS = 4
+
+def text_clip_boxes(polygons, scale_x, scale_y, margin=100):
+    """
+    Boxes (x0, y0, x1, y1 in PDF points) around polygons in image pixels
+
+    Each polygon's bounding box is expanded by `margin` pixels, the distance
+    within which match_numbers_to_polygons() pairs a label with a polygon.
+    """
+    boxes = np.zeros((len(polygons), 4))
+    for i, polygon in enumerate(polygons):
+        pts = np.asarray(polygon, dtype=np.float64)
+        boxes[i, :2] = pts.min(axis=0) - margin
+        boxes[i, 2:] = pts.max(axis=0) + margin
+    return boxes / [scale_x, scale_y, scale_x, scale_y]
+
+def text_clip_groups(boxes, max_groups=TEXT_CLIP_MAX_GROUPS):
+    """
+    Clip rectangles (x0, y0, x1, y1 in PDF points) covering `boxes`
+
+    Boxes grown by TEXT_CLIP_SLACK are merged into the bounding rectangle of
+    every group of overlapping ones, repeated until no two rectangles
+    overlap, so separate blocks of units get separate clips and the sheet
+    between them is not read. With more than max_groups groups the bounding
+    rectangle of all boxes is returned instead.
+    """
+    rects = [list(box) for box in (boxes + [-TEXT_CLIP_SLACK, -TEXT_CLIP_SLACK, TEXT_CLIP_SLACK, TEXT_CLIP_SLACK])]
+    merged = True
+    while merged and len(rects) > 1:
+        merged = False
+        groups = []
+        for rect in sorted(rects):
+            for group in groups:
+                if rect[0] < group[2] and group[0] < rect[2] and rect[1] < group[3] and group[1] < rect[3]:
+                    group[:] = [min(rect[0], group[0]), min(rect[1], group[1]),
+                                max(rect[2], group[2]), max(rect[3], group[3])]
+                    merged = True
+                    break
+            else:
+                groups.append(rect)
+        rects = groups
+    if len(rects) > max_groups:
+        rects = [[min(r[0] for r in rects), min(r[1] for r in rects),
+                  max(r[2] for r in rects), max(r[3] for r in rects)]]
+    return rects
+
+def points_in_boxes(points, boxes):
+    """Mask of the (N, 2) points inside (edges included) any of the (x0, y0, x1, y1) boxes"""
+    order = np.argsort(points[:, 0], kind='stable')
+    xs = points[order, 0]
+    inside = np.zeros(len(points), bool)
+    for x0, y0, x1, y1 in boxes:
+        idx = order[np.searchsorted(xs, x0, 'left'):np.searchsorted(xs, x1, 'right')]
+        ys = points[idx, 1]
+        inside[idx[(ys >= y0) & (ys <= y1)]] = True
+    return inside
+
+def clip_words(page, boxes):
+    """
+    Words of a PdfPage whose centre lies in one of `boxes` (PDF points)
+
+    Text is read with one clip per text_clip_groups() rectangle, so MuPDF
+    only assembles words around the units; words that reach a clip's edge
+    were cut off by it and are dropped, as are words of a clip whose centre
+    is in none of the boxes.
+    """
+    if len(boxes) == 0:
+        return []
+    kept = []
+    for rect in text_clip_groups(boxes):
+        clip = fitz.Rect(*rect)
+        word_list = [w for w in page.words(clip=clip) if w[4]]
+        if not word_list:
+            continue
+        geometry = np.fromiter(itertools.chain.from_iterable(w[:4] for w in word_list), np.float64,
+                               count=4 * len(word_list)).reshape(-1, 4)
+        whole = ((geometry[:, 0] > clip.x0) & (geometry[:, 1] > clip.y0) &
+                 (geometry[:, 2] < clip.x1) & (geometry[:, 3] < clip.y1))
+        inside = points_in_boxes((geometry[:, :2] + geometry[:, 2:]) / 2, boxes)
+        kept.extend(word_list[i] for i in np.flatnonzero(whole & inside).tolist())
+    return kept
+
+def get_pdf_text_data(pdf_path, image_w, image_h, page_number=0, vocabulary=None, near_polygons=None,
+                      margin=100):
     """
     Extract text and coordinates from PDF using PyMuPDF
     Returns a list of dicts: {'text': str, 'center': (x, y)}
     mapped to image dimensions
+
+    pdf_path may also be an open fitz.Document or a PdfPage, which are left open.
+    Words are kept in a WORD_DTYPE array, grouped into lines with
+    group_word_lines() and parsed with `vocabulary` (a LabelVocabulary,
+    default DEFAULT_VOCABULARY) in one pass over the page text.
+    With near_polygons (point lists in image pixels) only words within
+    `margin` pixels of their bounding boxes are kept (see clip_words()):
+    text away from the units is either outside every clip or dropped right
+    after extraction, so legends, title blocks and dimension strings
+    elsewhere on the sheet are never parsed or matched. The dropped words
+    would let lines run on across the gaps, so lines are also broken at gaps
+    wider than `margin`.
     """
-    if fitz is None:
-        sys.stderr.write("PyMuPDF not available for text extraction\n")
+    try:
+        load_dependencies('fitz')
+    except MissingDependency as e:
+        sys.stderr.write(f"PyMuPDF not available for text extraction: {e}\n")
         return None
+    if vocabulary is None:
+        vocabulary = DEFAULT_VOCABULARY
         
+    session = None
     try:
-        doc = fitz.open(pdf_path)
-        if len(doc) == 0:
-            return None
-            
-        page = doc[0]
-        page_rect = page.rect
-        page_w = page_rect.width
-        page_h = page_rect.height
-        
-        scale_x = image_w / page_w
-        scale_y = image_h / page_h
+        if isinstance(pdf_path, PdfPage):
+            page = pdf_path
+        else:
+            session = PdfSession(pdf_path)
+            if len(session) <= page_number:
+                return None
+            page = session.page(page_number)
+
+        scale_x = image_w / page.width
+        scale_y = image_h / page.height
         
         # Extract words with positions using get_text("words")
         # Returns list of tuples: (x0, y0, x1, y1, "word", block_no, line_no, word_no)
-        word_list = page.get_text("words")
-        
-        words = []
-        for w in word_list:
-            x_min, y_min, x_max, y_max, text = w[0], w[1], w[2], w[3], w[4]
-            
-            if not text:
-                continue
-            
-            # center in image coordinates
-            cx = ((x_min + x_max) / 2) * scale_x
-            cy = ((y_min + y_max) / 2) * scale_y
-            
-            words.append({
-                'text': text,
-                'x_min': x_min,
-                'y_min': y_min,
-                'x_max': x_max,
-                'y_max': y_max,
-                'center': (cx, cy)
-            })
-        
-        doc.close()
-            
-        # Group words into lines (simple clustering by mid-y)
-        lines = []
-        # Sort by Y then X
-        words.sort(key=lambda w: (w['y_min'], w['x_min']))
-        
-        current_line = []
-        for word in words:
-            if not current_line:
-                current_line.append(word)
-                continue
-                
-            # Check overlap vertically with last word in line
-            last = current_line[-1]
-            
-            # 1. Check for Line Break (X coordinate decreasing significantly)
-            # Tolerance of 10px to account for slight jitter
-            if word['x_min'] < last['x_max'] - 10:
-                lines.append(current_line)
-                current_line = [word]
-                continue
-                
-            # 2. Check overlap (Y coordinate)
-            y_overlap = min(last['y_max'], word['y_max']) - max(last['y_min'], word['y_min'])
-            height = min(last['y_max'] - last['y_min'], word['y_max'] - word['y_min'])
-            
-            if y_overlap > height * 0.5:
-                current_line.append(word)
-            else:
-                lines.append(current_line)
-                current_line = [word]
-        if current_line:
-            lines.append(current_line)
-            
-        # Parse numbers from lines
-        numbers = []
-        import re
-        
+        if near_polygons is not None:
+            word_list = clip_words(page, text_clip_boxes(near_polygons, scale_x, scale_y, margin))
+        else:
+            word_list = [w for w in page.words() if w[4]]
+        if not word_list:
+            return []
 
-        for line in lines:
-            line_text = ' '.join(w['text'] for w in line)
-            
-            # Priority 1: "bina X", "apt X", "apartment X"
-            # We check this FIRST, ignoring "m2" presence because sometimes they are on same line
-            match = re.search(r'(?:bina|apt|apartment|ბინა)\s*(\d+[-\w]*)', line_text, re.IGNORECASE)
-            if match:
-                num = match.group(1)
-                
-                # Approximate position
-                avg_x = sum(w['center'][0] for w in line) / len(line)
-                avg_y = sum(w['center'][1] for w in line) / len(line)
-                
-                numbers.append({
-                    'number': num,
-                    'center': (avg_x, avg_y),
-                    'source': 'pdf'
-                })
-                continue
-            
-            # Skip if contains area pattern for bare numbers
-            if re.search(r'(m2|მ2|sq|sqm)', line_text, re.IGNORECASE):
-                continue
-                
-            # Priority 2: Just a number
-            match = re.search(r'^(\d+[-\w]*)$', line_text.strip())
-            if match:
-                num = match.group(1)
-                if '.' in num:
-                     continue 
-
-                avg_x = sum(w['center'][0] for w in line) / len(line)
-                avg_y = sum(w['center'][1] for w in line) / len(line)
-                numbers.append({
-                    'number': num,
-                    'center': (avg_x, avg_y),
-                    'source': 'pdf'
-                })
-        
-        return numbers
+        words = np.array([w[:4] + (0.0, 0.0) for w in word_list], dtype=WORD_DTYPE)
+        # center in image coordinates
+        words['cx'] = ((words['x0'] + words['x1']) / 2) * scale_x
+        words['cy'] = ((words['y0'] + words['y1']) / 2) * scale_y
+
+        # Sort by Y then X (stable, like a sort on (y0, x0) tuples)
+        order = np.lexsort((words['x0'], words['y0']))
+        words = words[order]
+        texts = [word_list[i][4] for i in order.tolist()]
+
+        line_starts = group_word_lines(words, margin / scale_x if near_polygons is not None else None)
+        line_ends = np.append(line_starts[1:], len(words))
+
+        # Page text with one line per text line; character offsets of the lines
+        is_start = np.zeros(len(words), bool)
+        is_start[line_starts] = True
+        separators = np.where(is_start[1:], '\n', ' ').tolist() + ['']
+        text = ''.join([t + sep for t, sep in zip(texts, separators)])
+        word_offsets = np.concatenate([[0], np.cumsum([len(t) + 1 for t in texts])[:-1]])
+        line_offsets = word_offsets[line_starts]
+
+        # Approximate position: mean word centre of the line. Summed word by
+        # word in line order (not pairwise like np.add.reduceat) so centres
+        # do not depend on how long the other lines are
+        counts = line_ends - line_starts
+        sums_x = np.zeros(len(line_starts))
+        sums_y = np.zeros(len(line_starts))
+        active = np.arange(len(line_starts))
+        for k in range(int(counts.max())):
+            active = active[counts[active] > k]
+            idx = line_starts[active] + k
+            sums_x[active] += words['cx'][idx]
+            sums_y[active] += words['cy'][idx]
+        centers_x = sums_x / counts
+        centers_y = sums_y / counts
+
+        return [{
+            'number': number,
+            'center': (float(centers_x[line]), float(centers_y[line])),
+            'source': 'pdf'
+        } for line, number in vocabulary.parse_lines(text, line_offsets)]
 
     except Exception as e:
         sys.stderr.write(f"PDF text extraction failed: {e}\n")
         return None
+    finally:
+        if session is not None:
+            session.close()
+
+# Red color range in OpenCV HSV (handles both low and high hue values for red)
+RED_HSV_RANGES = [
+    ((0, 80, 80), (10, 255, 255)),
+    ((160, 80, 80), (180, 255, 255)),
+]
 
 def detect_red_lines(image):
     """Detect red lines/marks in the image"""
     hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     
-    # Red color range (handles both low and high hue values for red)
-    lower_red1 = np.array([0, 80, 80])
-    upper_red1 = np.array([10, 255, 255])
-    lower_red2 = np.array([160, 80, 80])
-    upper_red2 = np.array([180, 255, 255])
+    (lower_red1, upper_red1), (lower_red2, upper_red2) = RED_HSV_RANGES
     
     mask1 = cv2.inRange(hsv, lower_red1, upper_red1)
     mask2 = cv2.inRange(hsv, lower_red2, upper_red2)
@@ -239,10 +901,280 @@ def clean_mask(mask, thickness=3):
     barrier = cv2.dilate(mask, kernel, iterations=1)
     return barrier
 
-def flood_fill_apartments(image, barrier_mask):
+def red_pixel_mask(image, band_rows=256):
+    """
+    Red pixels of a BGR image (the mask of detect_red_lines() before closing)
+
+    Works through the image in bands of band_rows, so the HSV copy and the
+    per-range masks only ever exist at band size; the result is written straight
+    into the full-size output.
+    """
+    height, width = image.shape[:2]
+    mask = np.empty((height, width), np.uint8)
+    band_mask = np.empty((min(band_rows, height), width), np.uint8)
+    (lower1, upper1), (lower2, upper2) = RED_HSV_RANGES
+
+    for y0 in range(0, height, band_rows):
+        y1 = min(height, y0 + band_rows)
+        hsv = cv2.cvtColor(image[y0:y1], cv2.COLOR_BGR2HSV)
+        out = mask[y0:y1]
+        cv2.inRange(hsv, lower1, upper1, dst=out)
+        cv2.inRange(hsv, lower2, upper2, dst=band_mask[:y1 - y0])
+        cv2.bitwise_or(out, band_mask[:y1 - y0], dst=out)
+    return mask
+
+def red_barrier(image, thickness=5):
+    """
+    Barrier mask of a BGR image in one pass: red_pixel_mask() dilated once
+
+    Equal to clean_mask(detect_red_lines(image), thickness) for thickness >= 3:
+    a pixel added by the 3x3 closing has red within one pixel of every 3x3
+    window around it, so its thickness x thickness neighbourhood is already
+    covered by dilating the unclosed mask.
+    """
+    if thickness < 3:
+        return clean_mask(detect_red_lines(image), thickness=thickness)
+    return clean_mask(red_pixel_mask(image), thickness=thickness)
+
+def build_barrier_tiled(page, dpi, band_height=1024, thickness=5, timings=None):
+    """
+    Barrier mask of a PDF page built band by band
+
+    The page is rendered in horizontal bands through a fitz clip rectangle; each
+    band (plus an overlap covering the dilate kernel) goes through red_barrier()
+    and only its own rows are kept. Peak memory is one band's worth of BGR
+    temporaries plus the uint8 page mask, so high DPI renders fit in a fixed
+    budget.
+    """
+    if timings is None:
+        timings = Timings()
+    width, height = page.pixel_size(dpi)
+    barrier = np.zeros((height, width), np.uint8)
+    # Covers the dilation (thickness // 2 rows) with the margin the former
+    # close + dilate pair needed, which keeps the band clip rectangles (and so
+    # the resampling of embedded raster images) unchanged
+    overlap = 2 + thickness
+
+    for y0 in range(0, height, band_height):
+        y1 = min(height, y0 + band_height)
+        with timings.stage('render'):
+            band, (left, top) = page.render_clip(dpi, 0, max(0, y0 - overlap), width, min(height, y1 + overlap))
+        with timings.stage('red_lines'):
+            band_barrier = red_barrier(band, thickness=thickness)
+        del band
+        barrier[y0:y1, left:left + band_barrier.shape[1]] = band_barrier[y0 - top:y1 - top]
+
+    return barrier
+
+# --dpi auto: resolution bounds, preview resolution, and the pixel sizes the
+# fixed pixel parameters of the pipeline (5px barrier dilation, 5px polygon
+# simplification, 4px expansion) were tuned for
+AUTO_DPI_MIN = 50
+AUTO_DPI_MAX = 200
+AUTO_DPI_PREVIEW = 50
+AUTO_DPI_STEP = 10
+MIN_STROKE_PX = 1.5
+MIN_UNIT_PX = 80
+
+def measure_red_strokes(image):
+    """
+    Typical red stroke width in pixels of a BGR image, None without red lines
+
+    Twice the median distance-to-background on the centre ridge of the red
+    mask, minus the centre pixel itself.
+    """
+    red = red_pixel_mask(image)
+    if cv2.countNonZero(red) < 20:
+        return None
+    dist = cv2.distanceTransform(red, cv2.DIST_L2, 3)
+    ridge = (dist > 0) & (dist >= cv2.dilate(dist, np.ones((3, 3), np.uint8)))
+    return max(1.0, 2 * float(np.median(dist[ridge])) - 1)
+
+def choose_dpi(page, default=100, min_dpi=AUTO_DPI_MIN, max_dpi=AUTO_DPI_MAX, ocr=False):
+    """
+    Lowest render resolution that keeps a page's barriers sealed
+
+    A AUTO_DPI_PREVIEW preview gives the unit sizes and where the red lines
+    are; the stroke width is measured on a small crop around the reddest part
+    rendered at max_dpi, since strokes are only a pixel or two wide in the
+    preview. The chosen resolution keeps red strokes at least MIN_STROKE_PX
+    wide (thinner anti-aliased strokes fade below the red threshold and leave
+    gaps) and the smaller units at least MIN_UNIT_PX across. Pages without a
+    text layer that will be OCR'd never go below `default`, the resolution the
+    OCR preprocessing was tuned for.
+
+    Returns (dpi, report) with the measurements behind the choice.
+    """
+    preview = page.render(AUTO_DPI_PREVIEW)
+    report = {'preview_dpi': AUTO_DPI_PREVIEW}
+
+    # Reddest 64x64 block of the preview, by red pixel count
+    block = 64
+    red = red_pixel_mask(preview)
+    h, w = red.shape
+    blocks = cv2.resize(red, ((w + block - 1) // block, (h + block - 1) // block), interpolation=cv2.INTER_AREA)
+    by, bx = np.unravel_index(np.argmax(blocks), blocks.shape)
+    if blocks[by, bx] == 0:
+        # Nothing red to seal; keep the configured resolution
+        report['reason'] = 'no red lines in preview'
+        return default, report
+
+    zoom = max_dpi / AUTO_DPI_PREVIEW
+    crop, _ = page.render_clip(max_dpi, int(bx * block * zoom), int(by * block * zoom),
+                               int(min(w, (bx + 1) * block) * zoom), int(min(h, (by + 1) * block) * zoom))
+    stroke_px = measure_red_strokes(crop)
+    if stroke_px is None:
+        report['reason'] = 'red lines too faint to measure'
+        return default, report
+
+    stroke_pt = stroke_px * 72 / max_dpi
+    report['stroke_pt'] = round(stroke_pt, 2)
+    needed = [min_dpi, MIN_STROKE_PX * 72 / stroke_pt]
+
+    regions = flood_fill_apartments(preview, red_barrier(preview, thickness=3))
+    if regions:
+        short_px = np.percentile([min(r['bbox'][2], r['bbox'][3]) for r in regions], 10)
+        report['unit_pt'] = round(float(short_px) * 72 / AUTO_DPI_PREVIEW, 1)
+        needed.append(MIN_UNIT_PX * AUTO_DPI_PREVIEW / short_px)
+
+    if ocr and not page.words():
+        report['reason'] = 'no text layer, OCR needs the default resolution'
+        needed.append(default)
+
+    dpi = int(np.ceil(max(needed) / AUTO_DPI_STEP) * AUTO_DPI_STEP)
+    return int(min(max_dpi, dpi)), report
+
+# --max-memory: resident bytes per pixel, measured with --profile on synthetic
+# plans (benchmarks/bench_memory.py). A full-page run holds the raster, the
+# barrier and the component labels; a tiled one the same without the raster.
+# Full registration builds the backend's scale space of the source and the
+# target in turn (ORB keeps a fixed number of keypoints, SIFT and AKAZE grow
+# with the image); the pyramid mode works on 1024px copies and patches. The
+# target is counted at its peak while decoding, once its size is known. OCR
+# holds two 3x-upscaled copies of every unlabelled region (padding included)
+# and the mosaics built from them.
+RASTER_BYTES_PER_PX = 14
+TILED_BYTES_PER_PX = 10
+REGISTRATION_BYTES_PER_PX = {'orb': 6, 'akaze': 95, 'sift': 235}
+PYRAMID_REGISTRATION_MB = {'orb': 20, 'akaze': 60, 'sift': 170}
+TARGET_BYTES_PER_PX = 4
+OCR_BYTES_PER_PX = 60
+MEMORY_TILE_HEIGHT = 512
+
+def raster_memory_mb(pixels, tiled=False):
+    """Estimated MB held from rendering through matching for a page of `pixels`"""
+    return pixels * (TILED_BYTES_PER_PX if tiled else RASTER_BYTES_PER_PX) / 2**20
+
+def registration_memory_mb(mode, backend, source_pixels, target_pixels=0):
+    """Estimated MB registration with one feature backend adds, including the decoded target"""
+    if mode == 'pyramid':
+        needed = PYRAMID_REGISTRATION_MB[backend] * 2**20
+    else:
+        needed = REGISTRATION_BYTES_PER_PX[backend] * max(source_pixels, target_pixels)
+    return (needed + TARGET_BYTES_PER_PX * target_pixels) / 2**20
+
+def ocr_memory_mb(regions, padding=20):
+    """Estimated MB the OCR fallback adds for these regions (see prepare_ocr_images())"""
+    pixels = sum((r['bbox'][2] + 2 * padding) * (r['bbox'][3] + 2 * padding) for r in regions)
+    return pixels * OCR_BYTES_PER_PX / 2**20
+
+class MemoryBudget:
+    """
+    Keeps a detection under limit_mb of resident memory by degrading it
+
+    plan_render() picks the render before anything is rendered; the
+    registration and OCR stages then compare their own estimate plus the
+    memory actually resident at that point (read_rss()) against the limit and
+    cut back when it does not fit. Every step taken is recorded in
+    `degradations` and reported as timings.reports['memory'].
+    """
+
+    def __init__(self, limit_mb):
+        self.limit_mb = limit_mb
+        self.estimated_mb = None
+        self.degradations = []
+
+    def available_mb(self):
+        return self.limit_mb - (read_rss() or 0)
+
+    def fits(self, needed_mb):
+        return needed_mb <= self.available_mb()
+
+    def degrade(self, stage, action, estimated_mb, **details):
+        self.degradations.append(dict(stage=stage, action=action, estimated_mb=round(estimated_mb), **details))
+
+    def plan_render(self, page, dpi, tile_height=None, registration=None, backend=None):
+        """
+        (dpi, tile_height, registration) of the largest render of `page` that fits
+
+        Steps down from the requested settings: build the barrier in
+        MEMORY_TILE_HEIGHT bands, register with the pyramid instead of full
+        features, then lower the resolution by AUTO_DPI_STEP down to
+        AUTO_DPI_MIN. registration is None without a target; it is estimated
+        for `backend`, the first feature backend tried. The target's own share
+        and any fallback backend are only checked at the registration stage.
+        When even the smallest render does not fit, it is used anyway.
+        """
+        baseline = read_rss() or 0
+
+        def estimate(dpi, tile_height, registration):
+            width, height = page.pixel_size(dpi)
+            needed = baseline + raster_memory_mb(width * height, bool(tile_height))
+            if registration:
+                # Tiled runs register a render of at most 100 DPI
+                reg_w, reg_h = page.pixel_size(min(dpi, 100)) if tile_height else (width, height)
+                needed += registration_memory_mb(registration, backend, reg_w * reg_h)
+            return needed
+
+        steps = [(dpi, tile_height, registration)]
+        if not tile_height:
+            tile_height = MEMORY_TILE_HEIGHT
+            steps.append((dpi, tile_height, registration))
+        if registration == 'full':
+            registration = 'pyramid'
+            steps.append((dpi, tile_height, registration))
+        steps += [(lower, tile_height, registration)
+                  for lower in range(dpi - AUTO_DPI_STEP, AUTO_DPI_MIN - 1, -AUTO_DPI_STEP)]
+
+        for step in steps:
+            self.estimated_mb = estimate(*step)
+            if self.estimated_mb <= self.limit_mb:
+                break
+
+        chosen_dpi, chosen_tile, chosen_registration = step
+        if chosen_tile != steps[0][1]:
+            self.degrade('render', 'tile', self.estimated_mb, tile_height=chosen_tile)
+        if chosen_registration != steps[0][2]:
+            self.degrade('registration', 'pyramid', self.estimated_mb)
+        if chosen_dpi != dpi:
+            self.degrade('render', 'lower_dpi', self.estimated_mb, requested_dpi=dpi, dpi=chosen_dpi)
+        self.estimated_mb = round(self.estimated_mb)
+        return step
+
+    def feature_pixels(self, backend):
+        """Largest image whose full-resolution `backend` features still fit, for pyramid refinement"""
+        return max(0, int(self.available_mb() * 2**20 / REGISTRATION_BYTES_PER_PX[backend]))
+
+    def report(self, timings):
+        peaks = [entry.get('peak_rss_mb', 0) for entry in timings.stages.values() if isinstance(entry, dict)]
+        return {
+            'limit_mb': self.limit_mb,
+            'estimated_mb': self.estimated_mb,
+            'peak_mb': max(peaks) if peaks else None,
+            'degradations': self.degradations
+        }
+
+def flood_fill_apartments(image, barrier_mask, margin=8):
     """
     Use connected components to find enclosed apartment areas
     (Optimized replacement for iterative flood fill)
+
+    Each region is returned as a bounding-box crop instead of a full-page mask:
+        {'label': component id, 'bbox': (x, y, w, h),
+         'offset': (x0, y0) of the crop, 'mask': uint8 crop (255 = region)}
+    The crop keeps `margin` extra pixels (clipped at the page edge) so dilation in
+    region_to_polygon() gives the same result as on the full page, and memory stays
+    close to one page image regardless of how many apartments are found.
     """
     h, w = barrier_mask.shape
     total_area = h * w
@@ -255,6 +1187,7 @@ def flood_fill_apartments(image, barrier_mask):
     # connectivity=4 means pixels must share an edge (not just corner)
     # We use 4-connectivity to match floodFill's typical behavior for tight seals
     num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(fillable, connectivity=4)
+    del fillable
     
     regions = []
     
@@ -267,13 +1200,29 @@ def flood_fill_apartments(image, barrier_mask):
         area = stats[i, cv2.CC_STAT_AREA]
         
         if min_area < area < max_area:
-            # Create a mask for this component
-            # This is fast: numpy boolean comparison optimized in C
-            component_mask = (labels == i).astype(np.uint8) * 255
-            regions.append(component_mask)
+            x, y = int(stats[i, cv2.CC_STAT_LEFT]), int(stats[i, cv2.CC_STAT_TOP])
+            rw, rh = int(stats[i, cv2.CC_STAT_WIDTH]), int(stats[i, cv2.CC_STAT_HEIGHT])
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(w, x + rw + margin), min(h, y + rh + margin)
+
+            # Mask only the bounding-box crop of the label image
+            component_mask = (labels[y0:y1, x0:x1] == i).astype(np.uint8) * 255
+            regions.append({
+                'label': i,
+                'bbox': (x, y, rw, rh),
+                'offset': (x0, y0),
+                'mask': component_mask
+            })
             
     return regions
 
+def paint_region(image, region, color):
+    """Fill a cropped region into a full-size image (debug rendering)"""
+    x0, y0 = region['offset']
+    mask = region['mask']
+    view = image[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]]
+    view[mask > 0] = color
+
 def expand_region_to_barrier(region_mask, barrier_mask, expansion_px=4):
     """
     Expand the region mask outward to align with the center of the red lines.
@@ -288,20 +1237,24 @@ def expand_region_to_barrier(region_mask, barrier_mask, expansion_px=4):
     # This ensures polygons align with the red line center
     return expanded
 
-def region_to_polygon(region_mask, simplify_epsilon=5, expand_px=4):
-    """Convert a region mask to a simplified polygon
+def region_to_polygon(region, simplify_epsilon=5, expand_px=4):
+    """Convert a region to a simplified polygon in page coordinates
     
     Args:
-        region_mask: Binary mask of the region
+        region: Region crop from flood_fill_apartments()
         simplify_epsilon: Epsilon for polygon simplification (Douglas-Peucker)
         expand_px: Pixels to expand outward to align with red line centers
     """
+    region_mask = region['mask']
+
     # Expand region outward to compensate for barrier shrinkage
     if expand_px > 0:
         kernel = np.ones((expand_px, expand_px), np.uint8)
         region_mask = cv2.dilate(region_mask, kernel, iterations=1)
     
-    contours, _ = cv2.findContours(region_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Offset shifts crop coordinates back onto the page
+    contours, _ = cv2.findContours(region_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                   offset=region['offset'])
     
     if not contours:
         return None
@@ -318,90 +1271,555 @@ def region_to_polygon(region_mask, simplify_epsilon=5, expand_px=4):
     
     return points
 
-def find_transformation(source_img, target_img):
-    """
-    Find transformation matrix between source and target using ORB features
-    """
-    # Convert to grayscale
-    if len(source_img.shape) == 3:
-        gray1 = cv2.cvtColor(source_img, cv2.COLOR_BGR2GRAY)
-    else:
-        gray1 = source_img
-        
-    if len(target_img.shape) == 3:
-        gray2 = cv2.cvtColor(target_img, cv2.COLOR_BGR2GRAY)
+# Registration feature backends: detector factory (given a keypoint cap, 0 for
+# the backend default) and FLANN index parameters for its descriptors. ORB and
+# AKAZE produce binary descriptors, matched with an LSH (Hamming) index.
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+FEATURE_BACKENDS = {
+    'sift': (lambda n: cv2.SIFT_create(nfeatures=n),
+             dict(algorithm=FLANN_INDEX_KDTREE, trees=5)),
+    'orb': (lambda n: cv2.ORB_create(nfeatures=n or 2000),
+            dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=20, multi_probe_level=1)),
+    'akaze': (lambda n: create_akaze(),
+              dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=20, multi_probe_level=1)),
+}
+
+def create_akaze():
+    # AKAZE moved to opencv-contrib in OpenCV 5; checked here rather than
+    # when building FEATURE_BACKENDS, which would import OpenCV for every run
+    if not hasattr(cv2, 'AKAZE_create'):
+        raise ValueError(f"The akaze feature backend is not in OpenCV {cv2.__version__}, "
+                         "install opencv-contrib-python-headless or pick another backend")
+    return cv2.AKAZE_create()
+
+# Backends tried in order by the 'auto' registration backend: the fast binary
+# pass first, SIFT when it is not well supported
+AUTO_BACKENDS = ['orb', 'sift']
+# FLANN builds its randomized trees and LSH tables from OpenCV's (per-thread)
+# RNG; a fixed seed makes an index built now match one loaded from the cache
+FLANN_SEED = 0
+
+# Detector/matcher objects are costly to construct, keep one per process
+_feature_tools = {}
+
+def get_feature_tools(backend='sift', max_keypoints=0):
+    """Return the shared (detector, FLANN matcher) pair of a backend, creating it on first use"""
+    key = (backend, max_keypoints)
+    if key not in _feature_tools:
+        create_detector, index_params = FEATURE_BACKENDS[backend]
+        search_params = dict(checks=50)
+        _feature_tools[key] = (
+            create_detector(max_keypoints),
+            cv2.FlannBasedMatcher(index_params, search_params)
+        )
+    return _feature_tools[key]
+
+def keypoints_to_array(keypoints):
+    """Serialize cv2.KeyPoints to an (N, 7) float32 array"""
+    return np.array([
+        (kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+        for kp in keypoints
+    ], dtype=np.float32).reshape(-1, 7)
+
+def array_to_keypoints(array):
+    """Inverse of keypoints_to_array()"""
+    return [
+        cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave), int(class_id))
+        for x, y, size, angle, response, octave, class_id in array
+    ]
+
+def compute_features(image, max_keypoints=0, backend='sift'):
+    """Keypoints and descriptors of an image, optionally capped to the strongest max_keypoints"""
+    # Convert to grayscale
+    if len(image.shape) == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     else:
-        gray2 = target_img
-    
-    # Create SIFT detector (more robust than ORB for 2D->3D)
-    sift = cv2.SIFT_create()
-    
-    # Detect keypoints and compute descriptors
-    kp1, desc1 = sift.detectAndCompute(gray1, None)
-    kp2, desc2 = sift.detectAndCompute(gray2, None)
-    
-    if desc1 is None or desc2 is None:
-        return None
-    
-    # Match features using FLANN with KDTREE for SIFT
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50)
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    
+        gray = image
+
+    detector, _ = get_feature_tools(backend, max_keypoints)
+    return detector.detectAndCompute(gray, None)
+
+def build_flann_index(descriptors, backend='sift'):
+    """Standalone FLANN index over one image's descriptors, reusable across match_features() calls"""
+    _, index_params = FEATURE_BACKENDS[backend]
+    cv2.setRNGSeed(FLANN_SEED)
+    return cv2.flann_Index(descriptors, index_params)
+
+def match_features(features1, features2, ratio=0.75, backend='sift', index=None):
+    """
+    FLANN kNN matching with Lowe's ratio test
+
+    index is an optional build_flann_index() over features2's descriptors,
+    e.g. loaded from the detection cache, which skips building one per call.
+    Returns matched (N, 2) float32 point arrays (points1, points2).
+    """
+    _, flann = get_feature_tools(backend)
+    kp1, desc1 = features1
+    kp2, desc2 = features2
+    if desc1 is None or desc2 is None or len(desc1) < 2 or len(desc2) < 2:
+        return np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+
+    if index is not None:
+        indices, dists = index.knnSearch(desc1, 2, params=dict(checks=50))
+        if FEATURE_BACKENDS[backend][1]['algorithm'] != FLANN_INDEX_LSH:
+            # KD-tree searches report squared L2 distances
+            dists = np.sqrt(dists)
+        # LSH marks missing neighbours with -1
+        good = (indices[:, 1] >= 0) & (indices[:, 0] >= 0) & (dists[:, 0] < ratio * dists[:, 1])
+        query = np.flatnonzero(good)
+        pts1 = np.float32([kp1[i].pt for i in query]).reshape(-1, 2)
+        pts2 = np.float32([kp2[i].pt for i in indices[query, 0]]).reshape(-1, 2)
+        return pts1, pts2
+
+    # The matcher builds a new index over desc2 per call
+    cv2.setRNGSeed(FLANN_SEED)
     matches = flann.knnMatch(desc1, desc2, k=2)
-    
+
     # Apply Lowe's ratio test
     good_matches = []
     for match in matches:
         if len(match) == 2:
             m, n = match
-            if m.distance < 0.75 * n.distance:
+            if m.distance < ratio * n.distance:
                 good_matches.append(m)
-    
-    if len(good_matches) < 20:
-        return None
-    
-    # Get matched points
-    src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-    
-    # Find homography
-    H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
-    
+
+    pts1 = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 2)
+    pts2 = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 2)
+    return pts1, pts2
+
+def estimate_homography(src_pts, dst_pts, min_matches=20, min_inliers=12):
+    """
+    RANSAC homography from matched points, None unless it is well supported
+
+    Returns (H, inlier mask) or (None, None).
+    """
+    if len(src_pts) < min_matches:
+        return None, None
+
+    H, mask = cv2.findHomography(src_pts.reshape(-1, 1, 2), dst_pts.reshape(-1, 1, 2), cv2.RANSAC, 5.0)
     if H is None:
-        return None
-        
+        return None, None
+
     # Strict validation: Check inliers count
     # We need a robust match, not just minimum 4 points
-    inliers = np.sum(mask)
-    if inliers < 12:
-        return None
+    mask = mask.ravel().astype(bool)
+    if mask.sum() < min_inliers:
+        return None, None
+    return H, mask
+
+def homography_is_plausible(H, source_size, target_size, min_area=0.05, max_area=20.0):
+    """
+    Reject homographies that no real plan/render pair produces
+
+    Repetitive texture (hatching, pixel noise) can give RANSAC a well-supported
+    but degenerate fit, e.g. one that folds the whole plan onto a single point.
+    The source outline must stay a convex quadrilateral covering between
+    min_area and max_area of the target. Sizes are (width, height).
+    """
+    w, h = source_size
+    corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+    projected = cv2.perspectiveTransform(corners, H).reshape(-1, 2)
+    if not np.all(np.isfinite(projected)) or not cv2.isContourConvex(projected):
+        return False
+    area = cv2.contourArea(projected) / float(target_size[0] * target_size[1])
+    return min_area <= area <= max_area
+
+def find_transformation(source_img, target_img, source_features=None, target_features=None, stats=None,
+                        backend='sift', target_index=None):
+    """
+    Find transformation matrix between source and target using local features
+
+    backend picks the detector from FEATURE_BACKENDS (SIFT by default; ORB is
+    much cheaper on clean renders). Precomputed (keypoints, descriptors) of that
+    backend for either side may be passed in, e.g. from the detection cache,
+    to skip feature extraction for that image, together with a prebuilt FLANN
+    target_index over the target descriptors. Keypoint and match counts are
+    recorded in `stats` when a dict is given.
+    """
+    # Detectors and FLANN matchers are shared across calls so worker
+    # processes only build them once
+    
+    # Detect keypoints and compute descriptors
+    if source_features is None:
+        source_features = compute_features(source_img, backend=backend)
+    if target_features is None:
+        target_features = compute_features(target_img, backend=backend)
     
+    src_pts, dst_pts = match_features(source_features, target_features, backend=backend, index=target_index)
+    H, mask = estimate_homography(src_pts, dst_pts)
+
+    if stats is not None:
+        stats.update({
+            'source_keypoints': len(source_features[0]),
+            'target_keypoints': len(target_features[0]),
+            'matches': len(src_pts),
+            'inliers': int(mask.sum()) if mask is not None else 0
+        })
     return H
 
-def transform_polygon(polygon, H):
-    """Transform polygon points using homography matrix"""
-    if polygon is None or H is None:
-        return None
+def downscale_for_registration(image, max_side):
+    """
+    Shrink an image so its longer side is at most max_side pixels
+
+    Returns (image, S) where S is the 3x3 matrix mapping full-size pixel
+    coordinates to the downscaled image.
+    """
+    h, w = image.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    if scale >= 1.0:
+        return image, np.eye(3)
+    new_w, new_h = max(1, round(w * scale)), max(1, round(h * scale))
+    small = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    return small, np.diag([new_w / w, new_h / h, 1.0])
 
-    pts = np.array(polygon, dtype=np.float32).reshape(-1, 1, 2)
-    transformed = cv2.perspectiveTransform(pts, H)
-    return transformed.reshape(-1, 2).tolist()
+def coarse_registration_level(source_img, coarse_side, source_coarse=None):
+    """
+    Coarse source image for find_transformation_pyramid() and its scale matrix
 
-def extract_apartment_number_ocr(image, region_mask):
-    """Fallback OCR function (original)"""
-    try:
-        import pytesseract
-    except ImportError:
+    source_coarse=(image, S) reuses an existing low-resolution copy (S maps
+    source pixels to it), shrinking it further if needed.
+    """
+    if source_coarse is None:
+        return downscale_for_registration(source_img, coarse_side)
+    small, S = source_coarse
+    smaller, S_more = downscale_for_registration(small, coarse_side)
+    return smaller, S_more @ S
+
+def spread_points(points, count):
+    """Indices of up to `count` points picked by farthest-point sampling"""
+    if len(points) == 0:
+        return []
+    center = points.mean(axis=0)
+    chosen = [int(np.argmin(((points - center) ** 2).sum(axis=1)))]
+    dist = ((points - points[chosen[0]]) ** 2).sum(axis=1)
+    while len(chosen) < min(count, len(points)):
+        idx = int(np.argmax(dist))
+        if dist[idx] == 0:
+            break
+        chosen.append(idx)
+        dist = np.minimum(dist, ((points - points[idx]) ** 2).sum(axis=1))
+    return chosen
+
+# Longer side (pixels) of the coarse registration level and its keypoint cap
+PYRAMID_COARSE_SIDE = 1024
+PYRAMID_MAX_KEYPOINTS = 4000
+
+def find_transformation_pyramid(source_img, target_img, coarse_side=PYRAMID_COARSE_SIDE,
+                                max_keypoints=PYRAMID_MAX_KEYPOINTS,
+                                patches=6, patch_size=384, source_coarse=None, source_features=None,
+                                target_features=None, stats=None, backend='sift', max_window_pixels=None):
+    """
+    Coarse-to-fine homography between source and target
+
+    The homography is first estimated on copies of both images shrunk to
+    coarse_side pixels, keeping the max_keypoints strongest keypoints of the
+    backend. It is then refined from full-resolution patches: up to `patches`
+    windows of patch_size pixels around well-spread coarse inliers are matched
+    against the target area the coarse estimate predicts, and the homography is
+    re-fitted on those correspondences. When refinement is not well supported
+    the coarse estimate is returned.
+
+    source_img only needs .shape and 2D slicing, so a tiled PageRaster works;
+    pass source_coarse=(image, S) with a ready low-resolution copy in that case
+    (S maps source pixels to it). source_features and target_features are the
+    coarse-level features of either side, e.g. from the detection cache. Keypoint counts and per-level
+    timings are recorded in `stats` when a dict is given. Target windows over
+    max_window_pixels are not refined on (see MemoryBudget.feature_pixels()).
+    """
+    levels = []
+    if stats is not None:
+        stats['levels'] = levels
+
+    # Coarse level
+    start = time.perf_counter()
+    source_small, S_src = coarse_registration_level(source_img, coarse_side, source_coarse)
+    target_small, S_tgt = downscale_for_registration(target_img, coarse_side)
+
+    if source_features is None:
+        source_features = compute_features(source_small, max_keypoints, backend)
+    if target_features is None:
+        target_features = compute_features(target_small, max_keypoints, backend)
+    src_pts, dst_pts = match_features(source_features, target_features, backend=backend)
+    H_small, mask = estimate_homography(src_pts, dst_pts)
+    levels.append({
+        'level': 'coarse',
+        'source_size': list(source_small.shape[1::-1]),
+        'target_size': list(target_small.shape[1::-1]),
+        'source_keypoints': len(source_features[0]),
+        'target_keypoints': len(target_features[0]),
+        'matches': len(src_pts),
+        'inliers': int(mask.sum()) if mask is not None else 0,
+        'ms': round((time.perf_counter() - start) * 1000, 2)
+    })
+    if H_small is None:
         return None
 
-    coords = np.argwhere(region_mask > 0)
-    if len(coords) == 0:
+    # Full-resolution homography implied by the coarse estimate
+    H = np.linalg.inv(S_tgt) @ H_small @ S_src
+    H /= H[2, 2]
+
+    # Refinement on full-resolution patches around spread-out coarse inliers
+    start = time.perf_counter()
+    inlier_src = cv2.perspectiveTransform(
+        src_pts[mask].reshape(-1, 1, 2), np.linalg.inv(S_src)
+    ).reshape(-1, 2)
+    src_h, src_w = source_img.shape[:2]
+    tgt_h, tgt_w = target_img.shape[:2]
+    half = patch_size // 2
+    # Coarse error is about one coarse pixel; allow a few of them around the prediction
+    tolerance = 4.0 / min(S_tgt[0, 0], S_tgt[1, 1])
+    margin = int(np.ceil(tolerance)) + 8
+
+    refined_src, refined_dst = [], []
+    source_keypoints = target_keypoints = 0
+    used = 0
+    for idx in spread_points(inlier_src, patches):
+        cx, cy = inlier_src[idx]
+        x0, y0 = max(0, int(cx) - half), max(0, int(cy) - half)
+        x1, y1 = min(src_w, int(cx) + half), min(src_h, int(cy) + half)
+        if x1 - x0 < 32 or y1 - y0 < 32:
+            continue
+
+        corners = np.float32([[x0, y0], [x1, y0], [x1, y1], [x0, y1]]).reshape(-1, 1, 2)
+        projected = cv2.perspectiveTransform(corners, H).reshape(-1, 2)
+        tx0 = int(max(0, np.floor(projected[:, 0].min()) - margin))
+        ty0 = int(max(0, np.floor(projected[:, 1].min()) - margin))
+        tx1 = int(min(tgt_w, np.ceil(projected[:, 0].max()) + margin))
+        ty1 = int(min(tgt_h, np.ceil(projected[:, 1].max()) + margin))
+        if tx1 - tx0 < 32 or ty1 - ty0 < 32:
+            continue
+        if max_window_pixels is not None and (tx1 - tx0) * (ty1 - ty0) > max_window_pixels:
+            # A poor coarse estimate can predict most of the target
+            continue
+
+        patch_features = compute_features(source_img[y0:y1, x0:x1], backend=backend)
+        window_features = compute_features(target_img[ty0:ty1, tx0:tx1], backend=backend)
+        source_keypoints += len(patch_features[0])
+        target_keypoints += len(window_features[0])
+        used += 1
+        p_src, p_dst = match_features(patch_features, window_features, backend=backend)
+        if len(p_src) == 0:
+            continue
+        p_src += (x0, y0)
+        p_dst += (tx0, ty0)
+
+        # Keep only correspondences consistent with the coarse estimate
+        predicted = cv2.perspectiveTransform(p_src.reshape(-1, 1, 2), H).reshape(-1, 2)
+        keep = np.linalg.norm(predicted - p_dst, axis=1) < tolerance
+        refined_src.append(p_src[keep])
+        refined_dst.append(p_dst[keep])
+
+    refined_src = np.concatenate(refined_src) if refined_src else np.empty((0, 2), np.float32)
+    refined_dst = np.concatenate(refined_dst) if refined_dst else np.empty((0, 2), np.float32)
+    H_fine, fine_mask = estimate_homography(refined_src, refined_dst)
+    levels.append({
+        'level': 'refine',
+        'patches': used,
+        'source_keypoints': source_keypoints,
+        'target_keypoints': target_keypoints,
+        'matches': len(refined_src),
+        'inliers': int(fine_mask.sum()) if fine_mask is not None else 0,
+        'ms': round((time.perf_counter() - start) * 1000, 2)
+    })
+    if stats is not None:
+        stats['refined'] = H_fine is not None
+
+    return H_fine if H_fine is not None else H
+
+class PointGrid:
+    """Uniform grid over 2D points for fast bounding-box candidate queries"""
+
+    def __init__(self, points, cell_size=100):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        self.buckets = {}
+        if len(self.points) == 0:
+            return
+
+        cells = np.floor(self.points / self.cell_size).astype(np.int64)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        sorted_cells = cells[order]
+        # Split the sorted point indices at every change of cell
+        breaks = np.flatnonzero(np.any(np.diff(sorted_cells, axis=0) != 0, axis=1)) + 1
+        for idx in np.split(order, breaks):
+            cx, cy = cells[idx[0]]
+            self.buckets[(int(cx), int(cy))] = idx
+
+    def query(self, x_min, y_min, x_max, y_max):
+        """Sorted indices of points inside the rectangle"""
+        c = self.cell_size
+        found = [
+            self.buckets[(cx, cy)]
+            for cx in range(int(np.floor(x_min / c)), int(np.floor(x_max / c)) + 1)
+            for cy in range(int(np.floor(y_min / c)), int(np.floor(y_max / c)) + 1)
+            if (cx, cy) in self.buckets
+        ]
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+
+        idx = np.concatenate(found)
+        pts = self.points[idx]
+        keep = (pts[:, 0] >= x_min) & (pts[:, 0] <= x_max) & (pts[:, 1] >= y_min) & (pts[:, 1] <= y_max)
+        return np.sort(idx[keep])
+
+def polygon_signed_distances(polygon, points):
+    """
+    Vectorized cv2.pointPolygonTest(..., measureDist=True) for many points:
+    positive inside, negative outside, 0 on the boundary
+    """
+    poly = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    pts = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+    a = poly[None, :, :]
+    b = np.roll(poly, -1, axis=0)[None, :, :]
+    ab = b - a
+
+    # Distance to the closest point on every edge
+    length_sq = np.sum(ab * ab, axis=2)
+    t = np.sum((pts - a) * ab, axis=2) / np.where(length_sq == 0, 1, length_sq)
+    closest = a + np.clip(t, 0, 1)[:, :, None] * ab
+    dist = np.sqrt(np.min(np.sum((pts - closest) ** 2, axis=2), axis=1))
+
+    # Even-odd crossing test for containment
+    px, py = pts[:, :, 0], pts[:, :, 1]
+    ax, ay, bx, by = a[:, :, 0], a[:, :, 1], b[:, :, 0], b[:, :, 1]
+    straddles = (ay > py) != (by > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = ax + (py - ay) * (bx - ax) / (by - ay)
+    inside = np.count_nonzero(straddles & (px < x_cross), axis=1) % 2 == 1
+
+    return np.where(inside, dist, -dist)
+
+def proximity_candidates(polygons, centers, max_dist=100):
+    """
+    Candidate (polygon index, center index, signed distance) arrays for every
+    center inside or within max_dist pixels of a polygon
+
+    Centers go into a grid index queried with each polygon's expanded bounding
+    box, and distances are computed per polygon in one vectorized call, so the
+    work grows with the number of nearby pairs instead of polygons x labels.
+    """
+    grid = PointGrid(centers, cell_size=max_dist)
+
+    poly_ids, num_ids, dists = [], [], []
+    for i, poly_data in enumerate(polygons):
+        poly_pts = np.asarray(poly_data['polygon'], dtype=np.float64)
+        x_min, y_min = poly_pts.min(axis=0) - max_dist
+        x_max, y_max = poly_pts.max(axis=0) + max_dist
+
+        candidates = grid.query(x_min, y_min, x_max, y_max)
+        if len(candidates) == 0:
+            continue
+
+        dist = polygon_signed_distances(poly_pts, centers[candidates])
+        near = dist >= -max_dist
+        poly_ids.append(np.full(np.count_nonzero(near), i, dtype=np.int64))
+        num_ids.append(candidates[near])
+        dists.append(dist[near])
+
+    if not poly_ids:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    return np.concatenate(poly_ids), np.concatenate(num_ids), np.concatenate(dists)
+
+def match_numbers_to_polygons(polygons, pdf_numbers, max_dist=100, debug=False):
+    """
+    Assign PDF label numbers to polygons, each label and polygon used once
+
+    Labels inside a polygon win, in polygon/label order; labels outside but
+    within max_dist pixels are used next, closest first. Candidates come from
+    proximity_candidates(). Sets 'apartment_number' on the matched polygons and
+    returns the set of assigned polygon indices.
+    """
+    if not pdf_numbers or not polygons:
+        return set()
+
+    # 1. Collect all potential matches (polygon_idx, number_idx, distance)
+    centers = np.array([num_data['center'] for num_data in pdf_numbers], dtype=np.float64)
+    poly_ids, num_ids, dists = proximity_candidates(polygons, centers, max_dist)
+
+    return assign_matches(polygons, pdf_numbers, poly_ids, num_ids, dists, debug=debug)
+
+def match_numbers_by_labels(polygons, pdf_numbers, max_dist=100, debug=False):
+    """
+    Fast-path variant of match_numbers_to_polygons() using the region crops
+
+    Regions are disjoint connected components of the barrier, so the pixel
+    under a label center is in at most one region mask: reading it from the
+    crops whose box holds the center gives exact containment for all labels.
+    Only labels that land on barrier pixels or on components that are not
+    apartments go through the proximity search.
+    """
+    if not pdf_numbers or not polygons:
+        return set()
+
+    centers = np.array([num_data['center'] for num_data in pdf_numbers], dtype=np.float64)
+    pixels = np.floor(centers).astype(np.int64)
+    grid = PointGrid(pixels)
+
+    hit = np.full(len(pdf_numbers), -1, dtype=np.int64)
+    for i, poly_data in enumerate(polygons):
+        region = poly_data['region']
+        x0, y0 = region['offset']
+        mask = region['mask']
+        idx = grid.query(x0, y0, x0 + mask.shape[1] - 1, y0 + mask.shape[0] - 1)
+        if len(idx):
+            inside = mask[pixels[idx, 1] - y0, pixels[idx, 0] - x0] > 0
+            hit[idx[inside]] = i
+
+    # Containment is exact here; rank these like points strictly inside
+    inside = np.flatnonzero(hit >= 0)
+    poly_ids, num_ids, dists = hit[inside], inside, np.ones(len(inside))
+
+    rest = np.flatnonzero(hit < 0)
+    if len(rest):
+        near_polys, near_nums, near_dists = proximity_candidates(polygons, centers[rest], max_dist)
+        poly_ids = np.concatenate([poly_ids, near_polys])
+        num_ids = np.concatenate([num_ids, rest[near_nums]])
+        dists = np.concatenate([dists, near_dists])
+
+    return assign_matches(polygons, pdf_numbers, poly_ids, num_ids, dists, debug=debug)
+
+def assign_matches(polygons, pdf_numbers, poly_ids, num_ids, dists, debug=False):
+    """
+    Greedy unique assignment of candidate (polygon, label, signed distance) pairs
+
+    Sets 'apartment_number' on the matched polygons and returns the set of
+    assigned polygon indices.
+    """
+    # 2. Sort matches: inside (dist > 0) > on the edge > outside by proximity,
+    # ties keep polygon/label order
+    containment = np.sign(dists)
+    outside_gap = np.where(dists < 0, -dists, 0)
+    order = np.lexsort((num_ids, poly_ids, outside_gap, -containment))
+
+    # 3. Assign uniquely
+    assigned_polygons = set()
+    assigned_numbers = set()
+    for k in order:
+        p_idx, n_idx = int(poly_ids[k]), int(num_ids[k])
+
+        if p_idx in assigned_polygons or n_idx in assigned_numbers:
+            continue
+
+        # Assign
+        text = pdf_numbers[n_idx]['number']
+        polygons[p_idx]['apartment_number'] = text
+        assigned_polygons.add(p_idx)
+        assigned_numbers.add(n_idx)
+
+        if debug:
+            print(f"DEBUG: Assigned {text} to Polygon {polygons[p_idx]['id']} (dist={dists[k]:.2f})")
+
+    return assigned_polygons
+
+def prepare_ocr_images(image, region):
+    """Cropped, upscaled (gray, thresholded) versions of a region for Tesseract"""
+    x, y, rw, rh = region['bbox']
+    if rw == 0 or rh == 0:
         return None
 
-    y_min, x_min = coords.min(axis=0)
-    y_max, x_max = coords.max(axis=0)
+    y_min, x_min = y, x
+    y_max, x_max = y + rh - 1, x + rw - 1
 
     # Padding
     padding = 20
@@ -421,311 +1839,2229 @@ def extract_apartment_number_ocr(image, region_mask):
     else:
         gray = cropped.copy()
         
+    # Scale up significantly for better OCR
+    ch = gray.shape[0]
+    scale = 3.0
+    if ch < 50:
+         scale = 60 / ch # Ensure at least 60px height
+         
+    # Resize
+    gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+    
+    # Thresholding to separate text
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return gray, thresh
+
+def parse_ocr_text(text, vocabulary=None):
+    """Apartment number from OCR'd text ("bina X", or a bare number line), or None"""
+    return (vocabulary or DEFAULT_VOCABULARY).parse_text(text)
+
+def _tesseract_timeout(deadline):
+    """Seconds left before `deadline` (time.monotonic()), 0 for no limit"""
+    if deadline is None:
+        return 0
+    return max(0.01, deadline - time.monotonic())
+
+def ocr_prepared_single(prepared, deadline=None, vocabulary=None):
+    """Run Tesseract on one region's prepare_ocr_images() output, per image/config pair"""
+    import pytesseract
+
     try:
-        # Scale up significantly for better OCR
-        ch = gray.shape[0]
-        scale = 3.0
-        if ch < 50:
-             scale = 60 / ch # Ensure at least 60px height
-             
-        # Resize
-        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
-        
-        # Thresholding to separate text
-        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
         # Try both original gray and thresholded
         configs = ['--psm 6', '--psm 7']
-        images = [gray, thresh]
-        
-        import re
+        images = list(prepared)
         
         for img_ver in images:
             for config in configs:
-                text = pytesseract.image_to_string(img_ver, config=config).strip()
-                
-                # Look for "bina X" or just numbers
-                match = re.search(r'(?:bina|apt|apartment|ბინა)\s*(\d+[-\w]*)', text, re.IGNORECASE)
-                if match:
-                     return match.group(1)
-                
-                # Look for single number on lines without "m2"
-                for line in text.split('\n'):
-                    if re.search(r'(m2|მ2|sq|sqm)', line, re.IGNORECASE): continue
-                    match = re.search(r'^(\d+[-\w]*)$', line.strip())
-                    if match:
-                         return match.group(1)
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                text = pytesseract.image_to_string(img_ver, config=config,
+                                                   timeout=_tesseract_timeout(deadline)).strip()
+                number = parse_ocr_text(text, vocabulary)
+                if number:
+                    return number
                  
         return None
     except Exception:
+        # Includes pytesseract's RuntimeError when the budget runs out mid-call
         return None
 
-def detect_apartments(source_path, target_path=None, enable_ocr=True, debug=False):
+# (image variant, Tesseract config) passes of the batched OCR, cheapest first.
+# psm 11 (sparse text) suits a mosaic of unrelated crops.
+OCR_BATCH_PASSES = [(0, '--psm 11'), (1, '--psm 11'), (0, '--psm 6'), (1, '--psm 6')]
+
+def build_ocr_mosaic(crops, gap=40, max_height=20000):
     """
-    Main detection function
+    Stack crops vertically on white with `gap` pixel separators
+
+    Returns a list of (mosaic, cells) chunks, where cells holds (key, top, bottom)
+    rows for mapping recognized tokens back to their crop. A new chunk starts
+    before max_height so Tesseract never sees an oversized image.
     """
-    # Load source image
-    is_pdf = source_path.lower().endswith('.pdf')
-    if is_pdf:
-        source_img = pdf_to_image(source_path)
+    chunks = []
+    current, cells, height = [], [], gap
+
+    def flush():
+        if not current:
+            return
+        width = max(crop.shape[1] for _, crop in current) + 2 * gap
+        mosaic = np.full((height, width), 255, np.uint8)
+        for (key, crop), (_, top, bottom) in zip(current, cells):
+            mosaic[top:bottom, gap:gap + crop.shape[1]] = crop
+        chunks.append((mosaic, list(cells)))
+
+    for key, crop in crops:
+        if current and height + crop.shape[0] + gap > max_height:
+            flush()
+            current, cells, height = [], [], gap
+        cells.append((key, height, height + crop.shape[0]))
+        current.append((key, crop))
+        height += crop.shape[0] + gap
+    flush()
+    return chunks
+
+def ocr_prepared_batch(prepared, min_confidence=60, deadline=None, vocabulary=None):
+    """
+    Batched OCR fallback: all region crops of a page in one Tesseract run per pass
+
+    Crops are packed into a mosaic and read with image_to_data; every token is
+    mapped back to its region by its vertical position. Passes follow
+    OCR_BATCH_PASSES, and a region leaves the mosaic as soon as it yields a
+    number whose words average at least min_confidence. A page with N unlabelled
+    units costs at most len(OCR_BATCH_PASSES) Tesseract launches instead of 4N.
+
+    prepared maps keys to prepare_ocr_images() output; returns {key: number}
+    for the regions that were recognized. Stops starting new Tesseract runs once
+    `deadline` (time.monotonic()) passes.
+    """
+    import pytesseract
+
+    results = {}
+    tentative = {}
+    for variant, config in OCR_BATCH_PASSES:
+        pending = [(key, images[variant]) for key, images in prepared.items() if key not in results]
+        if not pending:
+            break
+
+        for mosaic, cells in build_ocr_mosaic(pending):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            try:
+                data = pytesseract.image_to_data(mosaic, config=config, output_type=pytesseract.Output.DICT,
+                                                 timeout=_tesseract_timeout(deadline))
+            except Exception as e:
+                sys.stderr.write(f"Batched OCR failed: {e}\n")
+                continue
+
+            # Group words into (cell, block, paragraph, line)
+            tops = np.array([top for _, top, _ in cells])
+            lines = {}
+            for i, word in enumerate(data['text']):
+                word = word.strip()
+                if not word:
+                    continue
+                center_y = data['top'][i] + data['height'][i] / 2
+                cell = int(np.searchsorted(tops, center_y, side='right')) - 1
+                if cell < 0 or center_y > cells[cell][2]:
+                    continue  # In a separator gap
+                line_key = (cell, data['block_num'][i], data['par_num'][i], data['line_num'][i])
+                lines.setdefault(line_key, []).append((data['left'][i], word, float(data['conf'][i])))
+
+            per_cell = {}
+            for (cell, _, _, _), words in sorted(lines.items()):
+                words.sort()
+                per_cell.setdefault(cell, []).append(words)
+
+            for cell, cell_lines in per_cell.items():
+                key = cells[cell][0]
+                text = '\n'.join(' '.join(word for _, word, _ in line) for line in cell_lines)
+                number = parse_ocr_text(text, vocabulary)
+                if not number:
+                    continue
+                # Confidence of the line(s) the number was read from (-1 marks non-words)
+                confs = [
+                    conf
+                    for line in cell_lines if any(number in word for _, word, _ in line)
+                    for _, _, conf in line if conf >= 0
+                ]
+                confidence = sum(confs) / len(confs) if confs else 0
+                if confidence >= min_confidence:
+                    results[key] = number
+                    tentative.pop(key, None)
+                elif key not in tentative:
+                    tentative[key] = number
+
+    # Low-confidence readings are still better than nothing
+    for key, number in tentative.items():
+        results.setdefault(key, number)
+    return results
+
+def run_ocr_fallback(image, regions, mode='batch', workers=4, budget=None, on_result=None, vocabulary=None):
+    """
+    OCR fallback for (key, region) pairs, spread over a bounded thread pool
+
+    Crops are prepared up front on the calling thread (a tiled PageRaster renders
+    through PyMuPDF, which is not thread-safe); the pool threads only wait on
+    Tesseract processes. In 'batch' mode the regions are split into one mosaic
+    group per worker, in 'single' mode each region is its own task. Once
+    `budget` seconds have passed no new Tesseract run starts and running ones are
+    killed, so the page returns partial results instead of running into the
+    controller's process timeout. on_result(key, number) is called from the
+    pool threads for every number as soon as its task has finished. With more
+    than one worker, each Tesseract process should run single-threaded
+    (OMP_THREAD_LIMIT=1, which main() sets).
+
+    Returns ({key: number}, report) where report summarizes the run.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from importlib.util import find_spec
+
+    report = {'mode': mode, 'regions': len(regions), 'recognized': 0, 'timed_out': False}
+    if find_spec('pytesseract') is None:
+        report['error'] = 'pytesseract not installed'
+        return {}, report
+
+    started = time.monotonic()
+    deadline = started + budget if budget else None
+
+    prepared = []
+    for key, region in regions:
+        try:
+            images = prepare_ocr_images(image, region)
+        except Exception:
+            images = None
+        if images is not None:
+            prepared.append((key, images))
+
+    workers = max(1, min(workers, len(prepared)))
+    report['workers'] = workers
+
+    if mode == 'batch':
+        groups = [dict(prepared[i::workers]) for i in range(workers)]
+        tasks = [(ocr_prepared_batch, (group, 60, deadline, vocabulary)) for group in groups if group]
     else:
-        source_img = cv2.imread(source_path)
-    
-    if source_img is None:
-        raise ValueError(f"Could not load source image: {source_path}")
-    
-    source_h, source_w = source_img.shape[:2]
-    
-    # Try to extract text from PDF directly
-    pdf_numbers = []
-    if is_pdf and enable_ocr:
-        pdf_numbers = get_pdf_text_data(source_path, source_w, source_h)
-        if pdf_numbers:
-            pass # We have data
+        tasks = [
+            (lambda images, key=key: {key: ocr_prepared_single(images, deadline, vocabulary)}, (images,))
+            for key, images in prepared
+        ]
+
+    def run_task(fn, args):
+        found = fn(*args)
+        if on_result is not None:
+            for key, number in found.items():
+                if number:
+                    on_result(key, number)
+        return found
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_task, fn, args) for fn, args in tasks]
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        done, not_done = wait(futures, timeout=remaining)
+        for future in not_done:
+            future.cancel()
+        # Running calls end on their own Tesseract timeout shortly after the deadline
+        done, _ = wait([f for f in futures if not f.cancelled()])
+        for future in done:
+            try:
+                results.update({k: v for k, v in future.result().items() if v})
+            except Exception as e:
+                sys.stderr.write(f"OCR task failed: {e}\n")
+
+    report['timed_out'] = deadline is not None and time.monotonic() >= deadline
+    report['recognized'] = len(results)
+    report['seconds'] = round(time.monotonic() - started, 2)
+    return results, report
+
+def format_apartments(apartments, source_w, source_h, H=None, target_w=None, target_h=None, debug=False):
+    """
+    Output records of apartments, polygons in % of the target image
+
+    All polygons are packed into one point array with per-polygon offsets, so
+    the homography, the percentage scaling and the bounds check each run once
+    over every point; Python lists are only built for the records. An
+    apartment falls back to % of the source image without a homography, or
+    when its transformed polygon lands well outside the target (probably a bad
+    match).
+    """
+    if not apartments:
+        return []
+
+    lengths = np.array([len(apt['polygon']) for apt in apartments])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.array([p for apt in apartments for p in apt['polygon']], np.float64).reshape(-1, 2)
+
+    # Source coords percentage
+    pct = points / [source_w, source_h] * 100
+
+    # Decide output based on transformation availability
+    if H is not None and target_w is not None and len(points):
+        # Transform to target
+        transformed = cv2.perspectiveTransform(points.astype(np.float32).reshape(-1, 1, 2), H)
+        target_pct = transformed.reshape(-1, 2).astype(np.float64) / [target_w, target_h] * 100
+
+        # Validate coordinates are within reasonable bounds
+        # Allow slight overscan (-10% to 110%) to account for crop/bleed
+        point_valid = ((target_pct >= -10) & (target_pct <= 110)).all(axis=1)
+        nonempty = lengths > 0
+        valid = np.zeros(len(apartments), bool)
+        valid[nonempty] = np.logical_and.reduceat(point_valid, starts[nonempty])
+
+        if debug:
+            for apt, ok in zip(apartments, valid):
+                if not ok:
+                    # Invalid transform result - probably bad match
+                    print(f"DEBUG: Transform produced invalid coords for apt {apt['id']}, using source pct fallback")
+
+        pct = np.where(np.repeat(valid, lengths)[:, None], target_pct, pct)
+
+    pct = pct.tolist()
+    return [{
+        'id': apt['id'],
+        'polygon': pct[start:start + length],
+        'apartment_number': apt.get('apartment_number')
+    } for apt, start, length in zip(apartments, starts.tolist(), lengths.tolist())]
+
+# Incremental re-detection (--previous-state / --save-state): a state file holds
+# a run's barrier mask, unit regions and polygons, OCR reads and homography, so
+# a re-upload with edited red lines only recomputes the units near the edit
+STATE_VERSION = 2
+
+def region_digest(image, bbox, padding=20):
+    """Hash of the pixels OCR reads for a region (its bbox plus prepare_ocr_images() padding)"""
+    import hashlib
+
+    x, y, rw, rh = bbox
+    h, w = image.shape[:2]
+    crop = image[max(0, y - padding):min(h, y + rh - 1 + padding), max(0, x - padding):min(w, x + rw - 1 + padding)]
+    return hashlib.blake2b(np.ascontiguousarray(crop).tobytes(), digest_size=16).hexdigest()
+
+def save_detection_state(path, barrier, meta, masks):
+    """
+    Write a state file: the bit-packed barrier, the JSON `meta` and the
+    region crops of meta['units'] (in that order), bit-packed back to back
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    mask_bits, mask_shapes = pack_masks(masks)
+    with open(tmp, 'wb') as f:
+        np.savez(f, bits=np.packbits(barrier > 0), shape=np.array(barrier.shape),
+                 meta=np.frombuffer(json.dumps(meta).encode('utf-8'), np.uint8),
+                 mask_bits=mask_bits, mask_shapes=mask_shapes)
+    os.replace(tmp, path)
+
+def load_detection_state(path):
+    """State written by save_detection_state() as (barrier, meta, masks), None if unreadable"""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            shape = tuple(data['shape'])
+            barrier = np.unpackbits(data['bits'], count=shape[0] * shape[1]).reshape(shape) * np.uint8(255)
+            meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+            if meta.get('version') != STATE_VERSION:
+                return None
+            masks = unpack_masks(data['mask_bits'], data['mask_shapes'])
+    except (OSError, ValueError, KeyError) as e:
+        sys.stderr.write(f"Ignoring previous state {path}: {e}\n")
+        return None
+    return barrier, meta, masks
+
+def region_seed(region):
+    """A pixel (x, y) of a region, page coordinates; the first of its crop in raster order"""
+    if 'seed' in region:
+        return region['seed']
+    mask = region['mask']
+    index = int(np.argmax(mask))
+    return region['offset'][0] + index % mask.shape[1], region['offset'][1] + index // mask.shape[1]
+
+def changed_window(previous, barrier, margin=1):
+    """
+    Page window (x0, y0, x1, y1) around the changed barrier pixels, None if the masks are equal
+
+    The bounding box of the changes grows by `margin` so it takes in every
+    pixel next to a change too.
+    """
+    diff = cv2.compare(previous, barrier, cv2.CMP_NE)
+    if cv2.countNonZero(diff) == 0:
+        return None
+    x, y, rw, rh = cv2.boundingRect(diff)
+    h, w = barrier.shape
+    return max(0, x - margin), max(0, y - margin), min(w, x + rw + margin), min(h, y + rh + margin)
+
+def flood_fill_window(barrier_mask, window, margin=8):
+    """
+    flood_fill_apartments() regions of the part of a page inside `window`
+
+    Components of the window are labelled on their own. One that reaches an
+    edge of the window inside the page may continue outside it, so its full
+    extent is flood-filled on the whole page before the size filter is
+    applied. Regions carry no connected-components label.
+    """
+    h, w = barrier_mask.shape
+    min_area = h * w * 0.005
+    max_area = h * w * 0.20
+    wx0, wy0, wx1, wy1 = window
+
+    fillable = 255 - barrier_mask[wy0:wy1, wx0:wx1]
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(fillable, connectivity=4)
+    del fillable
+
+    # Labels on the window edges that lie inside the page
+    edges = []
+    if wx0 > 0:
+        edges.append(labels[:, 0])
+    if wx1 < w:
+        edges.append(labels[:, -1])
+    if wy0 > 0:
+        edges.append(labels[0, :])
+    if wy1 < h:
+        edges.append(labels[-1, :])
+    leaking = np.unique(np.concatenate(edges)) if edges else np.zeros(0, np.int32)
+    leaking = set(leaking[leaking > 0].tolist())
+
+    regions = []
+    flood_mask = None
+    floods = 0
+    for i in range(1, num_labels):
+        if i in leaking:
+            py, px = np.argwhere(labels == i)[0]
+            px, py = int(px) + wx0, int(py) + wy0
+            if flood_mask is None:
+                flood_mask = np.zeros((h + 2, w + 2), np.uint8)
+            elif flood_mask[py + 1, px + 1]:
+                continue  # Joined to an earlier component outside the window
+            floods += 1
+            if floods > 255:
+                raise ValueError('too many components leave the changed window')
+            area, _, _, (x, y, rw, rh) = cv2.floodFill(
+                barrier_mask, flood_mask, (px, py), 0,
+                flags=4 | cv2.FLOODFILL_MASK_ONLY | (floods << 8))
+            if not min_area < area < max_area:
+                continue
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(w, x + rw + margin), min(h, y + rh + margin)
+            component_mask = (flood_mask[y0 + 1:y1 + 1, x0 + 1:x1 + 1] == floods).astype(np.uint8) * 255
+        else:
+            area = stats[i, cv2.CC_STAT_AREA]
+            if not min_area < area < max_area:
+                continue
+            x, y = int(stats[i, cv2.CC_STAT_LEFT]) + wx0, int(stats[i, cv2.CC_STAT_TOP]) + wy0
+            rw, rh = int(stats[i, cv2.CC_STAT_WIDTH]), int(stats[i, cv2.CC_STAT_HEIGHT])
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(w, x + rw + margin), min(h, y + rh + margin)
+            # The component lies inside the window, the margin may not
+            component_mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+            cx0, cy0 = max(x0, wx0), max(y0, wy0)
+            cx1, cy1 = min(x1, wx1), min(y1, wy1)
+            component_mask[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = (
+                labels[cy0 - wy0:cy1 - wy0, cx0 - wx0:cx1 - wx0] == i).astype(np.uint8) * 255
+        regions.append({
+            'label': None,
+            'bbox': (int(x), int(y), int(rw), int(rh)),
+            'offset': (x0, y0),
+            'mask': component_mask
+        })
+    return regions
+
+def incremental_regions(previous, meta, masks, barrier):
+    """
+    Units of a run whose previous state is (previous barrier, meta, masks)
+
+    A previous unit is kept as it was (polygon, id, region box and crop)
+    unless its region, flood-filled from its seed pixel on the previous
+    barrier, reaches into changed_window(): no pixel of it or next to it
+    changed, so neither did the region or the polygon drawn from it. Regions of the window are
+    recomputed with flood_fill_window() and keep the id of a previous unit
+    with the same box and polygon; new ones get ids above the previous maximum.
+
+    Returns (polygons sorted by id, report).
+    """
+    units = meta['units']
+    window = changed_window(previous, barrier)
+    h, w = barrier.shape
+
+    kept, touched = [], {}
+    flood_mask = None
+    floods = 0
+    for u, mask in zip(units, masks):
+        x, y, rw, rh = u['bbox']
+        reaches = (window is not None and x < window[2] and x + rw > window[0]
+                   and y < window[3] and y + rh > window[1])
+        if reaches:
+            if flood_mask is None or floods == 255:
+                flood_mask = np.zeros((h + 2, w + 2), np.uint8)
+                floods = 0
+            floods += 1
+            cv2.floodFill(previous, flood_mask, tuple(u['seed']), 0,
+                          flags=4 | cv2.FLOODFILL_MASK_ONLY | (floods << 8))
+            reaches = bool(np.any(flood_mask[window[1] + 1:window[3] + 1, window[0] + 1:window[2] + 1] == floods))
+        if reaches:
+            touched[(tuple(u['bbox']), json.dumps(u['polygon']))] = u['id']
         else:
-            pdf_numbers = [] # Fallback to empty
+            kept.append({
+                'id': u['id'],
+                'polygon': u['polygon'],
+                'region': {'label': None, 'bbox': tuple(u['bbox']), 'offset': (max(0, x - 8), max(0, y - 8)),
+                           'seed': tuple(u['seed']), 'mask': mask},
+                'apartment_number': None
+            })
+
+    new, matched = [], 0
+    if window is not None:
+        next_id = max([u['id'] for u in units] + [0]) + 1
+        for region in flood_fill_window(barrier, window):
+            poly = region_to_polygon(region)
+            if not poly or len(poly) < 3:
+                continue
+            unit_id = touched.pop((region['bbox'], json.dumps(poly)), None)
+            if unit_id is None:
+                unit_id, next_id = next_id, next_id + 1
+            else:
+                matched += 1
+            new.append({'id': unit_id, 'polygon': poly, 'region': region, 'apartment_number': None})
+
+    report = {
+        'window': list(window) if window else None,
+        'kept': len(kept),
+        'recomputed': len(new),
+        'new': len(new) - matched,
+        'removed': len(touched)
+    }
+    return sorted(kept + new, key=lambda p: p['id']), report
+
+def detect_apartments(source_path, target_path=None, enable_ocr=True, debug=False,
+                      page_number=0, source_doc=None, timings=None, cache=None, dpi=100,
+                      match_mode='labels', tile_height=None, ocr_mode='batch', ocr_workers=4,
+                      ocr_budget=60, registration='full', feature_backend='auto', profile=False,
+                      on_apartment=None, label_prefixes=None, area_suffixes=None, text_scope='page',
+                      previous_state=None, save_state=None, max_memory=None):
+    """
+    Main detection function
+
+    page_number selects the PDF page (0-based). source_doc may be an already
+    open fitz.Document for source_path so batch callers don't reopen it.
+    Per-stage wall times are accumulated into `timings` (a Timings) if given.
+    With a DetectionCache, every stage whose inputs are unchanged is loaded
+    instead of recomputed. match_mode 'labels' matches PDF labels through the
+    region crops; 'index' uses the geometric grid search only.
+    tile_height (pixels) builds the red-line mask band by band for PDF sources,
+    without ever holding the full-page raster (see build_barrier_tiled()).
+    ocr_mode 'batch' reads all unlabelled regions of the page in a few Tesseract
+    runs (ocr_prepared_batch()); 'single' runs Tesseract per region. Either way
+    the work runs on up to ocr_workers threads and stops after ocr_budget
+    seconds per page, keeping what was recognized so far.
+    registration 'full' matches features of the whole source and target;
+    'pyramid' estimates on downscaled copies and refines on full-resolution
+    patches (find_transformation_pyramid()). feature_backend picks the
+    detector from FEATURE_BACKENDS; 'auto' tries AUTO_BACKENDS in order until
+    one yields a well-supported homography. profile adds CPU time and peak RSS
+    to every stage in timings (see Timings).
+    on_apartment(apartment) receives each output record as soon as its polygon
+    and number are final: registration runs before the OCR fallback, PDF-labelled
+    units are passed on right after matching and OCR'd ones as Tesseract reads
+    them. It may be called from OCR threads. The returned list is unaffected.
+    dpi 'auto' picks the resolution per PDF page with choose_dpi() and reports
+    the choice as timings.reports['dpi'].
+    label_prefixes / area_suffixes replace the words of DEFAULT_VOCABULARY for
+    reading apartment numbers from PDF text and OCR output.
+    text_scope 'page' reads the whole page's text up front; 'regions' reads it
+    after the regions are found, only around their polygons (see
+    get_pdf_text_data()).
+    previous_state is the path of a state file written by an earlier run with
+    save_state (see save_detection_state()). When its barrier has the same
+    size, only the units near changed red lines are recomputed
+    (incremental_regions(), reported as timings.reports['incremental']):
+    the others keep their polygon and id, OCR reads are reused for units whose
+    pixels are unchanged, and the homography is reused for the same target.
+    Such runs bypass the polygon and OCR cache entries, whose ids would not
+    match; runs that only save a state may use them, as the region crops are
+    cached with the polygons.
+    max_memory (MB) keeps the run under that much resident memory with a
+    MemoryBudget: PDF renders are tiled, registered with the pyramid or
+    lowered in resolution before rendering, and registration or the OCR of the
+    largest unlabelled regions are skipped when their estimate does not fit
+    next to what is resident by then. The steps taken are reported as
+    timings.reports['memory']; it implies profile, so every stage shows its
+    peak RSS.
+    """
+    # Everything a detection needs is imported before the clock starts, so a
+    # missing package fails the run up front and imports stay out of the timings
+    load_dependencies('numpy', 'cv2')
+    if source_path.lower().endswith('.pdf') or (target_path or '').lower().endswith('.pdf'):
+        load_dependencies('fitz')
+
+    profile = profile or bool(max_memory)
+    if timings is None:
+        timings = Timings(profile)
+    elif profile:
+        timings.profile = True
+    started = timings.mark()
+    vocabulary = get_vocabulary(label_prefixes, area_suffixes)
+    previous = load_detection_state(previous_state) if previous_state and os.path.exists(previous_state) else None
 
     if debug:
-        debug_dir = f"debug_output_{int(time.time())}"
-        os.makedirs(debug_dir, exist_ok=True)
-        print(f"DEBUG: Created debug directory {debug_dir}")
-        cv2.imwrite(f"{debug_dir}/source.png", source_img)
-        
-        # Save extracted PDF numbers info
-        with open(f"{debug_dir}/pdf_text.json", 'w') as f:
-            json.dump(pdf_numbers, f, indent=2)
+        # Debug runs dump every intermediate image, so always compute them
+        cache = None
+
+    is_pdf = source_path.lower().endswith('.pdf')
+    source_session = None
+    source_page = None
+
+    def get_source_page():
+        # The PDF is opened at most once and shared by rendering and text extraction
+        nonlocal source_session, source_page
+        if source_page is None:
+            source_session = PdfSession(source_doc if source_doc is not None else source_path, timings)
+            source_page = source_session.page(page_number)
+        return source_page
+
+    try:
+        if cache is not None:
+            with timings.stage('cache_hash'):
+                source_key = cache.key('source', file_digest(source_path), page_number)
+
+        if dpi == 'auto':
+            # Images are used at their own resolution, dpi only matters for PDFs
+            dpi_report = None
+            if cache is not None:
+                dpi_key = cache.key(source_key, 'dpi', AUTO_DPI_MIN, AUTO_DPI_MAX, enable_ocr)
+                dpi_report = cache.load_json(dpi_key, 'dpi')
+            if dpi_report is None:
+                dpi_report = {'dpi': 100}
+                if is_pdf:
+                    with timings.stage('dpi'):
+                        dpi, details = choose_dpi(get_source_page(), ocr=enable_ocr)
+                    dpi_report = dict(details, dpi=dpi)
+                if cache is not None:
+                    cache.save_json(dpi_key, 'dpi', dpi_report)
+            dpi = dpi_report['dpi']
+            timings.report('dpi', dpi_report)
 
-    # Detect red lines and create barrier
-    red_mask = detect_red_lines(source_img)
-    barrier = clean_mask(red_mask, thickness=5)
+        budget = None
+        if max_memory:
+            budget = MemoryBudget(max_memory)
+            # Images are used at their own size, and debug dumps need the full raster
+            if is_pdf and not debug:
+                requested_dpi = dpi
+                first_backend = AUTO_BACKENDS[0] if feature_backend == 'auto' else feature_backend
+                dpi, tile_height, planned = budget.plan_render(get_source_page(), dpi, tile_height,
+                                                               registration if target_path else None, first_backend)
+                registration = planned or registration
+                if dpi != requested_dpi:
+                    # Output geometry is in pixels of the resolution actually rendered
+                    timings.report('dpi', dict(timings.reports.get('dpi', {}), dpi=dpi,
+                                               requested_dpi=requested_dpi, limited_by='max_memory'))
+
+        if cache is not None:
+            raster_key = cache.key(source_key, 'raster', dpi)
+
+        # Tiled PDF runs keep no full-page raster: the mask is built band by band and
+        # OCR crops are rendered on demand. Debug dumps need the full image.
+        tiled = bool(tile_height) and is_pdf and not debug
+
+        # Load source image
+        source_img = cache.load_array(raster_key, 'raster') if cache is not None and not tiled else None
+        if tiled:
+            source_img = PageRaster(get_source_page(), dpi)
+        elif source_img is None:
+            if is_pdf:
+                source_img = get_source_page().render(dpi)
+            else:
+                with timings.stage('render'):
+                    source_img = cv2.imread(source_path)
+            if source_img is not None and cache is not None:
+                cache.save_array(raster_key, 'raster', source_img)
     
-    if debug:
-        cv2.imwrite(f"{debug_dir}/red_mask.png", red_mask)
-        cv2.imwrite(f"{debug_dir}/barrier.png", barrier)
+        if source_img is None:
+            raise ValueError(f"Could not load source image: {source_path}")
+    
+        source_h, source_w = source_img.shape[:2]
     
-    # Find apartment regions using flood fill
-    regions = flood_fill_apartments(source_img, barrier)
+        def read_pdf_numbers(base_key, near_polygons=None):
+            # Try to extract text from PDF directly
+            pdf_numbers = None
+            if cache is not None:
+                numbers_key = cache.key(base_key, 'numbers', source_w, source_h, vocabulary.key)
+                pdf_numbers = cache.load_json(numbers_key, 'numbers')
+                if pdf_numbers is not None:
+                    for num_data in pdf_numbers:
+                        num_data['center'] = tuple(num_data['center'])
 
-    if debug:
-        # Visualize regions
-        regions_vis = source_img.copy()
-        for i, region in enumerate(regions):
-            color = np.random.randint(0, 255, (3,)).tolist()
-            regions_vis[region > 0] = color
-        cv2.imwrite(f"{debug_dir}/regions.png", regions_vis)
-
-    # Convert regions to polygons and match text
-    # Convert regions to polygons and match text
-    apartments_data = []
-    
-    # Pre-calculate polygons and valid regions
-    polygons = []
-    for i, region in enumerate(regions):
-        poly = region_to_polygon(region)
-        if poly and len(poly) >= 3:
-            polygons.append({
-                'id': i + 1,
-                'polygon': poly,
-                'region': region,
-                'apartment_number': None
-            })
-            
-    # Global Matching Strategy
-    # 1. Collect all potential matches (polygon_idx, number_idx, distance, text_val)
-    all_matches = []
+            if pdf_numbers is None:
+                pdf_numbers = get_pdf_text_data(get_source_page(), source_w, source_h, vocabulary=vocabulary,
+                                                near_polygons=near_polygons)
+                if pdf_numbers is not None and cache is not None:
+                    cache.save_json(numbers_key, 'numbers', pdf_numbers)
+
+            if debug:
+                # Save extracted PDF numbers info
+                with open(f"{debug_dir}/pdf_text.json", 'w') as f:
+                    json.dump(pdf_numbers, f, indent=2)
+            return pdf_numbers or []
+
+        if debug:
+            debug_dir = f"debug_output_{int(time.time())}"
+            if page_number:
+                debug_dir += f"_p{page_number + 1}"
+            os.makedirs(debug_dir, exist_ok=True)
+            print(f"DEBUG: Created debug directory {debug_dir}")
+            cv2.imwrite(f"{debug_dir}/source.png", source_img)
+
+        pdf_numbers = []
+        read_text = is_pdf and enable_ocr
+        if read_text and text_scope == 'page':
+            pdf_numbers = read_pdf_numbers(source_key if cache is not None else None)
+
+        # Detect red lines and create barrier
+        barrier = None
+        if cache is not None:
+            mask_key = cache.key(raster_key, 'barrier', 5)
+            barrier = cache.load_mask(mask_key, 'barrier')
+
+        if barrier is None:
+            if tiled:
+                barrier = build_barrier_tiled(get_source_page(), dpi, tile_height, thickness=5, timings=timings)
+            else:
+                with timings.stage('red_lines'):
+                    barrier = red_barrier(source_img, thickness=5)
+            if cache is not None:
+                cache.save_mask(mask_key, 'barrier', barrier)
     
-    if pdf_numbers:
-        for i, poly_data in enumerate(polygons):
-            poly_pts = np.array(poly_data['polygon'])
-            
-            for j, num_data in enumerate(pdf_numbers):
-                pt = num_data['center']
-                dist = cv2.pointPolygonTest(poly_pts, pt, False)
-                
-                # Check strict inclusion or proximity (e.g., within 50px)
-                # Prioritize: dist >= 0 (inside) > dist < 0 (outside)
-                
-                if dist >= -100: # Broad proximity search
-                     all_matches.append({
-                         'poly_idx': i,
-                         'num_idx': j,
-                         'dist': dist,
-                         'text': num_data['number']
-                     })
-                     
-    # 2. Sort matches
-    # Primary key: dist (descending). Positive (inside) > Negative (outside close)
-    all_matches.sort(key=lambda x: x['dist'], reverse=True)
+        if debug:
+            # The closed red-line mask the barrier is dilated from (see red_barrier())
+            cv2.imwrite(f"{debug_dir}/red_mask.png", detect_red_lines(source_img))
+            cv2.imwrite(f"{debug_dir}/barrier.png", barrier)
     
-    # 3. Assign uniquely
-    assigned_polygons = set()
-    assigned_numbers = set()
+        if previous is not None and previous[0].shape != barrier.shape:
+            # Different page size or DPI: nothing lines up, run in full
+            previous = None
+
+        # Region polygons only depend on the barrier mask
+        polygons = None
+        if cache is not None:
+            polygons_key = cache.key(mask_key, 'polygons')
+            # Units of a previous state keep their own ids
+            cached = crops = None
+            if previous is None:
+                cached = cache.load_json(polygons_key, 'polygons')
+                crops = cache.load_masks(polygons_key, 'crops') if cached is not None else None
+            if crops is not None and len(crops) == len(cached):
+                polygons = [{
+                    'id': p['id'],
+                    'polygon': p['polygon'],
+                    'region': {'label': p['label'], 'bbox': tuple(p['bbox']), 'offset': tuple(p['offset']),
+                               'mask': crop},
+                    'apartment_number': None
+                } for p, crop in zip(cached, crops)]
+
+        incremental = None
+        if polygons is None and previous is not None:
+            with timings.stage('regions'):
+                polygons, incremental = incremental_regions(*previous, barrier)
+            timings.report('incremental', incremental)
+
+        if polygons is None:
+            # Find apartment regions using flood fill
+            with timings.stage('regions'):
+                regions = flood_fill_apartments(source_img, barrier)
+
+            if debug:
+                # Visualize regions
+                regions_vis = source_img.copy()
+                for i, region in enumerate(regions):
+                    color = np.random.randint(0, 255, (3,)).tolist()
+                    paint_region(regions_vis, region, color)
+                cv2.imwrite(f"{debug_dir}/regions.png", regions_vis)
+
+            # Pre-calculate polygons and valid regions
+            with timings.stage('polygons'):
+                polygons = []
+                for i, region in enumerate(regions):
+                    poly = region_to_polygon(region)
+                    if poly and len(poly) >= 3:
+                        polygons.append({
+                            'id': i + 1,
+                            'polygon': poly,
+                            'region': region,
+                            'apartment_number': None
+                        })
+
+            if cache is not None:
+                cache.save_json(polygons_key, 'polygons', [{
+                    'id': p['id'],
+                    'polygon': p['polygon'],
+                    'label': p['region']['label'],
+                    'bbox': p['region']['bbox'],
+                    'offset': p['region']['offset']
+                } for p in polygons])
+                cache.save_masks(polygons_key, 'crops', [p['region']['mask'] for p in polygons])
+
+        if read_text and text_scope == 'regions':
+            # The clip depends on the polygons, so numbers are cached under them
+            pdf_numbers = read_pdf_numbers(polygons_key if cache is not None else None,
+                                           [p['polygon'] for p in polygons])
+
+        # Global Matching Strategy (see match_numbers_to_polygons)
+        with timings.stage('matching'):
+            if match_mode == 'labels':
+                assigned_polygons = match_numbers_by_labels(polygons, pdf_numbers, debug=debug)
+            else:
+                assigned_polygons = match_numbers_to_polygons(polygons, pdf_numbers, debug=debug)
+
+        # Register against the target before the OCR fallback, so apartments are
+        # final (and can be streamed) as soon as their number is known
+        H = None
+        target_w, target_h = None, None
     
-    for match in all_matches:
-        p_idx = match['poly_idx']
-        n_idx = match['num_idx']
-        
-        if p_idx in assigned_polygons or n_idx in assigned_numbers:
-            continue
+        if target_path:
+            # Target size, descriptors and FLANN index are cached by the target's
+            # content hash: floors aligned to the same render only pay for the
+            # source side, and full registration does not even read the target
+            target_key = None
+            target_size = None
+            target_digest = None
+            if cache is not None or previous is not None or save_state:
+                with timings.stage('cache_hash'):
+                    target_digest = file_digest(target_path)
+            if cache is not None:
+                target_key = cache.key('target', target_digest)
+                target_size = cache.load_json(target_key, 'target_size')
+
+            # Red-line edits do not move the plan on the page, so the previous
+            # run's alignment to the same target still holds
+            prior_H = None
+            if previous is not None:
+                prior = previous[1].get('registration')
+                if prior and prior['target'] == target_digest and prior['settings'] == [registration, feature_backend]:
+                    prior_H = np.array(prior['H'])
+                    target_size = target_size or prior['size']
+
+            target_state = {}
+
+            def get_target_img():
+                if 'image' not in target_state:
+                    if target_path.lower().endswith('.pdf'):
+                        with PdfSession(target_path, timings) as target_session:
+                            target_state['image'] = target_session.page(0).render()
+                    else:
+                        with timings.stage('render'):
+                            target_state['image'] = cv2.imread(target_path)
+                return target_state['image']
+
+            if target_size is None and get_target_img() is not None:
+                target_size = list(get_target_img().shape[:2])
+                if cache is not None:
+                    cache.save_json(target_key, 'target_size', target_size)
             
-        # Assign
-        polygons[p_idx]['apartment_number'] = match['text']
-        assigned_polygons.add(p_idx)
-        assigned_numbers.add(n_idx)
-        
-        if debug:
-            print(f"DEBUG: Assigned {match['text']} to Polygon {polygons[p_idx]['id']} (dist={match['dist']:.2f})")
+            if target_size is not None:
+                 target_h, target_w = target_size
 
-    # 4. Fallback to OCR for unassigned polygons
-    for i, poly_data in enumerate(polygons):
-        if i in assigned_polygons:
-            continue
+                 backends = AUTO_BACKENDS if feature_backend == 'auto' else [feature_backend]
+
+                 # A run over its memory budget is better returned in source
+                 # coordinates than killed half way. Only the first backend is
+                 # checked here, fallbacks are checked before they run.
+                 registration_skipped = False
+                 if budget is not None and prior_H is None:
+                     if tiled:
+                         registration_w, registration_h = get_source_page().pixel_size(min(dpi, 100))
+                     else:
+                         registration_w, registration_h = source_w, source_h
+                     needed = registration_memory_mb(registration, backends[0], registration_w * registration_h,
+                                                     target_w * target_h)
+                     if not budget.fits(needed) and registration == 'full':
+                         pyramid = registration_memory_mb('pyramid', backends[0], 0, target_w * target_h)
+                         if budget.fits(pyramid):
+                             budget.degrade('registration', 'pyramid', needed)
+                             registration, needed = 'pyramid', pyramid
+                     if not budget.fits(needed):
+                         budget.degrade('registration', 'skip_registration', needed)
+                         registration_skipped = True
+
+                 # Tiled runs register a 100 DPI render and scale the homography
+                 # back up to source pixels
+                 registration_img = source_img
+                 registration_scale = 1.0
+                 if tiled and prior_H is None and not registration_skipped:
+                     registration_dpi = min(dpi, 100)
+                     registration_img = get_source_page().render(registration_dpi)
+                     registration_scale = registration_dpi / dpi
+                 registration_stats = {'mode': registration, 'attempts': []}
+                 if prior_H is not None:
+                     H = prior_H
+                     registration_stats['reused'] = True
+                     backends = []
+                 if registration_skipped:
+                     registration_stats['skipped'] = 'max_memory'
+                     backends = []
+
+                 with timings.stage('registration'):
+                     source_coarse = None
+
+                     # Fast backends first; the next one only runs when the
+                     # previous match was not well supported
+                     for backend in backends:
+                         attempt = {'backend': backend}
+                         registration_stats['attempts'].append(attempt)
+                         mode = registration
+                         if budget is not None and backend != backends[0]:
+                             # A fallback steps down like the first backend did;
+                             # the decoded target is already resident
+                             needed = registration_memory_mb(mode, backend,
+                                                             max(registration_w * registration_h, target_w * target_h))
+                             pyramid = registration_memory_mb('pyramid', backend, 0)
+                             if not budget.fits(needed) and mode == 'full' and budget.fits(pyramid):
+                                 budget.degrade('registration', 'pyramid', needed, backend=backend)
+                                 mode = attempt['mode'] = 'pyramid'
+                             elif not budget.fits(needed):
+                                 budget.degrade('registration', 'skip_backend', needed, backend=backend)
+                                 attempt['skipped'] = 'max_memory'
+                                 continue
+                         if mode == 'pyramid' and source_coarse is None:
+                             source_coarse = coarse_registration_level(
+                                 source_img, PYRAMID_COARSE_SIDE,
+                                 (registration_img, np.diag([registration_scale, registration_scale, 1.0])) if tiled else None
+                             )
+                         if mode == 'pyramid':
+                             features_name = f'{backend}_{PYRAMID_COARSE_SIDE}_{PYRAMID_MAX_KEYPOINTS}'
+                         else:
+                             features_name = backend
+
+                         source_features = None
+                         if cache is not None:
+                             features_key = cache.key(cache.key(source_key, 'raster', round(dpi * registration_scale)), features_name)
+                             source_features = cache.load_features(features_key, backend)
+
+                         if source_features is None:
+                             if mode == 'pyramid':
+                                 source_features = compute_features(source_coarse[0], PYRAMID_MAX_KEYPOINTS, backend)
+                             else:
+                                 source_features = compute_features(registration_img, backend=backend)
+                             if cache is not None:
+                                 cache.save_features(features_key, backend, source_features)
+
+                         target_features = None
+                         target_index = None
+                         if cache is not None:
+                             target_features_key = cache.key(target_key, features_name)
+                             target_features = cache.load_features(target_features_key, f'target_{backend}')
+                         if target_features is None:
+                             if mode == 'pyramid':
+                                 target_small, _ = downscale_for_registration(get_target_img(), PYRAMID_COARSE_SIDE)
+                                 target_features = compute_features(target_small, PYRAMID_MAX_KEYPOINTS, backend)
+                                 target_small = None
+                             else:
+                                 target_features = compute_features(get_target_img(), backend=backend)
+                             if cache is not None:
+                                 cache.save_features(target_features_key, f'target_{backend}', target_features)
+
+                         if mode == 'pyramid':
+                             H = find_transformation_pyramid(
+                                 source_img, get_target_img(),
+                                 coarse_side=PYRAMID_COARSE_SIDE,
+                                 max_keypoints=PYRAMID_MAX_KEYPOINTS,
+                                 source_coarse=source_coarse,
+                                 source_features=source_features,
+                                 target_features=target_features,
+                                 stats=attempt,
+                                 backend=backend,
+                                 max_window_pixels=budget.feature_pixels(backend) if budget is not None else None
+                             )
+                         else:
+                             lsh = FEATURE_BACKENDS[backend][1]['algorithm'] == FLANN_INDEX_LSH
+                             if cache is not None and target_features[1] is not None and len(target_features[1]) >= 2:
+                                 # flann_Index.load() does not restore LSH tables
+                                 # exactly, and they are quick to build: only
+                                 # KD-trees come from the cache
+                                 target_index = None if lsh else cache.load_flann_index(
+                                     target_features_key, f'target_{backend}_index', target_features[1], backend)
+                                 if target_index is None:
+                                     target_index = build_flann_index(target_features[1], backend)
+                                     if not lsh:
+                                         cache.save_flann_index(target_features_key, f'target_{backend}_index',
+                                                                target_index)
+                             H = find_transformation(registration_img, None, source_features=source_features,
+                                                     target_features=target_features, stats=attempt,
+                                                     backend=backend, target_index=target_index)
+                             if H is not None and registration_scale != 1.0:
+                                 H = H @ np.diag([registration_scale, registration_scale, 1.0])
+                         if H is not None and not homography_is_plausible(H, (source_w, source_h), (target_w, target_h)):
+                             attempt['rejected'] = 'implausible homography'
+                             H = None
+                         if H is not None:
+                             registration_stats['backend'] = backend
+                             break
+                     source_coarse = None
+                 registration_img = None
+                 target_state.clear()
+                 registration_stats['success'] = H is not None
+                 timings.report('registration', registration_stats)
+
+        # Output records are built once per apartment, when it becomes final
+        finalized = {}
+        finalize_lock = threading.Lock()
+
+        def finalize(apts):
+            with finalize_lock:
+                apts = [apt for apt in apts if apt['id'] not in finalized]
+                records = format_apartments(apts, source_w, source_h, H, target_w, target_h, debug)
+                for record in records:
+                    finalized[record['id']] = record
+            if on_apartment is not None:
+                for record in records:
+                    on_apartment(record)
+
+        if on_apartment is not None:
+            finalize([poly_data for i, poly_data in enumerate(polygons) if i in assigned_polygons or not enable_ocr])
+
+        # 4. Fallback to OCR for unassigned polygons
+        ocr_results = {}
+        ocr_dirty = False
+        ocr_cache = cache is not None and previous is None
+        if ocr_cache and enable_ocr and len(assigned_polygons) < len(polygons):
+            # Misses are kept too, so a read in the other mode is a new entry
+            ocr_key = cache.key(polygons_key, 'ocr', vocabulary.key, ocr_mode)
+            ocr_results = cache.load_json(ocr_key, 'ocr') or {}
+
+        with timings.stage('ocr'):
+            # Pixels each OCR read came from, to tell whether a state's read still holds
+            digests = {}
+            if enable_ocr and (previous is not None or save_state):
+                digests = {
+                    str(poly_data['id']): region_digest(source_img, poly_data['region']['bbox'])
+                    for i, poly_data in enumerate(polygons) if i not in assigned_polygons
+                }
+            # Misses of the other OCR mode are retried, like in the cache
+            if (previous is not None and previous[1].get('vocabulary') == vocabulary.key
+                    and previous[1].get('ocr_mode') == ocr_mode):
+                prior_ocr = previous[1].get('ocr', {})
+                reused = [ocr_id for ocr_id, digest in digests.items()
+                          if ocr_id in prior_ocr and prior_ocr[ocr_id]['digest'] == digest]
+                for ocr_id in reused:
+                    ocr_results[ocr_id] = prior_ocr[ocr_id]['number']
+                if incremental is not None:
+                    incremental['ocr_reused'] = len(reused)
+
+            # Cached misses (None) are reused too, Tesseract would not do better
+            pending = [
+                (str(poly_data['id']), poly_data) for i, poly_data in enumerate(polygons)
+                if enable_ocr and i not in assigned_polygons and str(poly_data['id']) not in ocr_results
+            ]
+            if pending and budget is not None:
+                needed = ocr_memory_mb([poly_data['region'] for _, poly_data in pending])
+                available = budget.available_mb()
+                if needed > available:
+                    # Largest regions are dropped first, so most units still get a number
+                    kept, total = set(), 0
+                    for ocr_id, poly_data in sorted(pending, key=lambda item: ocr_memory_mb([item[1]['region']])):
+                        total += ocr_memory_mb([poly_data['region']])
+                        if total > available:
+                            break
+                        kept.add(ocr_id)
+                    budget.degrade('ocr', 'skip_ocr', needed, regions=len(pending), skipped=len(pending) - len(kept))
+                    pending = [item for item in pending if item[0] in kept]
+
+            if debug:
+                for _, poly_data in pending:
+                    print(f"DEBUG: No PDF text match for Polygon {poly_data['id']}. Attempting OCR...")
+
+            if pending:
+                pending_by_id = dict(pending)
+
+                # Streams each OCR'd apartment as soon as its number is read
+                def finalize_ocr(ocr_id, apt_num):
+                    pending_by_id[ocr_id]['apartment_number'] = apt_num
+                    finalize([pending_by_id[ocr_id]])
+
+                found, ocr_report = run_ocr_fallback(
+                    source_img,
+                    [(ocr_id, poly_data['region']) for ocr_id, poly_data in pending],
+                    mode=ocr_mode,
+                    workers=ocr_workers,
+                    budget=ocr_budget,
+                    on_result=finalize_ocr if on_apartment is not None else None,
+                    vocabulary=vocabulary
+                )
+                timings.report('ocr', ocr_report)
+                # A timed-out run is partial, don't let the cache remember its misses
+                for ocr_id, _ in pending:
+                    if ocr_id in found or not ocr_report['timed_out']:
+                        ocr_results[ocr_id] = found.get(ocr_id)
+            ocr_dirty = bool(pending)
+
+            for i, poly_data in enumerate(polygons):
+                if i in assigned_polygons:
+                    continue
             
-        if enable_ocr:
-             if debug:
-                 print(f"DEBUG: No PDF text match for Polygon {poly_data['id']}. Attempting OCR...")
-             
-             apt_num = extract_apartment_number_ocr(source_img, poly_data['region'])
-             if apt_num:
-                 poly_data['apartment_number'] = apt_num
-                 if debug:
-                     print(f"DEBUG: OCR result for Polygon {poly_data['id']}: {apt_num}")
-    
-    # Finalize data structure
-    apartments_data = polygons
-
-    # Visualize results if debug
-    # Visualize aggregated results if debug
-    if debug:
-        final_debug_img = source_img.copy()
+                if enable_ocr:
+                     apt_num = ocr_results.get(str(poly_data['id']))
+                     if apt_num:
+                         poly_data['apartment_number'] = apt_num
+                         if debug:
+                             print(f"DEBUG: OCR result for Polygon {poly_data['id']}: {apt_num}")
+    
+        if ocr_cache and ocr_dirty:
+            cache.save_json(ocr_key, 'ocr', ocr_results)
+
+        if save_state:
+            save_detection_state(save_state, barrier, {
+                'version': STATE_VERSION,
+                'dpi': dpi,
+                'vocabulary': vocabulary.key,
+                'ocr_mode': ocr_mode,
+                'units': [{
+                    'id': p['id'],
+                    'polygon': p['polygon'],
+                    'bbox': list(p['region']['bbox']),
+                    'seed': [int(v) for v in region_seed(p['region'])]
+                } for p in polygons],
+                # Misses of a timed-out OCR run are left out, like in the cache
+                'ocr': {ocr_id: {'number': ocr_results[ocr_id], 'digest': digest}
+                        for ocr_id, digest in digests.items() if ocr_id in ocr_results},
+                'registration': {
+                    'target': target_digest,
+                    'settings': [registration, feature_backend],
+                    'size': [target_h, target_w],
+                    'H': H.tolist()
+                } if H is not None else None
+            }, [p['region']['mask'] for p in polygons])
+
+        # Finalize data structure
+        apartments_data = polygons
+
+        # Visualize results if debug
+        # Visualize aggregated results if debug
+        if debug:
+            final_debug_img = source_img.copy()
         
-        for apt in apartments_data:
-            # Draw polygon
-            poly = apt['polygon']
-            pts = np.array(poly, np.int32)
-            pts = pts.reshape((-1, 1, 2))
+            for apt in apartments_data:
+                # Draw polygon
+                poly = apt['polygon']
+                pts = np.array(poly, np.int32)
+                pts = pts.reshape((-1, 1, 2))
             
-            # Use random color or consistent green
-            cv2.polylines(final_debug_img, [pts], True, (0, 255, 0), 3)
+                # Use random color or consistent green
+                cv2.polylines(final_debug_img, [pts], True, (0, 255, 0), 3)
             
-            # Label
-            if apt['apartment_number']:
-                # Calculate centroid for label
-                M = cv2.moments(pts)
-                if M["m00"] != 0:
-                    cx = int(M["m10"] / M["m00"])
-                    cy = int(M["m01"] / M["m00"])
+                # Label
+                if apt['apartment_number']:
+                    # Calculate centroid for label
+                    M = cv2.moments(pts)
+                    if M["m00"] != 0:
+                        cx = int(M["m10"] / M["m00"])
+                        cy = int(M["m01"] / M["m00"])
                     
-                    # Draw background box for text
-                    text = str(apt['apartment_number'])
-                    (w, h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
-                    cv2.rectangle(final_debug_img, (cx - w//2 - 5, cy - h//2 - 5), (cx + w//2 + 5, cy + h//2 + 5), (0, 0, 0), -1)
-                    cv2.putText(final_debug_img, text, (cx - w//2, cy + h//2), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+                        # Draw background box for text
+                        text = str(apt['apartment_number'])
+                        (w, h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
+                        cv2.rectangle(final_debug_img, (cx - w//2 - 5, cy - h//2 - 5), (cx + w//2 + 5, cy + h//2 + 5), (0, 0, 0), -1)
+                        cv2.putText(final_debug_img, text, (cx - w//2, cy + h//2), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
         
-        cv2.imwrite(f"{debug_dir}/final_detection.png", final_debug_img)
-        print(f"DEBUG: Saved final combined visualization to {debug_dir}/final_detection.png")
+            cv2.imwrite(f"{debug_dir}/final_detection.png", final_debug_img)
+            print(f"DEBUG: Saved final combined visualization to {debug_dir}/final_detection.png")
             
-    # Result formatting (Target Image Mapping logic preserved)
-    # ... Same as before but cleaner ...
+        with timings.stage('output'):
+            finalize(apartments_data)
+            final_result = [finalized[apt['id']] for apt in apartments_data]
+    finally:
+        # Also on errors, so a --serve or --job-worker process does not keep
+        # failed documents open
+        if source_session is not None:
+            source_session.close()
 
-    final_result = []
-    
-    H = None
-    target_w, target_h = None, None
-    
-    if target_path:
-        if target_path.lower().endswith('.pdf'):
-            target_img = pdf_to_image(target_path)
+    if cache is not None:
+        cache.evict()
+
+    if budget is not None:
+        timings.report('memory', budget.report(timings))
+
+    timings.add_since('total', started)
+
+    return final_result, source_w, source_h, target_w, target_h
+
+def build_result(apartments, src_w, src_h, tgt_w, tgt_h, timings=None, cache=None):
+    """Wrap detect_apartments() output in the JSON document the controller expects"""
+    result = {
+        'success': True,
+        'apartment_count': len(apartments),
+        'source_dimensions': {'width': src_w, 'height': src_h},
+        'target_dimensions': {'width': tgt_w, 'height': tgt_h} if tgt_w else None,
+        'apartments': apartments
+    }
+    if timings is not None:
+        result['timings'] = timings.to_dict()
+        result.update(timings.reports)
+    if cache is not None:
+        result['cache'] = cache.stats()
+    return result
+
+class MetricsSink:
+    """
+    Publishes the stage timings of each result for monitoring
+
+    textfile is rewritten atomically with Prometheus gauges of the latest run
+    (for node_exporter's textfile collector); statsd is a "host:port" that gets
+    one UDP packet of StatsD timers/gauges per result. Page batches are labelled
+    (Prometheus) or prefixed (StatsD) per page. Wall time is always available,
+    CPU time and peak RSS with --profile.
+    """
+
+    FIELDS = [
+        # (timings key, Prometheus metric, unit scale, StatsD suffix, StatsD type)
+        ('wall_ms', 'stage_wall_seconds', 0.001, 'wall', 'ms'),
+        ('cpu_ms', 'stage_cpu_seconds', 0.001, 'cpu', 'ms'),
+        ('child_cpu_ms', 'stage_child_cpu_seconds', 0.001, 'child_cpu', 'ms'),
+        ('peak_rss_mb', 'stage_peak_rss_bytes', 1024 * 1024, 'peak_rss_mb', 'g'),
+    ]
+
+    def __init__(self, textfile=None, statsd=None, prefix='detect_apartments'):
+        self.textfile = textfile
+        self.prefix = prefix
+        self.statsd = None
+        if statsd:
+            host, _, port = statsd.rpartition(':')
+            self.statsd = (host or '127.0.0.1', int(port))
+
+    @staticmethod
+    def samples(result):
+        """(page or None, stage, {field: value}) for every stage of a result"""
+        if 'pages' in result:
+            timed = [(page.get('page'), page.get('timings', {})) for page in result['pages']]
         else:
-            target_img = cv2.imread(target_path)
-            
-        if target_img is not None:
-             target_h, target_w = target_img.shape[:2]
-             H = find_transformation(source_img, target_img)
+            timed = [(None, result.get('timings', {}))]
+        for page, stages in timed:
+            for stage, value in stages.items():
+                yield page, stage, value if isinstance(value, dict) else {'wall_ms': value}
 
-    for apt in apartments_data:
-        # Source coords percentage
-        src_poly_pct = [[p[0] / source_w * 100, p[1] / source_h * 100] for p in apt['polygon']]
-        
-        # Decide output based on transformation availability
-        if H is not None and target_w is not None:
-             # Transform to target
-             trans_poly = transform_polygon(apt['polygon'], H)
-             if trans_poly:
-                 final_poly_pct = [[p[0] / target_w * 100, p[1] / target_h * 100] for p in trans_poly]
-                 
-                 # Validate coordinates are within reasonable bounds
-                 # Allow slight overscan (-10% to 110%) to account for crop/bleed
-                 is_valid = all(
-                     -10 <= p[0] <= 110 and -10 <= p[1] <= 110
-                     for p in final_poly_pct
-                 )
-                 
-                 if is_valid:
-                     final_result.append({
-                         'id': apt['id'],
-                         'polygon': final_poly_pct,
-                         'apartment_number': apt.get('apartment_number')
-                     })
-                 else:
-                     # Invalid transform result - probably bad match
-                     if debug:
-                         print(f"DEBUG: Transform produced invalid coords for apt {apt['id']}, using source pct fallback")
-                     
-                     final_result.append({
-                         'id': apt['id'],
-                         'polygon': src_poly_pct,
-                         'apartment_number': apt.get('apartment_number')
-                     })
-             else:
-                 # Transform return None
-                 if debug:
-                     print(f"DEBUG: Transform failed for apt {apt['id']}, using source pct fallback")
-                     
-                 final_result.append({
-                     'id': apt['id'],
-                     'polygon': src_poly_pct,
-                     'apartment_number': apt.get('apartment_number')
-                 })
+    def emit(self, result):
+        samples = list(self.samples(result))
+        if not samples:
+            return
+        if self.textfile:
+            self.write_textfile(samples)
+        if self.statsd:
+            self.send_statsd(samples)
+
+    def write_textfile(self, samples):
+        lines = []
+        for field, metric, scale, _, _ in self.FIELDS:
+            rows = [(page, stage, values[field]) for page, stage, values in samples if values.get(field) is not None]
+            if not rows:
+                continue
+            name = f"{self.prefix}_{metric}"
+            lines.append(f"# TYPE {name} gauge")
+            for page, stage, value in rows:
+                labels = f'stage="{stage}"' + (f',page="{page}"' if page is not None else '')
+                lines.append(f"{name}{{{labels}}} {value * scale:g}")
+        tmp = f"{self.textfile}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp, self.textfile)
+        except OSError as e:
+            sys.stderr.write(f"Metrics textfile write failed: {e}\n")
+
+    def send_statsd(self, samples):
+        import socket
+
+        lines = []
+        for page, stage, values in samples:
+            base = f"{self.prefix}.{stage}" if page is None else f"{self.prefix}.page{page}.{stage}"
+            for field, _, _, suffix, kind in self.FIELDS:
+                if values.get(field) is not None:
+                    lines.append(f"{base}.{suffix}:{values[field]:g}|{kind}")
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                # Keep packets under a typical MTU
+                packet = []
+                for line in lines + [None]:
+                    if packet and (line is None or sum(len(l) + 1 for l in packet) + len(line) > 1400):
+                        sock.sendto('\n'.join(packet).encode('utf-8'), self.statsd)
+                        packet = []
+                    if line is not None:
+                        packet.append(line)
+        except OSError as e:
+            sys.stderr.write(f"StatsD send failed: {e}\n")
+
+def parse_page_spec(spec, page_count):
+    """Turn a 1-based page spec ("all", "3", "1-4,7") into sorted 0-based indices"""
+    if spec is None or str(spec).strip().lower() in ('', 'all'):
+        return list(range(page_count))
+
+    pages = set()
+    for part in str(spec).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else page_count
         else:
-             # No H matrix
-             final_result.append({
-                 'id': apt['id'],
-                 'polygon': src_poly_pct,
-                 'apartment_number': apt.get('apartment_number')
-             })
-             
-    return final_result, source_w, source_h, target_w, target_h
+            start = end = int(part)
+        if start < 1 or end > page_count or start > end:
+            raise ValueError(f"Invalid page range '{part}' for a {page_count}-page PDF")
+        pages.update(range(start - 1, end))
+    return sorted(pages)
+
+def _page_worker_init(source_path):
+    """Pool initializer for page batches: open the source PDF once per worker"""
+    sys.stdout = sys.stderr
+    _worker_state['doc'] = fitz.open(source_path)
+
+def _page_worker_detect(source_path, page_number, target_path, enable_ocr, cache=None, options=None,
+                        on_stage=None, on_apartment=None):
+    """Detect apartments on one page, using the worker's open document if any"""
+    timings = Timings(on_stage=on_stage)
+    if cache is not None:
+        cache = cache.for_request()
+    try:
+        apartments, src_w, src_h, tgt_w, tgt_h = detect_apartments(
+            source_path,
+            target_path,
+            enable_ocr=enable_ocr,
+            page_number=page_number,
+            source_doc=_worker_state.get('doc'),
+            timings=timings,
+            cache=cache,
+            on_apartment=on_apartment,
+            **(options or {})
+        )
+        result = build_result(apartments, src_w, src_h, tgt_w, tgt_h, timings, cache)
+    except Exception as e:
+        result = error_result(e)
+
+    result['page'] = page_number + 1
+    return result
+
+def _page_worker_task(args):
+    """imap() entry point for _page_worker_detect()"""
+    return _page_worker_detect(*args)
+
+def detect_apartments_pages(source_path, pages=None, target_path=None, enable_ocr=True, workers=None,
+                            cache=None, options=None, progress=None, on_apartment=None):
+    """
+    Detect apartments on several pages of one PDF
+
+    pages is a page spec for parse_page_spec() (default: every page). Pages are
+    processed in parallel on up to `workers` processes (default: CPU count), each
+    opening the document once. `options` are extra detect_apartments() keyword
+    arguments. Returns one result dict per page, in page order, each carrying
+    its 1-based 'page' number. progress(stage, page_index, page_count) is
+    called as stages start; only in-process (workers == 1) runs report it.
+    on_apartment(apartment, page) streams the output records: in-process as
+    each apartment is final (see detect_apartments()), otherwise per page as
+    soon as that page is done.
+    """
+    with fitz.open(source_path) as doc:
+        page_numbers = parse_page_spec(pages, len(doc))
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(page_numbers)))
+
+        if workers == 1:
+            _worker_state['doc'] = doc
+            try:
+                results = []
+                for i, n in enumerate(page_numbers):
+                    on_stage = None
+                    if progress is not None:
+                        on_stage = lambda name, i=i: progress(name, i, len(page_numbers))
+                    on_page_apartment = None
+                    if on_apartment is not None:
+                        on_page_apartment = lambda apt, n=n: on_apartment(apt, n + 1)
+                    results.append(_page_worker_detect(source_path, n, target_path, enable_ocr, cache, options,
+                                                       on_stage, on_page_apartment))
+                return results
+            finally:
+                _worker_state.pop('doc', None)
+
+    import multiprocessing
+
+    tasks = [(source_path, n, target_path, enable_ocr, cache, options) for n in page_numbers]
+    with multiprocessing.Pool(processes=workers, initializer=_page_worker_init, initargs=(source_path,)) as pool:
+        if on_apartment is None:
+            return pool.starmap(_page_worker_detect, tasks, chunksize=1)
+
+        results = []
+        for result in pool.imap_unordered(_page_worker_task, tasks, chunksize=1):
+            for apt in result.get('apartments', []):
+                on_apartment(apt, result['page'])
+            results.append(result)
+        return sorted(results, key=lambda result: result['page'])
+
+def build_pages_result(page_results):
+    """Wrap detect_apartments_pages() output in the multi-page JSON document"""
+    return {
+        'success': all(page.get('success') for page in page_results),
+        'page_count': len(page_results),
+        'apartment_count': sum(page.get('apartment_count', 0) for page in page_results),
+        'pages': page_results
+    }
+
+class NdjsonWriter:
+    """
+    Streaming output: one compact JSON record per line, flushed as written
+
+    Records carry a "type": "apartment" (id, polygon, apartment_number and,
+    for multi-page runs, page) as each apartment is final, then one "summary"
+    with the usual result document minus the apartment lists, or an "error".
+    Safe to call from OCR threads.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+    def apartment(self, apartment, page=None):
+        record = {'type': 'apartment'}
+        if page is not None:
+            record['page'] = page
+        record.update(apartment)
+        self.write(record)
+
+    def summary(self, result):
+        record = {'type': 'summary'}
+        record.update({k: v for k, v in result.items() if k != 'apartments'})
+        if 'pages' in result:
+            record['pages'] = [{k: v for k, v in page.items() if k != 'apartments'} for page in result['pages']]
+        self.write(record)
+
+    def error(self, result):
+        """Final line of a failed run, with the error_result() document"""
+        self.write(dict({'type': 'error'}, **result))
+
+# ---------------------------------------------------------------------------
+# Worker mode
+#
+# A long-lived process that keeps cv2/numpy/fitz imported and the feature
+# objects built, then serves many detections. Requests are line-delimited
+# JSON objects, either on stdin or on a local Unix socket:
+#   {"id": "42", "source": "/path/plan.pdf", "target": null, "ocr": true}
+#   {"id": "43", "source": "/path/building.pdf", "pages": "1-20"}
+#   {"cmd": "health"}
+# Each request gets exactly one JSON line back, echoing its "id".
+# ---------------------------------------------------------------------------
+
+_worker_state = {}
+
+def _worker_init(cache=None, options=None, started=None):
+    """Pool initializer: warm up the per-process state once"""
+    # stdout carries the protocol in stdin mode, keep stray prints off it
+    sys.stdout = sys.stderr
+    get_feature_tools()
+    _worker_state['cache'] = cache
+    _worker_state['options'] = options or {}
+    _worker_state['tasks'] = started
+    _worker_state['pid'] = os.getpid()
+    _worker_state['started'] = time.time()
+
+def _worker_health():
+    """Report that a pool worker is alive"""
+    return {'pid': os.getpid(), 'uptime': round(time.time() - _worker_state.get('started', time.time()), 1)}
+
+def _worker_detect(request, progress=None):
+    """
+    Run one detection request inside a pool worker
+
+    progress(stage, page_index, page_count) is called as pipeline stages start.
+    """
+    source = request.get('source')
+    if not source or not os.path.exists(source):
+        return {'success': False, 'error': f'Source file not found: {source}'}
+
+    cache = _worker_state.get('cache')
+    options = _worker_state.get('options', {})
+    try:
+        if request.get('pages') is not None:
+            # Pool workers are daemonic and cannot fork their own pool
+            page_results = detect_apartments_pages(
+                source,
+                request['pages'],
+                request.get('target'),
+                enable_ocr=request.get('ocr', True),
+                workers=1,
+                cache=cache,
+                options=options,
+                progress=progress
+            )
+            return build_pages_result(page_results)
+
+        on_stage = None
+        if progress is not None:
+            on_stage = lambda name: progress(name, 0, 1)
+        timings = Timings(on_stage=on_stage)
+        if cache is not None:
+            cache = cache.for_request()
+        apartments, src_w, src_h, tgt_w, tgt_h = detect_apartments(
+            source,
+            request.get('target'),
+            enable_ocr=request.get('ocr', True),
+            timings=timings,
+            cache=cache,
+            previous_state=request.get('previous_state'),
+            save_state=request.get('save_state'),
+            **options
+        )
+        return build_result(apartments, src_w, src_h, tgt_w, tgt_h, timings, cache)
+    except Exception as e:
+        return error_result(e)
+
+def _tracked_task(token, fn, args):
+    """Pool task of PoolTasks: report which process runs `token`, then run fn(*args)"""
+    started = _worker_state.get('tasks')
+    if started is not None:
+        started.put((token, os.getpid()))
+    return fn(*args)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class PoolTasks:
+    """
+    Tasks of a worker pool, failed when the process running them dies
+
+    multiprocessing.Pool replaces a worker killed mid-task (OOM killer, a
+    crash inside OpenCV or PyMuPDF) but never completes that task, so its
+    callbacks would never run. Workers started with _worker_init(started=
+    queue) report every task they pick up on `queue`; check() calls
+    lost(pid) for a task whose process has been gone for `grace` seconds
+    (a worker retiring after max tasks exits right after its result is sent).
+    Exactly one of callback(result) and lost(pid) runs per task.
+    """
+
+    def __init__(self, pool, queue, grace=1.0):
+        self.pool = pool
+        self.queue = queue
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_token = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, fn, args, callback, lost):
+        """Run fn(*args) on the pool; a raised exception is passed on as an error_result()"""
+        with self.lock:
+            token = self.next_token
+            self.next_token += 1
+            self.pending[token] = {'callback': callback, 'lost': lost, 'pid': None, 'gone': None}
+        self.pool.apply_async(_tracked_task, (token, fn, args),
+                              callback=lambda result: self._finish(token, result),
+                              error_callback=lambda e: self._finish(token, error_result(e)))
+
+    def _finish(self, token, result):
+        with self.lock:
+            task = self.pending.pop(token, None)
+        if task is not None:
+            task['callback'](result)
+
+    def check(self):
+        """Fail the tasks whose worker process died"""
+        now = time.monotonic()
+        lost = []
+        with self.lock:
+            # Only this process reads the queue, so empty() cannot race a get()
+            while not self.queue.empty():
+                token, pid = self.queue.get()
+                if token in self.pending:
+                    self.pending[token]['pid'] = pid
+            for token, task in self.pending.items():
+                if task['pid'] is None or pid_alive(task['pid']):
+                    continue
+                task['gone'] = task['gone'] or now
+                if now - task['gone'] >= self.grace:
+                    lost.append(token)
+            lost = [self.pending.pop(token) for token in lost]
+        for task in lost:
+            task['lost'](task['pid'])
+
+    def watch(self, interval=0.5):
+        """check() every interval seconds, forever (run it on a daemon thread)"""
+        while True:
+            time.sleep(interval)
+            self.check()
+
+    def close(self, poll=0.1):
+        """Wait for the pending tasks, then stop the pool"""
+        self.pool.close()
+        while self.pending:
+            self.check()
+            time.sleep(poll)
+        # A lost task is never removed from the pool's result cache, which
+        # Pool.join() would wait for; all workers are idle by now
+        self.pool.terminate()
+        self.pool.join()
+
+class DetectionServer:
+    """Dispatches line-delimited JSON requests to a bounded worker pool"""
+
+    def __init__(self, workers=2, max_tasks_per_worker=100, request_timeout=120, cache=None, options=None,
+                 metrics=None):
+        import multiprocessing
+
+        self.workers = workers
+        self.metrics = metrics
+        self.request_timeout = request_timeout
+        self.started = time.time()
+        self.served = 0
+        started = multiprocessing.SimpleQueue()
+        self.pool = multiprocessing.Pool(
+            processes=workers,
+            initializer=_worker_init,
+            initargs=(cache, options, started),
+            maxtasksperchild=max_tasks_per_worker
+        )
+        # Answers the requests of workers that die mid-detection
+        self.tasks = PoolTasks(self.pool, started)
+        threading.Thread(target=self.tasks.watch, daemon=True).start()
+
+    def health(self):
+        """Check that the pool can still run work"""
+        try:
+            worker = self.pool.apply_async(_worker_health).get(timeout=10)
+            healthy = True
+        except Exception as e:
+            worker = {'error': str(e)}
+            healthy = False
+
+        return {
+            'success': healthy,
+            'status': 'ok' if healthy else 'unhealthy',
+            'server_pid': os.getpid(),
+            'workers': self.workers,
+            'uptime': round(time.time() - self.started, 1),
+            'served': self.served,
+            'worker': worker
+        }
+
+    def submit(self, line, callback):
+        """Parse one request line and call callback(response) once it is done"""
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+        except ValueError as e:
+            callback({'success': False, 'error': f'Invalid request: {e}'})
+            return
+
+        request_id = request.get('id')
+
+        def respond(response):
+            if request_id is not None:
+                response['id'] = request_id
+            callback(response)
+
+        cmd = request.get('cmd', 'detect')
+        if cmd == 'health':
+            respond(self.health())
+        elif cmd == 'detect':
+            self.served += 1
+
+            def done(response):
+                if self.metrics is not None:
+                    self.metrics.emit(response)
+                respond(response)
+
+            def lost(pid):
+                sys.stderr.write(f"Detection worker {pid} died during request {request_id}\n")
+                done({'success': False,
+                      'error': f'Detection worker {pid} died before finishing (e.g. out of memory)'})
+
+            self.tasks.submit(_worker_detect, (request,), done, lost)
+        else:
+            respond({'success': False, 'error': f'Unknown command: {cmd}'})
+
+    def handle(self, line):
+        """Blocking variant of submit() used by socket connections"""
+        done = threading.Event()
+        box = {}
+
+        def callback(response):
+            box['response'] = response
+            done.set()
+
+        self.submit(line, callback)
+        if not done.wait(self.request_timeout):
+            return {'success': False, 'error': f'Detection timed out after {self.request_timeout}s'}
+        return box['response']
+
+    def serve_stdin(self):
+        """Read requests from stdin, write responses to stdout as they complete"""
+        out = sys.stdout
+        lock = threading.Lock()
+        pending = []
+
+        def write(response):
+            with lock:
+                out.write(json.dumps(response) + '\n')
+                out.flush()
+            pending.pop()
+
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            pending.append(None)
+            self.submit(line, write)
+
+        # Drain outstanding work before exiting on EOF
+        while pending:
+            time.sleep(0.05)
+
+    def serve_socket(self, path):
+        """Accept connections on a Unix socket, one JSON line per request"""
+        import signal
+        import socketserver
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    line = line.decode('utf-8').strip()
+                    if not line:
+                        continue
+                    response = server.handle(line)
+                    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        # Let a plain `kill` (e.g. from a process supervisor) remove the socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as sock_server:
+            sock_server.daemon_threads = True
+            os.chmod(path, 0o660)
+            sys.stderr.write(f"Detection worker listening on {path} ({self.workers} workers)\n")
+            sys.stderr.flush()
+            try:
+                sock_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(path)
+
+    def close(self):
+        self.tasks.close()
+
+def health_check(socket_path, timeout=10):
+    """Send a health command to a running worker socket and return its reply"""
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(b'{"cmd": "health"}\n')
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    return json.loads(reply)
+
+# ---------------------------------------------------------------------------
+# Job mode
+#
+# Lets the web request return immediately: the caller drops a job directory
+# into a jobs directory and polls it, while `--job-worker` drains the queue
+# with a bounded pool. Layout of <jobs_dir>/<job id>/:
+#   job.json     request in the worker-mode format; relative paths are
+#                resolved against the job directory
+#   queued       marker written last by the submitter; a worker claims the
+#                job by renaming it to `claimed`
+#   status.json  {"id", "state": queued|running|done|failed, "stage",
+#                 "progress" (0-1), "page", "pages", timestamps, "error"}
+#   result.json  the detection result once state is done
+# ---------------------------------------------------------------------------
+
+JOB_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{1,64}$')
+
+# Pipeline stages in the order they normally start, for the progress fraction
+JOB_STAGES = ['cache_hash', 'dpi', 'render', 'text_extract', 'red_lines', 'regions', 'polygons', 'matching',
+              'registration', 'ocr', 'output']
+
+def write_json_atomic(path, data):
+    """Replace a JSON file in one step so pollers never read a partial write"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _job_dir(jobs_dir, job_id):
+    if not JOB_ID_PATTERN.match(job_id or ''):
+        raise ValueError(f'Invalid job id: {job_id}')
+    return os.path.join(jobs_dir, job_id)
+
+def submit_job(jobs_dir, request, job_id=None):
+    """Queue a detection request (worker-mode format) and return its job id"""
+    job_id = job_id or f"{time.strftime('%Y%m%d%H%M%S')}_{os.urandom(4).hex()}"
+    job_dir = _job_dir(jobs_dir, job_id)
+    os.makedirs(job_dir)
+    write_json_atomic(os.path.join(job_dir, 'job.json'), request)
+    write_json_atomic(os.path.join(job_dir, 'status.json'),
+                      {'id': job_id, 'state': 'queued', 'submitted': time.time()})
+    open(os.path.join(job_dir, 'queued'), 'w').close()
+    return job_id
+
+def job_status(jobs_dir, job_id):
+    """Current status of a job, with its result once it is done"""
+    job_dir = _job_dir(jobs_dir, job_id)
+    try:
+        with open(os.path.join(job_dir, 'status.json')) as f:
+            status = json.load(f)
+    except FileNotFoundError:
+        return {'id': job_id, 'state': 'unknown', 'error': f'No such job: {job_id}'}
+    if status.get('state') == 'done':
+        with open(os.path.join(job_dir, 'result.json')) as f:
+            status['result'] = json.load(f)
+    return status
+
+class JobProgress:
+    """progress() callback that records the running stage in status.json"""
+
+    def __init__(self, job_dir, status):
+        self.path = os.path.join(job_dir, 'status.json')
+        self.status = status
+
+    def __call__(self, stage, page_index, page_count):
+        position = JOB_STAGES.index(stage) if stage in JOB_STAGES else 0
+        progress = (page_index + position / len(JOB_STAGES)) / max(1, page_count)
+        # Lazily rendered stages can start late; never report going backwards
+        self.status.update({
+            'stage': stage,
+            'page': page_index + 1,
+            'pages': page_count,
+            'progress': round(max(progress, self.status.get('progress', 0.0)), 3)
+        })
+        self.update()
+
+    def update(self, **fields):
+        self.status.update(fields)
+        try:
+            write_json_atomic(self.path, self.status)
+        except OSError as e:
+            sys.stderr.write(f"Job status write failed for {self.path}: {e}\n")
+
+def _run_job(job_dir):
+    """Run one claimed job inside a pool worker; returns the result"""
+    with open(os.path.join(job_dir, 'status.json')) as f:
+        status = json.load(f)
+    progress = JobProgress(job_dir, status)
+    progress.update(state='running', started=time.time(), progress=0.0, pid=os.getpid())
+
+    try:
+        with open(os.path.join(job_dir, 'job.json')) as f:
+            request = json.load(f)
+        for key in ('source', 'target'):
+            if request.get(key):
+                request[key] = os.path.join(job_dir, request[key])
+        result = _worker_detect(request, progress)
+    except Exception as e:
+        result = error_result(e)
+
+    if result.get('success'):
+        write_json_atomic(os.path.join(job_dir, 'result.json'), result)
+        progress.update(state='done', progress=1.0, finished=time.time())
+    else:
+        progress.update(state='failed', error=result.get('error', 'Detection failed'), finished=time.time())
+    return result
+
+def claim_jobs(jobs_dir, limit):
+    """Claim up to `limit` queued jobs, oldest first; returns their directories"""
+    queued = []
+    for name in os.listdir(jobs_dir):
+        marker = os.path.join(jobs_dir, name, 'queued')
+        try:
+            queued.append((os.path.getmtime(marker), name))
+        except OSError:
+            continue
+
+    claimed = []
+    for _, name in sorted(queued):
+        if len(claimed) >= limit:
+            break
+        job_dir = os.path.join(jobs_dir, name)
+        try:
+            # Atomic: exactly one worker wins the rename
+            os.rename(os.path.join(job_dir, 'queued'), os.path.join(job_dir, 'claimed'))
+        except OSError:
+            continue
+        claimed.append(job_dir)
+    return claimed
+
+def expire_jobs(jobs_dir, retention, orphans=False):
+    """
+    Delete finished jobs older than retention seconds
+
+    With orphans=True, jobs still claimed (by a worker that has stopped) are
+    marked failed as well.
+    """
+    now = time.time()
+    for name in os.listdir(jobs_dir):
+        job_dir = os.path.join(jobs_dir, name)
+        try:
+            with open(os.path.join(job_dir, 'status.json')) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        if orphans and status.get('state') in ('queued', 'running') and os.path.exists(os.path.join(job_dir, 'claimed')):
+            JobProgress(job_dir, status).update(state='failed', error='Worker stopped before the job finished',
+                                                finished=now)
+        elif status.get('state') in ('done', 'failed') and now - status.get('finished', now) > retention:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+def serve_jobs(jobs_dir, workers=2, once=False, poll=1.0, retention=86400, max_tasks_per_worker=100,
+               cache=None, options=None, metrics=None):
+    """
+    Drain the job queue in jobs_dir on a pool of `workers` processes
+
+    Runs until interrupted, or with once=True until the queue is empty (for
+    cron). Only one job worker may serve a jobs directory at a time: on start,
+    jobs still claimed by a previous worker are marked failed, and so is a
+    job whose pool process dies while running it (see PoolTasks).
+    """
+    import multiprocessing
+
+    import signal
+
+    os.makedirs(jobs_dir, exist_ok=True)
+    expire_jobs(jobs_dir, retention, orphans=True)
+
+    def done(result):
+        if metrics is not None:
+            metrics.emit(result)
+
+    def lost(job_dir):
+        def fail(pid):
+            # The worker died before _run_job() could record the outcome
+            error = f'Detection worker {pid} died before the job finished (e.g. out of memory)'
+            sys.stderr.write(f"Job {os.path.basename(job_dir)}: {error}\n")
+            try:
+                with open(os.path.join(job_dir, 'status.json')) as f:
+                    status = json.load(f)
+            except (OSError, ValueError):
+                status = {'id': os.path.basename(job_dir)}
+            JobProgress(job_dir, status).update(state='failed', error=error, finished=time.time())
+            done({'success': False, 'error': error})
+        return fail
+
+    started = multiprocessing.SimpleQueue()
+    pool = multiprocessing.Pool(
+        processes=workers,
+        initializer=_worker_init,
+        initargs=(cache, options, started),
+        maxtasksperchild=max_tasks_per_worker
+    )
+    running = PoolTasks(pool, started)
+    # Let a plain `kill` stop claiming new jobs and wait for the running ones
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write(f"Job worker draining {jobs_dir} ({workers} workers)\n")
+    sys.stderr.flush()
+    last_expiry = time.time()
+    try:
+        while True:
+            running.check()
+            for job_dir in claim_jobs(jobs_dir, workers - len(running)):
+                running.submit(_run_job, (job_dir,), done, lost(job_dir))
+            if once and not running:
+                break
+            if time.time() - last_expiry > 3600:
+                expire_jobs(jobs_dir, retention)
+                last_expiry = time.time()
+            time.sleep(poll)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        running.close()
+
+def check_dependencies():
+    """
+    Which DEPENDENCIES are installed, and what that makes possible, without importing any
+
+    Modules are only located (importlib.util.find_spec) and their versions
+    read from the installed package metadata, so the probe takes a fraction
+    of a detection's start-up and its answer can be cached by the caller.
+    A module that is found but broken (e.g. OpenCV missing a system library)
+    still only fails when a detection imports it, with MissingDependency.
+    """
+    from importlib.util import find_spec
+    try:
+        from importlib import metadata
+    except ImportError:
+        metadata = None
+
+    dependencies = {}
+    for module, (_, packages, purpose) in DEPENDENCIES.items():
+        entry = {'available': find_spec(module) is not None, 'package': packages[0], 'needed_for': purpose}
+        for package in packages if entry['available'] and metadata is not None else []:
+            try:
+                entry['version'] = metadata.version(package)
+            except metadata.PackageNotFoundError:
+                continue
+            entry['package'] = package
+            break
+        dependencies[module] = entry
+
+    # pytesseract drives the tesseract binary, which pip does not install
+    tesseract = shutil.which('tesseract')
+    detection = dependencies['numpy']['available'] and dependencies['cv2']['available']
+    capabilities = {
+        'images': detection,
+        'pdf': detection and dependencies['fitz']['available'],
+        'ocr': dependencies['pytesseract']['available'] and tesseract is not None,
+    }
+    return {
+        'success': capabilities['pdf'],
+        'python': sys.version.split()[0],
+        'dependencies': dependencies,
+        'tesseract': tesseract,
+        'capabilities': capabilities,
+        'missing': [entry['package'] for module, entry in dependencies.items()
+                    if not entry['available'] and module in ('numpy', 'cv2', 'fitz')],
+    }
+
+def error_result(e):
+    """Error document for an exception, naming the package to install when one is missing"""
+    result = {'success': False, 'error': str(e)}
+    if isinstance(e, MissingDependency):
+        result['missing_dependency'] = e.package
+    return result
+
+def dpi_arg(value):
+    """argparse type of --dpi: a positive integer or 'auto'"""
+    if value == 'auto':
+        return value
+    try:
+        dpi = int(value)
+    except ValueError:
+        dpi = 0
+    if dpi <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive integer or 'auto', got {value!r}")
+    return dpi
 
 def main():
     parser = argparse.ArgumentParser(description='Detect apartments from floor plan PDF')
-    parser.add_argument('--source', required=True, help='Path to PDF with red lines')
+    parser.add_argument('--source', help='Path to PDF with red lines')
     parser.add_argument('--target', help='Path to clean image for polygon alignment')
     parser.add_argument('--output', help='Output JSON file path')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write NDJSON: one record per apartment as soon as it is final, then a summary')
     parser.add_argument('--no-ocr', action='store_true', help='Disable OCR apartment number extraction')
-    parser.add_argument('--debug', action='store_true', help='Enable debug mode with verbose output and image dumps')
+    parser.add_argument('--debug', action='store_true', help='Enable debug mode with verbose output and image dumps '
+                        '(one debug_output_* directory per page with --pages)')
+    parser.add_argument('--pages', help='PDF pages to process, e.g. "all" or "1-3,5" (one result per page)')
+    parser.add_argument('--page-workers', type=int, help='Processes for --pages (default: CPU count)')
+    parser.add_argument('--cache-dir', help='Directory for the content-hash cache of intermediate results')
+    parser.add_argument('--cache-max-mb', type=int, default=256, help='Size limit of --cache-dir before LRU eviction')
+    parser.add_argument('--dpi', type=dpi_arg, default=100,
+                        help='Render resolution for PDF sources, or "auto" to pick it per page from a preview')
+    parser.add_argument('--tile-height', type=int,
+                        help='Build the red-line mask in bands of this many pixel rows (bounded memory at high DPI)')
+    parser.add_argument('--ocr-mode', choices=['batch', 'single'], default='batch',
+                        help='OCR fallback: one mosaic per page (batch) or one Tesseract run per region')
+    parser.add_argument('--ocr-workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Concurrent Tesseract runs for the OCR fallback')
+    parser.add_argument('--ocr-budget', type=float, default=60,
+                        help='Seconds of OCR per page before returning partial results (0 = unlimited)')
+    parser.add_argument('--registration', choices=['full', 'pyramid'], default='full',
+                        help='Target alignment: features of the full images, or coarse-to-fine on a downscaled copy')
+    parser.add_argument('--feature-backend', choices=['auto'] + list(FEATURE_BACKENDS), default='auto',
+                        help='Registration features: ORB with SIFT fallback (auto), or a single backend')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report CPU time and peak RSS per stage in the timings block')
+    parser.add_argument('--metrics-file', help='Write stage timings as a Prometheus textfile after each run')
+    parser.add_argument('--statsd', metavar='HOST:PORT', help='Send stage timings as StatsD lines after each run')
+    parser.add_argument('--label-prefixes', type=lambda v: [w for w in v.split(',') if w],
+                        help='Comma-separated words before an apartment number (default: %s)'
+                        % ','.join(DEFAULT_LABEL_PREFIXES))
+    parser.add_argument('--area-suffixes', type=lambda v: [w for w in v.split(',') if w],
+                        help='Comma-separated area units; lines with them are not bare numbers (default: %s)'
+                        % ','.join(DEFAULT_AREA_SUFFIXES))
+    parser.add_argument('--text-scope', choices=['page', 'regions'], default='page',
+                        help='PDF text to read labels from: the whole page, or only around the detected regions')
+    parser.add_argument('--max-memory', type=int, metavar='MB',
+                        help='Resident memory budget: tile, lower the DPI, then skip OCR or registration to stay under it')
+    parser.add_argument('--previous-state', metavar='PATH',
+                        help='State file of an earlier run of this plan: only units near changed red lines are recomputed')
+    parser.add_argument('--save-state', metavar='PATH', help='Write this run\'s state file for a later --previous-state')
+    parser.add_argument('--match-mode', choices=['labels', 'index'], default='labels',
+                        help='Label matching: label-image lookup (fast) or geometric grid search')
+    parser.add_argument('--serve', action='store_true', help='Run as a long-lived worker reading JSON lines from stdin (or --socket)')
+    parser.add_argument('--socket', help='Unix socket path for --serve / --health')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes in --serve mode')
+    parser.add_argument('--max-tasks-per-worker', type=int, default=100, help='Recycle a worker after this many detections')
+    parser.add_argument('--health', action='store_true', help='Query a running worker on --socket and exit')
+    parser.add_argument('--check-deps', action='store_true',
+                        help='Print which Python dependencies are installed (JSON, without importing them) and exit')
+    parser.add_argument('--jobs-dir', help='Job queue directory for --submit-job / --job-status / --job-worker')
+    parser.add_argument('--submit-job', action='store_true',
+                        help='Queue --source (and --target, --pages, --no-ocr) in --jobs-dir, print the job id')
+    parser.add_argument('--job-status', metavar='ID', help='Print the status (and result, once done) of a job')
+    parser.add_argument('--job-worker', action='store_true', help='Drain --jobs-dir on --workers processes')
+    parser.add_argument('--once', action='store_true', help='With --job-worker, exit when the queue is empty (cron)')
+    parser.add_argument('--job-retention', type=float, default=24, help='Hours to keep finished jobs')
 
     args = parser.parse_args()
 
+    if args.check_deps:
+        report = check_dependencies()
+        print(json.dumps(report))
+        sys.exit(0 if report['success'] else 1)
+
+    if args.health:
+        if not args.socket:
+            parser.error('--health requires --socket')
+        try:
+            reply = health_check(args.socket)
+        except Exception as e:
+            reply = {'success': False, 'status': 'unreachable', 'error': str(e)}
+        print(json.dumps(reply))
+        sys.exit(0 if reply.get('success') else 1)
+
+    if (args.submit_job or args.job_status or args.job_worker) and not args.jobs_dir:
+        parser.error('--submit-job, --job-status and --job-worker require --jobs-dir')
+
+    if args.job_status:
+        try:
+            status = job_status(args.jobs_dir, args.job_status)
+        except ValueError as e:
+            status = {'state': 'unknown', 'error': str(e)}
+        print(json.dumps(status))
+        sys.exit(0 if status.get('state') != 'unknown' else 1)
+
+    if args.submit_job:
+        if not args.source:
+            parser.error('--submit-job requires --source')
+        job_id = submit_job(args.jobs_dir, {
+            'source': os.path.abspath(args.source),
+            'target': os.path.abspath(args.target) if args.target else None,
+            'pages': args.pages,
+            'ocr': not args.no_ocr
+        })
+        print(json.dumps({'success': True, 'id': job_id}))
+        return
+
+    # detect_apartments() settings shared by every mode
+    options = {
+        'match_mode': args.match_mode,
+        'ocr_mode': args.ocr_mode,
+        'ocr_workers': max(1, args.ocr_workers),
+        'ocr_budget': args.ocr_budget or None,
+        'registration': args.registration,
+        'feature_backend': args.feature_backend,
+        'profile': args.profile,
+        'dpi': args.dpi,
+        'label_prefixes': args.label_prefixes,
+        'area_suffixes': args.area_suffixes,
+        'tile_height': args.tile_height,
+        'text_scope': args.text_scope,
+        'max_memory': args.max_memory
+    }
+    if options['ocr_workers'] > 1:
+        # Parallel Tesseract processes would otherwise each spin up one OpenMP
+        # thread per core. Set once, before any worker process or thread starts
+        os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+    cache = None
+    if args.cache_dir:
+        cache = DetectionCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+
+    metrics = None
+    if args.metrics_file or args.statsd:
+        metrics = MetricsSink(args.metrics_file, args.statsd)
+
+    if args.job_worker or args.serve:
+        # Imported once here, so forked workers start with them loaded; PDF
+        # support stays optional as before
+        load_dependencies('numpy', 'cv2')
+        try:
+            load_dependencies('fitz')
+        except MissingDependency as e:
+            sys.stderr.write(f"{e}\n")
+
+    if args.job_worker:
+        serve_jobs(args.jobs_dir, max(1, args.workers), once=args.once, retention=args.job_retention * 3600,
+                   max_tasks_per_worker=args.max_tasks_per_worker, cache=cache, options=options, metrics=metrics)
+        return
+
+    if args.serve:
+        server = DetectionServer(max(1, args.workers), args.max_tasks_per_worker, cache=cache, options=options,
+                                 metrics=metrics)
+        try:
+            if args.socket:
+                server.serve_socket(args.socket)
+            else:
+                server.serve_stdin()
+        finally:
+            server.close()
+        return
+
+    if not args.source:
+        parser.error('--source is required')
+
     if not os.path.exists(args.source):
         print(json.dumps({'error': f'Source file not found: {args.source}'}))
         sys.exit(1)
 
+    if args.pages and (args.previous_state or args.save_state):
+        parser.error('--previous-state and --save-state work on single-page runs')
+
+    stream = None
+    if args.stream:
+        stream = NdjsonWriter(open(args.output, 'w') if args.output else sys.stdout)
+        # Keep debug prints from interleaving with the records
+        sys.stdout = sys.stderr
+
     try:
-        apartments, src_w, src_h, tgt_w, tgt_h = detect_apartments(
-            args.source,
-            args.target,
-            enable_ocr=not args.no_ocr,
-            debug=args.debug
-        )
+        if args.pages:
+            page_results = detect_apartments_pages(
+                args.source,
+                args.pages,
+                args.target,
+                enable_ocr=not args.no_ocr,
+                workers=args.page_workers,
+                cache=cache,
+                options=dict(options, debug=args.debug),
+                on_apartment=stream.apartment if stream is not None else None
+            )
+            result = build_pages_result(page_results)
+        else:
+            timings = Timings()
+            apartments, src_w, src_h, tgt_w, tgt_h = detect_apartments(
+                args.source,
+                args.target,
+                enable_ocr=not args.no_ocr,
+                debug=args.debug,
+                timings=timings,
+                cache=cache,
+                on_apartment=stream.apartment if stream is not None else None,
+                previous_state=args.previous_state,
+                save_state=args.save_state,
+                **options
+            )
 
-        result = {
-            'success': True,
-            'apartment_count': len(apartments),
-            'source_dimensions': {'width': src_w, 'height': src_h},
-            'target_dimensions': {'width': tgt_w, 'height': tgt_h} if tgt_w else None,
-            'apartments': apartments
-        }
+            result = build_result(apartments, src_w, src_h, tgt_w, tgt_h, timings, cache)
+
+        if metrics is not None:
+            metrics.emit(result)
+
+        if stream is not None:
+            stream.summary(result)
+            return
 
         output_json = json.dumps(result, indent=2)
 
@@ -736,7 +4072,10 @@ def main():
             print(output_json)
 
     except Exception as e:
-        print(json.dumps({'error': str(e)}))
+        if stream is not None:
+            stream.error(error_result(e))
+        else:
+            print(json.dumps(error_result(e)))
         sys.exit(1)
 
 if __name__ == '__main__':